@@ -1,12 +1,104 @@
-import boto3
-import argparse
+import csv
+import json
+import os
+import sys
+import time
+from collections import Counter
+from typing import Callable, List, Mapping, Set, Tuple
+from common import clients
+from common import datasync_policy
 from common import users as u
 from common import users_history as hist
-import time
-import sys
-from botocore.exceptions import ClientError
+from common.user_mapping import UserMapping
+
+def name_mapper(prefix: str = None, map_file: str = None) -> Callable[[str], str]:
+    '''
+    Target profile name for a source profile name: identity by default, prefix + name with a prefix,
+    or the second column of a "source,target" CSV. Profiles missing from the CSV map to None and are not migrated.
+    '''
+    if map_file:
+        with open(map_file, newline='') as f:
+            mapping = {row[0].strip(): row[1].strip() for row in csv.reader(f) if len(row) >= 2 and not row[0].startswith('#')}
+        return mapping.get
+    if prefix:
+        return lambda name: f"{prefix}{name}"
+    return lambda name: name
+
+def policy_attributes(tier: str = None, options: str = None) -> Mapping:
+    ## replication_tier and datasync_options of the target rows, read by the stream processor's option policy
+    attributes = {}
+    if tier:
+        attributes['replication_tier'] = tier
+    if options:
+        overrides = json.loads(options)
+        clean = datasync_policy.sanitize(overrides)
+        if len(clean) != len(overrides):
+            raise ValueError(f"unsupported datasync options {sorted(set(overrides) - set(clean))}. allowed: {sorted(datasync_policy.ALLOWED)}")
+        attributes['datasync_options'] = clean
+    return attributes
+
+## what single mode writes to the target row; the source's transfer totals, status, tier and
+## options describe the source replication and must not size the new one
+TARGET_ATTRIBUTES = ['replication', 'role_name', 'domain_id', 'user_profile_name', 'space_name', 'efs_sys_id', 'efs_uid']
+
+def plan_migration(users: u.Users, src_domain_name: str, target_domain_name: str,
+                   mapper: Callable[[str], str], attributes: Mapping = None) -> List[Tuple[Mapping, Mapping]]:
+    plan = []
+    for item in users.scan_users(domain_name=src_domain_name):
+        target_profile_name = mapper(item[u.HASHKEY])
+        if not target_profile_name:
+            continue
+        target = {name: item[name] for name in TARGET_ATTRIBUTES if name in item}
+        target[u.HASHKEY] = target_profile_name
+        target[u.RANGEKEY] = target_domain_name
+        target['replication'] = True
+        target.update(attributes or {})
+        plan.append((item, target))
+    return plan
+
+def find_duplicates(plan: List[Tuple[Mapping, Mapping]]) -> Set[Tuple[str, str]]:
+    ## target keys more than one source profile maps to, e.g. two CSV rows or a prefix that collides
+    counts = Counter((target[u.RANGEKEY], target[u.HASHKEY]) for _, target in plan)
+    return {key for key, count in counts.items() if count > 1}
+
+def find_conflicts(users: u.Users, plan: List[Tuple[Mapping, Mapping]]) -> Set[Tuple[str, str]]:
+    ## one BatchGetItem per 100 target keys instead of a GetItem per profile
+    keys = [{u.HASHKEY: target[u.HASHKEY], u.RANGEKEY: target[u.RANGEKEY]} for _, target in plan]
+    return {(item[u.RANGEKEY], item[u.HASHKEY]) for item in users.batch_get_users(keys)}
+
+def print_plan(plan: List[Tuple[Mapping, Mapping]], conflicts: Set[Tuple[str, str]], duplicates: Set[Tuple[str, str]] = frozenset()):
+    for src, target in plan:
+        key = (target[u.RANGEKEY], target[u.HASHKEY])
+        mark = '=' if key in duplicates else '!' if key in conflicts else '+'
+        print(f"{mark} {target[u.RANGEKEY]}/{target[u.HASHKEY]} <- {src[u.RANGEKEY]}/{src[u.HASHKEY]}"
+              f" (efs_sys_id {src.get('efs_sys_id')}, efs_uid {src.get('efs_uid')})")
+    if duplicates:
+        print(f"{len(duplicates)} target profiles mapped from more than one source profile (=)")
+    print(f"{len(plan) - len(conflicts)} to add, {len(conflicts)} already exist (!)")
+
+def apply_migration(users: u.Users, users_hist: hist.UsersHistory, targets: List[Mapping]) -> int:
+    epoctime = int(time.time() * 1000)
+    count = users.put_users(targets)
+    users_hist.put_users([
+        {
+            os.getenv('HASHKEY_HIST', 'profile_name'): target[u.HASHKEY],
+            ## distinct range keys so a batch never overwrites its own history rows
+            os.getenv('RANGEKEY_HIST', 'epoctime'): epoctime + i,
+            "replication": target['replication'],
+            "role_name": target.get('role_name', ''),
+            "domain_id": target.get('domain_id', ''),
+            "domain_name": target[u.RANGEKEY],
+            "user_profile_name": target.get('user_profile_name', ''),
+            "space_name": target.get('space_name', ''),
+            "efs_sys_id": target.get('efs_sys_id', ''),
+            "efs_uid": target.get('efs_uid', '')
+        }
+        for i, target in enumerate(targets)
+    ])
+    return count
 
 if __name__ == "__main__":
+    import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "-src-domain-name",
@@ -52,6 +144,54 @@ if __name__ == "__main__":
         type=str,
         default='studioUserHistory'
     )
+    parser.add_argument(
+        "-all-profiles",
+        "--all-profiles",
+        dest="all_profiles",
+        action='store_true',
+        help="domain mode: map every profile of the source domain into the target domain"
+    )
+    parser.add_argument(
+        "-name-prefix",
+        "--name-prefix",
+        dest="name_prefix",
+        type=str,
+        help="domain mode: target profile name is prefix + source profile name"
+    )
+    parser.add_argument(
+        "-name-map-file",
+        "--name-map-file",
+        dest="name_map_file",
+        type=str,
+        help="domain mode: CSV of source_profile_name,target_profile_name; unlisted profiles are skipped"
+    )
+    parser.add_argument(
+        "-skip-existing",
+        "--skip-existing",
+        dest="skip_existing",
+        action='store_true',
+        help="domain mode: migrate the rest when some targets already exist instead of aborting"
+    )
+    parser.add_argument(
+        "-tier",
+        "--tier",
+        dest="tier",
+        type=str,
+        help="replication_tier of the target profiles, e.g. bulk or priority"
+    )
+    parser.add_argument(
+        "-datasync-options",
+        "--datasync-options",
+        dest="datasync_options",
+        type=str,
+        help='DataSync options pinned for the target profiles as JSON, e.g. \'{"LogLevel": "OFF"}\''
+    )
+    parser.add_argument(
+        "-dry-run",
+        "--dry-run",
+        dest="dry_run",
+        action='store_true'
+    )
     args = parser.parse_args()
     table = args.table_name
     history_table = args.history_table_name
@@ -60,10 +200,38 @@ if __name__ == "__main__":
     target_profile_name = args.target_profile_name
     target_domain_name = args.target_domain_name
     region = args.region
+    ddb_resource = clients.resource('dynamodb', region)
+    try:
+        attributes = policy_attributes(args.tier, args.datasync_options)
+    except ValueError as e:
+        sys.exit(str(e))
+
+    if args.all_profiles:
+        users = u.Users(ddb_resource, table)
+        mapper = name_mapper(prefix=args.name_prefix, map_file=args.name_map_file)
+        plan = plan_migration(users, src_domain_name, target_domain_name, mapper, attributes)
+        duplicates = find_duplicates(plan)
+        if duplicates:
+            ## one of them would silently overwrite the other; no mapping flag makes that right
+            print(f"plan for domain {src_domain_name} -> {target_domain_name}:")
+            print_plan(plan, set(), duplicates)
+            sys.exit(f"{len(duplicates)} target profiles are mapped from more than one source profile. Nothing written; fix the name mapping.")
+        conflicts = find_conflicts(users, plan)
+        print(f"plan for domain {src_domain_name} -> {target_domain_name}:")
+        print_plan(plan, conflicts)
+        if args.dry_run:
+            sys.exit(0)
+        if conflicts and not args.skip_existing:
+            sys.exit(f"{len(conflicts)} target profiles already exist. Nothing written; use --skip-existing or a different mapping.")
+        targets = [target for _, target in plan if (target[u.RANGEKEY], target[u.HASHKEY]) not in conflicts]
+        users_hist = hist.UsersHistory(ddb_resource=ddb_resource, table_name=history_table)
+        count = apply_migration(users, users_hist, targets)
+        print(f"{count} profiles added to table {table} and {history_table}")
+        sys.exit(0)
+
     table_key = {"domain_name": src_domain_name, "profile_name": src_profile_name}
     target_table_key = {"domain_name": target_domain_name, "profile_name": target_profile_name}
     print(f"Read table {table} with key {table_key}")
-    ddb_resource = boto3.resource('dynamodb', region)
     users = u.Users(ddb_resource, args.table_name)
     print("table exists")
     print('-' * 50)
@@ -80,29 +248,24 @@ if __name__ == "__main__":
     item['profile_name'] = target_profile_name
     item['domain_name'] = target_domain_name
     item['replication'] = True
-    response = users.update_user(
-        key=target_table_key,
-        expression="set replication = :rp, domain_id = :d, user_profile_name = :upn, space_name = :s, efs_sys_id =:es, efs_uid = :eu, role_name =:rn",
-        attributes={
-            ":rp": item['replication'],
-            ":rn": item['role_name'],
-            ":d": item['domain_id'],
-            ":upn": item['user_profile_name'],
-            ":s": item['space_name'],
-            ":es": item['efs_sys_id'],
-            ":eu": item['efs_uid']
-        },
-        ret_val='ALL_NEW'
-    )
-    print(f"update table {table} respose: {response}")
-    print('-' * 50)
     users_hist = hist.UsersHistory(
         ddb_resource=ddb_resource,
         table_name=history_table
     )
-    print(f"append the item into table {history_table}")
-    users_hist.put_user(
-        item={
+    print(f"update table {table} and append the item into table {history_table} in one transaction")
+    response = UserMapping(users, users_hist).write(
+        key=target_table_key,
+        attributes={
+            "replication": item['replication'],
+            "role_name": item['role_name'],
+            "domain_id": item['domain_id'],
+            "user_profile_name": item['user_profile_name'],
+            "space_name": item['space_name'],
+            "efs_sys_id": item['efs_sys_id'],
+            "efs_uid": item['efs_uid'],
+            **attributes
+        },
+        history_item={
             "profile_name": target_profile_name,
             "epoctime": int(time.time() * 1000),
             "replication": item['replication'],
@@ -115,6 +278,7 @@ if __name__ == "__main__":
             "efs_uid": item['efs_uid']
         }
     )
+    print(f"write user mapping response: {response}")
 print("Done")
 
 
@@ -1,10 +1,10 @@
-import boto3
-import argparse
 import os
 import logging
 import string
 from botocore.exceptions import ClientError
 from common import cfnresponse
+from common import clients
+from common import metrics
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -51,6 +51,7 @@ def update_security_groups(source: string, target: string, client):
             f"Could not update target security group {target} with source {source}: {e}")
         return
 
+@metrics.report_api_calls('add-security-group')
 def lambda_handler(event, context):
     logger.info(f"received event: {event}")
     physicalResourceId = event.get('PhysicalResourceId')
@@ -63,12 +64,12 @@ def lambda_handler(event, context):
             physicalResourceId=physicalResourceId
         )
     try:
-        efs = boto3.client('efs')
+        efs = clients.client('efs')
         mount_id = get_target_mount_id(event.get('ResourceProperties')['EFS_ID'], efs)
         logger.info(f"obtained target_mount_id {mount_id}")
         security_groups = get_security_group(mount_id, efs)
         logger.info(f"obtained security groups {security_groups} from target_mount_id {mount_id}")
-        ec2 = boto3.client('ec2')
+        ec2 = clients.client('ec2')
         response = update_security_groups(
             source=event.get('ResourceProperties')['SECUITY_GROUPS'],
             target=security_groups,
@@ -100,6 +101,7 @@ def lambda_handler(event, context):
     return True
 
 if __name__ == "__main__":
+    import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "-domain-id",
@@ -0,0 +1,56 @@
+import json
+import os
+import string
+from typing import Mapping
+import logging
+from common import callbacks
+from common import clients
+from common import metrics
+from common.replication_state import ReplicationState
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+def app_key(domain_id: string, owner: string) -> string:
+    ## same key as the state machine's AppWait.Key
+    return f"app#{domain_id}#{owner}"
+
+def wake(key: string, output: Mapping, state: ReplicationState, sfn_client) -> string:
+    '''
+    Cut short the wait of the execution parked on key, so it checks the app again right away.
+    No record means nothing is waiting; the execution keeps polling on its own schedule.
+    Returns 'woken' or 'ignored'.
+    '''
+    item = state.get(key)
+    if not item or 'token' not in item:
+        logger.info(f"no execution is waiting on {key}")
+        return 'ignored'
+    woken = callbacks.send_task_success(item['token'], json.dumps(output), sfn_client)
+    state.release(key)
+    if woken:
+        logger.info(f"woke {item.get('execution')} waiting on {key}")
+        return 'woken'
+    return 'ignored'
+
+@metrics.report_api_calls('app-event-processor')
+def lambda_handler(event, context):
+    '''
+    Target of the CreateApp rule. SageMaker emits no event when an app turns InService, so the
+    CreateApp call is the earliest signal that the target app is on its way.
+    '''
+    logger.info(f"received event: {event}")
+    if 'detail' not in event or 'requestParameters' not in event['detail']:
+        logger.error(f"Expected keys detail and requestParameters in input payload but didn't exist")
+        raise ValueError(f"Invalid event format: {event}")
+    request = event['detail']['requestParameters'] or {}
+    owner = request.get('spaceName') or request.get('userProfileName')
+    if not request.get('domainId') or not owner:
+        logger.info(f"nothing to do. app is not owned by a profile or space: {request}")
+        return 'ignored'
+    output = {
+        "AppEvent": event['detail'].get('eventName'),
+        "AppType": request.get('appType'),
+        "AppName": request.get('appName')
+    }
+    state = ReplicationState(clients.resource('dynamodb'), os.getenv('REPLICATION_STATE_TABLE', 'studioReplicationState'))
+    return wake(app_key(request['domainId'], owner), output, state, clients.client('stepfunctions'))
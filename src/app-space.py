@@ -1,12 +1,12 @@
 import time
-import boto3
 import logging
 from common import cfnresponse
+from common import clients
+from common import metrics
 import json
 
-sm_client = boto3.client('sagemaker')
-
 def create_apps_space(domain_id, space_name):
+    sm_client = clients.client('sagemaker')
     logging.info(f'Start creating apps for space: {space_name}')
 
     try:
@@ -58,6 +58,7 @@ def create_apps_space(domain_id, space_name):
     return response
 
 def delete_apps_space(domain_id, space_name):
+    sm_client = clients.client('sagemaker')
     logging.info(f'Start deleting apps for space: {space_name}')
 
     try:
@@ -86,6 +87,7 @@ def delete_apps_space(domain_id, space_name):
     logging.info(f'KernelGateway apps for space {space_name} deleted')
     return
 
+@metrics.report_api_calls('app-space')
 def lambda_handler(event, context):
     logging.info(f'REQUEST RECEIVED: {event}')
     response_data = {}
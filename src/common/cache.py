@@ -0,0 +1,55 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Hashable
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel('ERROR')
+
+class TTLCache:
+    '''
+    Size-bounded LRU cache whose entries expire ttl seconds after they were stored.
+    Kept at module level by callers so entries survive warm Lambda invocations.
+    '''
+    def __init__(self, maxsize: int = 64, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, value: Any):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                evicted, _ = self._data.popitem(last=False)
+                logger.debug(f"evicted {evicted} from cache")
+
+    def invalidate(self, key: Hashable = None):
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._data)}
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,28 @@
+import string
+from botocore.exceptions import ClientError
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel('ERROR')
+
+## the execution timed out, failed or was stopped while waiting; nothing left to resume
+GONE_ERRORS = ['TaskTimedOut', 'TaskDoesNotExist', 'InvalidToken']
+
+def send_task_success(token: string, output: string, client) -> bool:
+    '''
+    Resume a state machine task parked on waitForTaskToken.
+    Returns False when the token is no longer waited on.
+    '''
+    try:
+        client.send_task_success(
+            taskToken=token,
+            output=output
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] in GONE_ERRORS:
+            logger.warning(f"could not resume execution: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
+            return False
+        logger.error(
+            f"Could not send task success: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
+        raise
+    return True
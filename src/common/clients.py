@@ -0,0 +1,72 @@
+import boto3
+import os
+import string
+from botocore.config import Config
+from threading import Lock
+import logging
+from common import metrics
+from common import ratelimit
+
+logger = logging.getLogger(__name__)
+logger.setLevel('ERROR')
+
+## clients and resources are created once per container and reused by every warm invocation
+MAX_POOL_CONNECTIONS = int(os.getenv('MAX_POOL_CONNECTIONS', 50))
+RETRY_MAX_ATTEMPTS = int(os.getenv('RETRY_MAX_ATTEMPTS', 8))
+
+_clients = {}
+_resources = {}
+_account_id = None
+_lock = Lock()
+
+def _config() -> Config:
+    options = {
+        "max_pool_connections": MAX_POOL_CONNECTIONS,
+        "retries": {"mode": "standard", "max_attempts": RETRY_MAX_ATTEMPTS}
+    }
+    ## tcp_keepalive is not available on older botocore releases
+    if 'tcp_keepalive' in Config.OPTION_DEFAULTS:
+        options["tcp_keepalive"] = True
+    return Config(**options)
+
+def client(service_name: string, region_name: string = None):
+    key = (service_name, region_name)
+    with _lock:
+        if key not in _clients:
+            logger.debug(f"create client {service_name} in region {region_name}")
+            _clients[key] = metrics.instrument(boto3.client(service_name, region_name=region_name, config=_config()))
+            ## every SageMaker Describe*/List* call in the process shares one adaptive budget
+            if service_name == 'sagemaker':
+                ratelimit.install(_clients[key])
+        return _clients[key]
+
+def resource(service_name: string, region_name: string = None):
+    key = (service_name, region_name)
+    with _lock:
+        if key not in _resources:
+            logger.debug(f"create resource {service_name} in region {region_name}")
+            _resources[key] = boto3.resource(service_name, region_name=region_name, config=_config())
+            metrics.instrument(getattr(getattr(_resources[key], 'meta', None), 'client', None))
+        return _resources[key]
+
+def register_client(service_name: string, client, region_name: string = None):
+    ## lets local tools and benchmarks swap in stand-in clients
+    with _lock:
+        _clients[(service_name, region_name)] = client
+
+def register_resource(service_name: string, resource, region_name: string = None):
+    with _lock:
+        _resources[(service_name, region_name)] = resource
+
+def account_id() -> string:
+    global _account_id
+    if _account_id is None:
+        _account_id = client('sts').get_caller_identity().get('Account')
+    return _account_id
+
+def reset():
+    global _account_id
+    with _lock:
+        _clients.clear()
+        _resources.clear()
+        _account_id = None
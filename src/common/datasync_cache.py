@@ -0,0 +1,58 @@
+import hashlib
+import json
+import string
+from typing import Mapping
+from botocore.exceptions import ClientError
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel('ERROR')
+
+## DataSync locations and tasks are reusable: a location is fully defined by
+## (file system ARN, subdirectory, subnet, security groups) and a task by its two locations.
+## their ARNs are kept in the replication state table under these keys, without expiry.
+## the state machine writes the entries after creating a resource and drops the task entry
+## when a cached task turns out to be gone.
+
+def digest(*parts) -> string:
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+def location_key(efs_arn: string, subdirectory: string, subnet_arn: string, security_group_arns) -> string:
+    return f"location#{digest(efs_arn, str(subdirectory).strip('/'), subnet_arn, sorted(security_group_arns or []))}"
+
+def task_key(source_location_key: string, target_location_key: string, includes: string = None) -> string:
+    ## a shard's task copies only its include filter, so it is a different task
+    if includes:
+        return f"task#{digest(source_location_key, target_location_key, includes)}"
+    return f"task#{digest(source_location_key, target_location_key)}"
+
+def endpoint_key(endpoint: Mapping) -> string:
+    ## endpoint is the Source or Target block of the state machine input
+    return location_key(
+        endpoint['EfsFilesystemArn'],
+        endpoint['HomeEfsFileSystemUid'],
+        endpoint['SubnetArn'],
+        endpoint['SecurityGroupArns']
+    )
+
+def lookup(input: Mapping, state=None) -> Mapping:
+    '''
+    The Cache block of the state machine input: the three cache keys, plus the ARN of every
+    resource already known. The state machine skips straight to StartTaskExecution when TaskArn is set.
+    '''
+    cache = {
+        "SourceLocationKey": endpoint_key(input['Source']),
+        "TargetLocationKey": endpoint_key(input['Target'])
+    }
+    cache["TaskKey"] = task_key(cache["SourceLocationKey"], cache["TargetLocationKey"], input.get('Includes'))
+    if state is None:
+        return cache
+    try:
+        items = state.get_many([cache["TaskKey"], cache["SourceLocationKey"], cache["TargetLocationKey"]])
+    except ClientError:
+        ## a cache miss only costs the create calls
+        return cache
+    for name, key in [("TaskArn", "TaskKey"), ("SourceLocationArn", "SourceLocationKey"), ("TargetLocationArn", "TargetLocationKey")]:
+        if cache[key] in items and items[cache[key]].get('arn'):
+            cache[name] = items[cache[key]]['arn']
+    return cache
@@ -0,0 +1,185 @@
+import json
+import os
+import string
+from typing import List, Mapping, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel('ERROR')
+
+## DataSync task options of one replication, chosen from what is known about the home directory.
+## facts are {"bytes": int or None, "files": int or None, "tier": str or None}: the totals the last
+## replication recorded on the users row (or an estimate put there), and the row's replication_tier.
+## every rule whose `when` holds is applied in order, later rules win; the row's datasync_options
+## attribute is applied last, so one profile can always be pinned to specific options.
+
+GiB = 2 ** 30
+MiB = 2 ** 20
+
+BASE_OPTIONS = {
+    "Gid": 'NONE',
+    "LogLevel": 'TRANSFER',
+    "OverwriteMode": 'ALWAYS',
+    "PosixPermissions": 'NONE',
+    "TransferMode": 'CHANGED',
+    "Uid": 'NONE',
+    "VerifyMode": 'POINT_IN_TIME_CONSISTENT',
+    "TaskQueueing": 'ENABLED'
+}
+
+MANY_FILES = int(os.getenv('POLICY_MANY_FILES', 100000))
+HUGE_FILES = int(os.getenv('POLICY_HUGE_FILES', 1000000))
+LARGE_BYTES = int(os.getenv('POLICY_LARGE_BYTES', 500 * GiB))
+BULK_BYTES_PER_SECOND = int(os.getenv('POLICY_BULK_BYTES_PER_SECOND', 50 * MiB))
+
+RULES = [
+    {
+        ## per-file logs of a first copy of unknown size can run into millions of entries
+        "name": "unknown-size",
+        "when": {"unknown": True},
+        "set": {"LogLevel": 'BASIC'}
+    },
+    {
+        "name": "many-files",
+        "when": {"files_at_least": MANY_FILES},
+        "set": {"LogLevel": 'BASIC', "VerifyMode": 'ONLY_FILES_TRANSFERRED'}
+    },
+    {
+        "name": "huge-files",
+        "when": {"files_at_least": HUGE_FILES},
+        "set": {"LogLevel": 'OFF'}
+    },
+    {
+        ## a full destination scan doubles the read load of a large copy
+        "name": "large-bytes",
+        "when": {"bytes_at_least": LARGE_BYTES},
+        "set": {"VerifyMode": 'ONLY_FILES_TRANSFERRED'}
+    },
+    {
+        ## background restores share the EFS throughput with running notebooks
+        "name": "bulk-tier",
+        "when": {"tier": ['bulk']},
+        "set": {"BytesPerSecond": BULK_BYTES_PER_SECOND, "TaskQueueing": 'ENABLED'}
+    },
+    {
+        "name": "priority-tier",
+        "when": {"tier": ['priority']},
+        "set": {"BytesPerSecond": -1}
+    }
+]
+
+## the values this module may set; anything else in an override is dropped
+ALLOWED = {
+    "LogLevel": ['OFF', 'BASIC', 'TRANSFER'],
+    "VerifyMode": ['POINT_IN_TIME_CONSISTENT', 'ONLY_FILES_TRANSFERRED', 'NONE'],
+    "TaskQueueing": ['ENABLED', 'DISABLED'],
+    "OverwriteMode": ['ALWAYS', 'NEVER'],
+    "TransferMode": ['CHANGED', 'ALL'],
+    "PosixPermissions": ['NONE', 'PRESERVE'],
+    "Uid": ['NONE', 'INT_VALUE', 'NAME', 'BOTH'],
+    "Gid": ['NONE', 'INT_VALUE', 'NAME', 'BOTH'],
+    "PreserveDeletedFiles": ['PRESERVE', 'REMOVE'],
+    "BytesPerSecond": int
+}
+
+def matches(when: Mapping, facts: Mapping) -> bool:
+    for condition, value in when.items():
+        if condition == 'unknown':
+            if (facts.get('bytes') is None and facts.get('files') is None) != value:
+                return False
+        elif condition == 'files_at_least':
+            if facts.get('files') is None or facts['files'] < value:
+                return False
+        elif condition == 'bytes_at_least':
+            if facts.get('bytes') is None or facts['bytes'] < value:
+                return False
+        elif condition == 'tier':
+            if facts.get('tier') not in value:
+                return False
+        else:
+            raise ValueError(f"unknown condition {condition}")
+    return True
+
+def valid(name: string, value) -> bool:
+    allowed = ALLOWED.get(name)
+    if allowed is int:
+        return isinstance(value, int) and not isinstance(value, bool) and (value == -1 or value >= 1)
+    return allowed is not None and value in allowed
+
+def sanitize(overrides: Mapping) -> Mapping:
+    clean = {}
+    for name, value in (overrides or {}).items():
+        ## numbers come back from DynamoDB as Decimal or, in stream images, as strings
+        if ALLOWED.get(name) is int:
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                pass
+        if valid(name, value):
+            clean[name] = value
+        else:
+            logger.warning(f"ignore datasync option override {name}={value}")
+    return clean
+
+def consistent(options: Mapping) -> Mapping:
+    ## combinations DataSync rejects: removing deleted files needs the changed-files scan
+    options = dict(options)
+    if options.get('PreserveDeletedFiles') == 'REMOVE' and options.get('TransferMode') == 'ALL':
+        options['PreserveDeletedFiles'] = 'PRESERVE'
+    return options
+
+def decide(facts: Mapping, overrides: Mapping = None, rules: List[Mapping] = None) -> Tuple[Mapping, List[str]]:
+    '''
+    Returns (options, names of the rules applied), "override" last when overrides changed anything.
+    '''
+    options = dict(BASE_OPTIONS)
+    applied = []
+    for rule in RULES if rules is None else rules:
+        if matches(rule['when'], facts):
+            options.update(rule['set'])
+            applied.append(rule['name'])
+    clean = sanitize(overrides)
+    if clean:
+        options.update(clean)
+        applied.append('override')
+    return consistent(options), applied
+
+def number(attribute: Mapping):
+    ## a stream image attribute stored as N or as S (the state machine writes the totals as strings)
+    if not attribute:
+        return None
+    value = attribute.get('N', attribute.get('S'))
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+def facts_from_record(record: Mapping) -> Tuple[Mapping, Mapping]:
+    '''
+    (facts, overrides) of a users table stream record. The new image wins over the old one, an
+    estimate (estimated_bytes, estimated_files) is used when no replication recorded totals yet.
+    '''
+    images = [record['dynamodb'].get('NewImage', {}), record['dynamodb'].get('OldImage', {})]
+    def first(*names):
+        for name in names:
+            for image in images:
+                value = number(image.get(name))
+                if value is not None:
+                    return value
+        return None
+    tier = next((image['replication_tier'].get('S') for image in images if image.get('replication_tier', {}).get('S')), None)
+    overrides = {}
+    raw = images[0].get('datasync_options', {})
+    if 'M' in raw:
+        overrides = {k: v.get('S', v.get('N')) for k, v in raw['M'].items()}
+    elif 'S' in raw:
+        try:
+            overrides = json.loads(raw['S'])
+        except ValueError:
+            logger.warning(f"ignore datasync_options that is not JSON: {raw['S']}")
+    facts = {
+        "bytes": first('bytes_written', 'estimated_bytes'),
+        "files": first('files_transferred', 'estimated_files'),
+        "tier": tier
+    }
+    return facts, overrides
@@ -0,0 +1,114 @@
+import functools
+import json
+import os
+import string
+import time
+from collections import defaultdict
+from threading import Lock
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel('ERROR')
+
+NAMESPACE = os.getenv('METRICS_NAMESPACE', 'SageMakerStudioEfsRecovery')
+
+class ApiCallStats:
+    '''
+    Per-invocation counters of AWS API calls, keyed by service.operation.
+    Fed by botocore before-call/after-call hooks registered with instrument().
+    '''
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = defaultdict(lambda: {"Calls": 0, "Errors": 0, "Retries": 0, "Latency": 0.0})
+
+    def before_call(self, model, context, **kwargs):
+        context['api_call_operation'] = f"{model.service_model.service_name}.{model.name}"
+        context['api_call_start'] = time.perf_counter()
+
+    def after_call(self, context, http_response=None, parsed=None, **kwargs):
+        if 'api_call_operation' not in context:
+            return
+        latency = (time.perf_counter() - context['api_call_start']) * 1000
+        retries = (parsed or {}).get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        failed = http_response is None or http_response.status_code >= 300
+        self.record(context['api_call_operation'], latency, retries, failed)
+
+    def after_call_error(self, context, **kwargs):
+        ## raised before a response was parsed, e.g. connection errors once retries are exhausted
+        self.after_call(context)
+
+    def record(self, operation: string, latency: float, retries: int = 0, failed: bool = False):
+        with self._lock:
+            stats = self.calls[operation]
+            stats["Calls"] += 1
+            stats["Retries"] += retries
+            stats["Errors"] += int(failed)
+            stats["Latency"] += latency
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {op: dict(stats) for op, stats in self.calls.items()}
+
+    def emf(self, handler: string) -> list:
+        ## one CloudWatch Embedded Metric Format document per service.operation
+        timestamp = int(time.time() * 1000)
+        documents = []
+        for operation, stats in sorted(self.summary().items()):
+            documents.append({
+                "_aws": {
+                    "Timestamp": timestamp,
+                    "CloudWatchMetrics": [{
+                        "Namespace": NAMESPACE,
+                        "Dimensions": [["Handler", "Operation"], ["Handler"]],
+                        "Metrics": [
+                            {"Name": "Calls", "Unit": "Count"},
+                            {"Name": "Errors", "Unit": "Count"},
+                            {"Name": "Retries", "Unit": "Count"},
+                            {"Name": "Latency", "Unit": "Milliseconds"}
+                        ]
+                    }]
+                },
+                "Handler": handler,
+                "Operation": operation,
+                "Calls": stats["Calls"],
+                "Errors": stats["Errors"],
+                "Retries": stats["Retries"],
+                "Latency": round(stats["Latency"], 3)
+            })
+        return documents
+
+api_calls = ApiCallStats()
+
+def instrument(client):
+    ## clients without botocore events (e.g. local stand-ins) are left alone
+    events = getattr(getattr(client, 'meta', None), 'events', None)
+    if events is None:
+        return client
+    events.register('before-call.*.*', api_calls.before_call, unique_id='metrics-before-call')
+    events.register('after-call.*.*', api_calls.after_call, unique_id='metrics-after-call')
+    events.register('after-call-error.*.*', api_calls.after_call_error, unique_id='metrics-after-call-error')
+    return client
+
+def emit(handler: string):
+    for document in api_calls.emf(handler):
+        print(json.dumps(document))
+
+def report_api_calls(handler: string):
+    '''
+    Decorator for lambda_handler: resets the counters, runs the handler and prints
+    the API call summary as EMF on the way out, whether the handler returns or raises.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(event, context):
+            api_calls.reset()
+            try:
+                return func(event, context)
+            finally:
+                emit(handler)
+        return wrapper
+    return decorator
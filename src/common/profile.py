@@ -1,14 +1,23 @@
-import json
 import string
-import boto3
 from typing import Mapping
 from botocore.exceptions import ClientError, ParamValidationError
 import logging
-import argparse
+import os
+from common import cache
+from common import ratelimit
 
 logger = logging.getLogger(__name__)
 logger.setLevel('ERROR')
 
+## domain metadata (HomeEfsFileSystemId, DomainName) rarely changes, so keep it across warm invocations
+domain_cache = cache.TTLCache(
+    maxsize=int(os.getenv('DOMAIN_CACHE_SIZE', 64)),
+    ttl=float(os.getenv('DOMAIN_CACHE_TTL', 300))
+)
+
+def invalidate_domain_cache(domain_id: string = None):
+    domain_cache.invalidate(domain_id)
+
 class Profile:
     def __init__(self, domain_id: string, sm_client, profile_name='', space_name='', role_name=''):
         self.client = sm_client
@@ -45,17 +54,29 @@ class Profile:
         self.efs_uid = meta['HomeEfsFileSystemUid']
         logger.debug(f"HomeEfsFileSystemUid:{self.efs_sys_id}")
 
+    def raise_if_throttled(self, e: ClientError):
+        ## let the event source retry instead of skipping the profile
+        if e.response['Error']['Code'] in ratelimit.THROTTLE_CODES:
+            logger.error(
+                f"Throttled while building profile for domain {self.domain_id}: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
+            raise e
+
     def get_domain_metadata(self) -> Mapping[str, str]:
+        response = domain_cache.get(self.domain_id)
+        if response:
+            return response
         try:
             response = self.client.describe_domain(
                 DomainId=self.domain_id
             )
         except ClientError as e:
+            self.raise_if_throttled(e)
             if e.response['Error']['Code'] == 'ValidationException':
                 logger.error(
                     f"Could not get domain {self.domain_id} metadata: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
             self.error = True
             return
+        domain_cache.put(self.domain_id, response)
         return response
 
     def get_user_metadata(self) -> Mapping:
@@ -65,6 +86,7 @@ class Profile:
                 UserProfileName=self.name
             )
         except ClientError as e:
+            self.raise_if_throttled(e)
             if e.response['Error']['Code'] == 'ValidationException':
                 logger.error(
                     f"Could not get UserProfile {self.name} metadata: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
@@ -82,6 +104,7 @@ class Profile:
                 SpaceName=self.space
             )
         except ClientError as e:
+            self.raise_if_throttled(e)
             if e.response['Error']['Code'] == 'ValidationException':
                 logger.error(
                     f"Could not get Space {self.space} metadata: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
@@ -107,6 +130,8 @@ def run_question(sm_client, args):
     efs_uid    : {profile.efs_uid}""")
 
 if __name__ == "__main__":
+    import argparse
+    import boto3
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "-domain-id",
@@ -0,0 +1,107 @@
+import os
+import string
+import time
+from threading import Lock
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel('ERROR')
+
+THROTTLE_CODES = ['ThrottlingException', 'Throttling', 'TooManyRequestsException', 'RequestLimitExceeded']
+
+class AdaptiveRateLimiter:
+    '''
+    Token bucket whose fill rate adapts with AIMD: successful calls grow the rate additively,
+    by about `increase` requests per second for every second of successes, up to max_rate;
+    a throttle multiplies it by `decrease` down to min_rate.
+    One instance is shared by every client and thread in the process.
+    '''
+    def __init__(self, rate: float = 10, min_rate: float = 1, max_rate: float = 40,
+                 increase: float = 2, decrease: float = 0.7, burst: float = None):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.max_burst = burst or max(1.0, rate)
+        self.burst = self.max_burst
+        self.tokens = self.burst
+        self.throttles = 0
+        self.successes = 0
+        self._last_refill = time.monotonic()
+        self._last_decrease = 0.0
+        self._lock = Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def on_success(self):
+        with self._lock:
+            self.successes += 1
+            self.rate = min(self.max_rate, self.rate + self.increase / max(self.rate, 1))
+            self.burst = max(1.0, min(self.max_burst, self.rate))
+
+    def on_throttle(self):
+        with self._lock:
+            self.throttles += 1
+            now = time.monotonic()
+            ## concurrent callers throttled by the same burst only back off once
+            if now - self._last_decrease < 1 / self.rate:
+                return
+            self._last_decrease = now
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.burst = max(1.0, min(self.burst, self.rate))
+            self.tokens = min(self.tokens, self.burst)
+            logger.warning(f"throttled. reduce request rate to {self.rate:.2f}/s")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"rate": self.rate, "throttles": self.throttles, "successes": self.successes}
+
+sagemaker_limiter = AdaptiveRateLimiter(
+    rate=float(os.getenv('SAGEMAKER_RATE', 10)),
+    min_rate=float(os.getenv('SAGEMAKER_MIN_RATE', 1)),
+    max_rate=float(os.getenv('SAGEMAKER_MAX_RATE', 40))
+)
+
+def is_limited(operation_name: string) -> bool:
+    return operation_name.startswith('Describe') or operation_name.startswith('List')
+
+def install(client, limiter: AdaptiveRateLimiter = sagemaker_limiter):
+    '''
+    Route every Describe*/List* attempt of client, retries included, through limiter.
+    Clients without botocore events (e.g. local stand-ins) are left alone.
+    '''
+    events = getattr(getattr(client, 'meta', None), 'events', None)
+    if events is None:
+        return client
+    service_id = client.meta.service_model.service_id.hyphenize()
+
+    def before_send(event_name, **kwargs):
+        if is_limited(event_name.rsplit('.', 1)[-1]):
+            limiter.acquire()
+
+    def needs_retry(operation, response=None, **kwargs):
+        if not is_limited(operation.name) or response is None:
+            return
+        http_response, parsed = response
+        if parsed.get('Error', {}).get('Code') in THROTTLE_CODES:
+            limiter.on_throttle()
+        elif http_response.status_code < 300:
+            limiter.on_success()
+
+    events.register(f'before-send.{service_id}.*', before_send, unique_id='ratelimit-before-send')
+    events.register(f'needs-retry.{service_id}.*', needs_retry, unique_id='ratelimit-needs-retry')
+    return client
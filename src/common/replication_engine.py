@@ -0,0 +1,356 @@
+import asyncio
+import copy
+import json
+import os
+import string
+from typing import Callable, Iterable, List, Mapping
+from botocore.exceptions import BotoCoreError, ClientError
+import logging
+from common import datasync_cache
+from common import users
+
+logger = logging.getLogger(__name__)
+logger.setLevel('ERROR')
+
+## the same knobs as the stepfunction.yaml parameters and states
+APP_READY_INITIAL_WAIT_SECONDS = int(os.getenv('APP_READY_INITIAL_WAIT_SECONDS', 5))
+APP_READY_MAX_WAIT_SECONDS = int(os.getenv('APP_READY_MAX_WAIT_SECONDS', 300))
+APP_READY_DEADLINE_SECONDS = int(os.getenv('APP_READY_DEADLINE_SECONDS', 7200))
+TASK_POLL_SECONDS = int(os.getenv('TASK_POLL_SECONDS', 30))
+## the Retry block of the DataSync create states: DataSync.DataSyncException, 10 s doubling, 100 attempts
+RETRY_CODES = ['DataSyncException', 'InternalException']
+RETRY_INTERVAL_SECONDS = 10
+RETRY_MAX_ATTEMPTS = 100
+FINAL_STATES = ['SUCCESS', 'ERROR']
+DEFAULT_MAX_CONCURRENCY = 10
+## replications in flight, waiting for their app included; keeps ListApps polling and threads bounded
+DEFAULT_MAX_REPLICATIONS = 50
+
+class ReplicationFailed(Exception):
+    def __init__(self, state: string, cause):
+        super().__init__(f"{state}: {cause}")
+        self.state = state
+        self.cause = cause
+
+class ReplicationEngine:
+    '''
+    The replication state machine of stepfunction.yaml as asyncio coroutines:
+    wait for the target app, create (or reuse) the two EFS locations and the task, start it, wait
+    for the task execution to finish and record the result in the users table.
+    Clients are plain boto3 clients (or stand-ins with the same methods); their blocking calls run on
+    the default thread pool. At most max_replications replications run at once, whatever number of
+    inputs run() is given, and at most max_concurrency DataSync transfers among them are in flight.
+    Shards count as transfers of the one replication they belong to.
+    '''
+    def __init__(self, sm_client, datasync_client, users_table=None, state=None, sqs_client=None,
+                 failure_queue_url: string = None, max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                 max_replications: int = DEFAULT_MAX_REPLICATIONS, sleep: Callable = asyncio.sleep):
+        self.sm_client = sm_client
+        self.datasync_client = datasync_client
+        ## a boto3 Table of the users table; the result is not recorded without it
+        self.users_table = users_table
+        ## a ReplicationState; the DataSync cache is neither read nor written without it
+        self.state = state
+        self.sqs_client = sqs_client
+        self.failure_queue_url = failure_queue_url
+        self.max_concurrency = max(1, int(max_concurrency or 1))
+        ## fewer replications than transfers would leave transfer slots unused
+        self.max_replications = max(self.max_concurrency, int(max_replications or 1))
+        ## injectable so fakes can run hours of waiting instantly
+        self.sleep = sleep
+        self.semaphore = None
+        self.replication_semaphore = None
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.replicating = 0
+        self.peak_replicating = 0
+
+    async def call(self, func: Callable, **kwargs) -> Mapping:
+        return await asyncio.to_thread(func, **kwargs)
+
+    async def call_with_retry(self, func: Callable, **kwargs) -> Mapping:
+        delay = RETRY_INTERVAL_SECONDS
+        for attempt in range(RETRY_MAX_ATTEMPTS + 1):
+            try:
+                return await self.call(func, **kwargs)
+            except ClientError as e:
+                if e.response['Error']['Code'] not in RETRY_CODES or attempt == RETRY_MAX_ATTEMPTS:
+                    raise
+                logger.warning(f"retry in {delay}s: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
+                await self.sleep(delay)
+                delay = min(delay * 2, APP_READY_MAX_WAIT_SECONDS)
+
+    async def list_apps(self, target: Mapping) -> List[Mapping]:
+        kwargs = {"DomainIdEquals": target['DomainID'], "MaxResults": 1}
+        if target.get('SpaceName'):
+            kwargs["SpaceNameEquals"] = target['SpaceName']
+        else:
+            kwargs["UserProfileNameEquals"] = target['UserProfileName']
+        response = await self.call(self.sm_client.list_apps, **kwargs)
+        return response.get('Apps', [])
+
+    async def wait_for_app(self, target: Mapping):
+        ## ListApps / AppNotReady / NextAppWait: doubling waits, capped, until the deadline
+        seconds, elapsed = APP_READY_INITIAL_WAIT_SECONDS, 0
+        while True:
+            apps = await self.list_apps(target)
+            if apps and apps[0].get('Status') == 'InService':
+                return
+            if elapsed >= APP_READY_DEADLINE_SECONDS:
+                raise ReplicationFailed('AppReadyDeadline', 'the target app was not InService before APP_READY_DEADLINE_SECONDS')
+            await self.sleep(seconds)
+            elapsed += seconds
+            seconds = min(seconds * 2, APP_READY_MAX_WAIT_SECONDS)
+
+    def remember(self, key: string, arn: string):
+        ## the Cache* states: a failed cache write does not fail the replication
+        if self.state is None:
+            return
+        try:
+            self.state.put(key, {"arn": arn})
+        except ClientError:
+            pass
+
+    def forget(self, key: string):
+        if self.state is None:
+            return
+        try:
+            self.state.release(key)
+        except ClientError:
+            pass
+
+    async def location(self, endpoint: Mapping, cached_arn: string, cache_key: string) -> string:
+        if cached_arn:
+            return cached_arn
+        response = await self.call_with_retry(
+            self.datasync_client.create_location_efs,
+            Ec2Config={"SecurityGroupArns": endpoint['SecurityGroupArns'], "SubnetArn": endpoint['SubnetArn']},
+            EfsFilesystemArn=endpoint['EfsFilesystemArn'],
+            Subdirectory=endpoint['HomeEfsFileSystemUid']
+        )
+        await asyncio.to_thread(self.remember, cache_key, response['LocationArn'])
+        return response['LocationArn']
+
+    async def task(self, input: Mapping, cache: Mapping) -> string:
+        if cache.get('TaskArn'):
+            return cache['TaskArn']
+        source_arn, target_arn = await asyncio.gather(
+            self.location(input['Source'], cache.get('SourceLocationArn'), cache['SourceLocationKey']),
+            self.location(input['Target'], cache.get('TargetLocationArn'), cache['TargetLocationKey'])
+        )
+        response = await self.call_with_retry(
+            self.datasync_client.create_task,
+            CloudWatchLogGroupArn=input['Log']['CloudWatchLogGroupArn'],
+            DestinationLocationArn=target_arn,
+            SourceLocationArn=source_arn,
+            Options=input['Options'],
+            **({"Includes": [{"FilterType": 'SIMPLE_PATTERN', "Value": input['Includes']}]} if input.get('Includes') else {})
+        )
+        await asyncio.to_thread(self.remember, cache['TaskKey'], response['TaskArn'])
+        return response['TaskArn']
+
+    async def start_task(self, input: Mapping, cache: Mapping) -> string:
+        task_arn = await self.task(input, cache)
+        try:
+            response = await self.call(self.datasync_client.start_task_execution, TaskArn=task_arn, OverrideOptions=input['Options'])
+        except ClientError as e:
+            ## CachedTaskGone / InvalidateCachedTask / ForgetCachedArns
+            if e.response['Error']['Code'] != 'InvalidRequestException' or not cache.get('TaskArn'):
+                raise
+            logger.warning(f"cached task {task_arn} is gone. create the task again")
+            await asyncio.to_thread(self.forget, cache['TaskKey'])
+            cache = {k: cache[k] for k in ['SourceLocationKey', 'TargetLocationKey', 'TaskKey']}
+            task_arn = await self.task(input, cache)
+            response = await self.call(self.datasync_client.start_task_execution, TaskArn=task_arn, OverrideOptions=input['Options'])
+        return response['TaskExecutionArn']
+
+    async def wait_for_task(self, execution_arn: string) -> Mapping:
+        ## Wait-TaskEnd / DescribeTaskExecution / Is_running
+        while True:
+            result = await self.call(self.datasync_client.describe_task_execution, TaskExecutionArn=execution_arn)
+            if result.get('Status') in FINAL_STATES:
+                result.pop('ResponseMetadata', None)
+                return result
+            await self.sleep(TASK_POLL_SECONDS)
+
+    async def record(self, target: Mapping, result: Mapping):
+        ## DynamoDB UpdateItem
+        if self.users_table is None:
+            return
+        await self.call(
+            self.users_table.update_item,
+            Key={
+                users.HASHKEY: target.get('UserProfileName') or target.get('SpaceName'),
+                users.RANGEKEY: target['DomainName']
+            },
+            UpdateExpression="set bytes_written =:b, files_transferred =:f, total_duration_ms =:t, replication_status =:rs",
+            ExpressionAttributeValues={
+                ":b": str(result.get('BytesWritten')),
+                ":f": str(result.get('FilesTransferred')),
+                ":t": str(result.get('Result', {}).get('TotalDuration')),
+                ":rs": str(result.get('Result', {}).get('TransferStatus'))
+            }
+        )
+
+    async def report_failure(self, input: Mapping):
+        ## SQS SendMessage: the whole state, as the state machine sends it
+        if self.sqs_client is None or not self.failure_queue_url:
+            return
+        try:
+            await self.call(self.sqs_client.send_message, QueueUrl=self.failure_queue_url, MessageBody=json.dumps(input, default=str))
+        except ClientError as e:
+            logger.error(
+                f"Could not report failed replication: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
+
+    async def transfer(self, input: Mapping) -> Mapping:
+        ## TaskCached .. Is_running under the global cap; returns the final DescribeTaskExecution result
+        async with self.limit():
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            try:
+                cache = input.get('Cache') or await asyncio.to_thread(datasync_cache.lookup, input, self.state)
+                execution_arn = await self.start_task(input, cache)
+                input['Task'] = {"TaskExecutionArn": execution_arn}
+                return await self.wait_for_task(execution_arn)
+            finally:
+                self.in_flight -= 1
+
+    async def replicate_one(self, input: Mapping, wait_app: bool = True, record: bool = True) -> Mapping:
+        stage = 'ListApps'
+        try:
+            if wait_app:
+                await self.wait_for_app(input['Target'])
+            stage = 'StartTaskExecution'
+            input['Result'] = await self.transfer(input)
+            if input['Result'].get('Status') == 'ERROR':
+                raise ReplicationFailed('Result', input['Result'].get('Result', {}).get('ErrorDetail', 'task execution failed'))
+            stage = 'DynamoDB UpdateItem'
+            if record:
+                await self.record(input['Target'], input['Result'])
+        except ReplicationFailed as e:
+            input['Error'] = {"State": e.state, "Cause": str(e.cause)}
+        except (ClientError, BotoCoreError, KeyError) as e:
+            ## BotoCoreError: connection and read timeouts, parameter validation
+            input['Error'] = {"State": stage, "Cause": str(e)}
+        if 'Error' in input:
+            logger.error(f"replication to {input['Target'].get('DomainName')} failed in {input['Error']['State']}: {input['Error']['Cause']}")
+            await self.report_failure(input)
+            return {"Status": "FAILED", "Input": input, "Error": input['Error']}
+        return {"Status": "SUCCEEDED", "Input": input, "Result": input['Result']}
+
+    async def replicate_shards(self, input: Mapping) -> Mapping:
+        '''
+        Every shard is its own DataSync task, restricted to its top-level entries by an include
+        filter. The app is waited for once and the shards run concurrently under the global cap.
+        Entries created after planning and empty directories match no filter, so once all shards
+        succeeded an unfiltered pass copies whatever they left; only then the users table gets the totals.
+        '''
+        stage = 'ListApps'
+        try:
+            await self.wait_for_app(input['Target'])
+            ## the shards share both locations; create them once instead of racing for them
+            stage = 'CreateLocationEfs'
+            cache = await asyncio.to_thread(datasync_cache.lookup, input, self.state)
+            source_arn, target_arn = await asyncio.gather(
+                self.location(input['Source'], cache.get('SourceLocationArn'), cache['SourceLocationKey']),
+                self.location(input['Target'], cache.get('TargetLocationArn'), cache['TargetLocationKey'])
+            )
+            stage = 'Shards'
+            shard_inputs = []
+            for index, shard in enumerate(input['Shards']):
+                shard_input = {k: v for k, v in copy.deepcopy(input).items() if k not in ['Shards', 'Cache']}
+                shard_input['Includes'] = shard['Includes']
+                shard_input['Shard'] = {"Index": index, "Count": len(input['Shards'])}
+                shard_cache = await asyncio.to_thread(datasync_cache.lookup, shard_input, self.state)
+                shard_input['Cache'] = dict(shard_cache, SourceLocationArn=source_arn, TargetLocationArn=target_arn)
+                shard_inputs.append(shard_input)
+            stage = 'CatchAll'
+            final_input = await self.catch_all_input(input, source_arn, target_arn)
+        except (ReplicationFailed, ClientError, BotoCoreError, KeyError) as e:
+            input['Error'] = {"State": getattr(e, 'state', stage), "Cause": str(getattr(e, 'cause', e))}
+            await self.report_failure(input)
+            return {"Status": "FAILED", "Input": input, "Error": input['Error']}
+        results = await asyncio.gather(*[self.replicate_one(i, wait_app=False, record=False) for i in shard_inputs])
+        failed = [r for r in results if r['Status'] == 'FAILED']
+        if failed:
+            input['Error'] = {"State": 'Shards', "Cause": f"{len(failed)} of {len(results)} shards failed"}
+            return {"Status": "FAILED", "Input": input, "Error": input['Error'], "Shards": results}
+        catch_all = await self.replicate_one(final_input, wait_app=False, record=False)
+        if catch_all['Status'] == 'FAILED':
+            input['Error'] = {"State": 'CatchAll', "Cause": catch_all['Error']['Cause']}
+            return {"Status": "FAILED", "Input": input, "Error": input['Error'], "Shards": results, "CatchAll": catch_all}
+        passes = results + [catch_all]
+        input['Result'] = {
+            "Status": 'SUCCESS',
+            "BytesWritten": sum(r['Result'].get('BytesWritten', 0) for r in passes),
+            "FilesTransferred": sum(r['Result'].get('FilesTransferred', 0) for r in passes),
+            "Result": {
+                "TotalDuration": max(r['Result'].get('Result', {}).get('TotalDuration', 0) for r in results)
+                + catch_all['Result'].get('Result', {}).get('TotalDuration', 0),
+                "TransferStatus": 'SUCCESS'
+            },
+            "TaskExecutionArns": [r['Result'].get('TaskExecutionArn') for r in passes]
+        }
+        try:
+            await self.record(input['Target'], input['Result'])
+        except (ClientError, BotoCoreError) as e:
+            input['Error'] = {"State": 'DynamoDB UpdateItem', "Cause": str(e)}
+            await self.report_failure(input)
+            return {"Status": "FAILED", "Input": input, "Error": input['Error'], "Shards": results, "CatchAll": catch_all}
+        return {"Status": "SUCCEEDED", "Input": input, "Result": input['Result'], "Shards": results, "CatchAll": catch_all}
+
+    async def catch_all_input(self, input: Mapping, source_arn: string, target_arn: string) -> Mapping:
+        ## the unsharded task of the home; CHANGED, so it only moves what the shards did not
+        final = {k: v for k, v in copy.deepcopy(input).items() if k not in ['Shards', 'Cache']}
+        final['Options'] = dict(final['Options'], TransferMode='CHANGED')
+        final['Shard'] = {"Index": len(input['Shards']), "Count": len(input['Shards']), "CatchAll": True}
+        cache = await asyncio.to_thread(datasync_cache.lookup, final, self.state)
+        final['Cache'] = dict(cache, SourceLocationArn=source_arn, TargetLocationArn=target_arn)
+        return final
+
+    async def replicate(self, input: Mapping) -> Mapping:
+        '''
+        One execution of the state machine for input, the document ddb-stream-processor starts it with,
+        optionally with the "Shards" of plan-shards.py.
+        Returns {"Status": "SUCCEEDED" | "FAILED", "Input": input, "Result" | "Error": ...}.
+        '''
+        input = copy.deepcopy(input)
+        async with self.replication_limit():
+            self.replicating += 1
+            self.peak_replicating = max(self.peak_replicating, self.replicating)
+            try:
+                if input.get('Shards'):
+                    return await self.replicate_shards(input)
+                return await self.replicate_one(input)
+            except Exception as e:
+                ## whatever the states did not expect fails this replication only, not the whole run
+                logger.exception(f"replication to {input['Target'].get('DomainName')} failed unexpectedly")
+                input['Error'] = {"State": 'Engine', "Cause": f"{type(e).__name__}: {e}"}
+                await self.report_failure(input)
+                return {"Status": "FAILED", "Input": input, "Error": input['Error']}
+            finally:
+                self.replicating -= 1
+
+    def limit(self) -> asyncio.Semaphore:
+        ## created on first use, inside the running event loop
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self.semaphore
+
+    def replication_limit(self) -> asyncio.Semaphore:
+        ## a separate semaphore, so the shards of a replication never wait on the slot it holds
+        if self.replication_semaphore is None:
+            self.replication_semaphore = asyncio.Semaphore(self.max_replications)
+        return self.replication_semaphore
+
+    async def run(self, inputs: Iterable[Mapping]) -> List[Mapping]:
+        ## results in input order. a replication holds one of the max_replications slots from its first
+        ## app check to its result, a transfer one of the max_concurrency slots on top
+        self.semaphore = None
+        self.replication_semaphore = None
+        return await asyncio.gather(*[self.replicate(input) for input in inputs])
+
+def run(inputs: Iterable[Mapping], **kwargs) -> List[Mapping]:
+    ## synchronous entry point for scripts
+    engine = ReplicationEngine(**kwargs)
+    return asyncio.run(engine.run(inputs))
@@ -0,0 +1,114 @@
+import string
+import time
+from typing import List, Mapping, Tuple
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel('ERROR')
+
+KEY = 'pk'
+TTL_ATTRIBUTE = 'expires_at'
+
+class ReplicationState:
+    '''
+    Short-lived coordination records for the replication pipeline, one item per `pk`.
+    Items carry an epoch-seconds `expires_at` that DynamoDB TTL uses to delete them; since TTL
+    deletion is lazy, expired items are also treated as absent here.
+    '''
+    def __init__(self, ddb_resource, table_name):
+        self.ddb_resource = ddb_resource
+        self.table = self.ddb_resource.Table(table_name)
+
+    def check_table(self, e: ClientError):
+        if e.response['Error']['Code'] == 'ResourceNotFoundException':
+            logger.error(
+                f"Table {self.table.name} not found: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
+
+    def claim(self, key: string, attributes: Mapping, ttl_seconds: int) -> Tuple[bool, Mapping]:
+        '''
+        Create the record for key unless an unexpired one exists.
+        Returns (True, item written) for the first caller and (False, existing item) for every other.
+        '''
+        now = int(time.time())
+        item = dict(attributes)
+        item[KEY] = key
+        item[TTL_ATTRIBUTE] = now + ttl_seconds
+        try:
+            self.table.put_item(
+                Item=item,
+                ConditionExpression=Attr(KEY).not_exists() | Attr(TTL_ATTRIBUTE).lt(now)
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                ## ReturnValuesOnConditionCheckFailure is newer than the boto3 of the Lambda layer (deploy.sh).
+                ## read the winner back; {} when it was released in between
+                return False, self.read(key)
+            self.check_table(e)
+            logger.error(
+                f"Could not claim {key}: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
+            raise
+        return True, item
+
+    def read(self, key: string) -> Mapping:
+        try:
+            return self.table.get_item(Key={KEY: key}, ConsistentRead=True).get('Item') or {}
+        except ClientError as e:
+            self.check_table(e)
+            logger.error(
+                f"Could not read {key}: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
+            raise
+
+    def put(self, key: string, attributes: Mapping):
+        ## unconditional write without expiry, like the state machine's cache entries
+        item = dict(attributes)
+        item[KEY] = key
+        try:
+            self.table.put_item(Item=item)
+        except ClientError as e:
+            self.check_table(e)
+            logger.error(
+                f"Could not put {key}: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
+            raise
+
+    def release(self, key: string):
+        try:
+            self.table.delete_item(Key={KEY: key})
+        except ClientError as e:
+            self.check_table(e)
+            logger.error(
+                f"Could not release {key}: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
+            raise
+
+    def get(self, key: string) -> Mapping:
+        ## the unexpired record for key, or None
+        try:
+            item = self.table.get_item(Key={KEY: key}).get('Item')
+        except ClientError as e:
+            self.check_table(e)
+            logger.error(
+                f"Could not get {key}: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
+            raise
+        if item is None or item.get(TTL_ATTRIBUTE, time.time() + 1) <= time.time():
+            return None
+        return item
+
+    def get_many(self, keys: List[string]) -> Mapping[str, Mapping]:
+        ## one BatchGetItem for up to 100 keys; expired and missing records are left out
+        if not keys:
+            return {}
+        now = int(time.time())
+        request = {self.table.name: {"Keys": [{KEY: key} for key in dict.fromkeys(keys)]}}
+        items = []
+        try:
+            while request:
+                response = self.ddb_resource.batch_get_item(RequestItems=request)
+                items.extend(response.get('Responses', {}).get(self.table.name, []))
+                request = response.get('UnprocessedKeys') or None
+        except ClientError as e:
+            self.check_table(e)
+            logger.error(
+                f"Could not get {keys}: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
+            raise
+        return {item[KEY]: item for item in items if item.get(TTL_ATTRIBUTE, now + 1) > now}
@@ -0,0 +1,112 @@
+import heapq
+import os
+import string
+from typing import Iterable, List, Mapping
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel('ERROR')
+
+## cost model of one DataSync task: a throughput term and a per-file term, which dominates for
+## homes with millions of small files
+BYTES_PER_SECOND = int(os.getenv('SHARD_BYTES_PER_SECOND', 100 * 1024 * 1024))
+SECONDS_PER_FILE = float(os.getenv('SHARD_SECONDS_PER_FILE', 0.002))
+## a DataSync filter value is at most 102400 characters
+FILTER_MAX_LENGTH = 102400
+
+def read_manifest(lines: Iterable[str]) -> Mapping[str, Mapping]:
+    '''
+    Sizes per top-level entry of a home directory from a file listing with one "<bytes>\\t<path>" per
+    file, paths relative to the home, e.g. `find . -type f -printf '%s\\t%P\\n'`.
+    Returns {top-level name: {"Bytes": ..., "Files": ...}}.
+    '''
+    subtrees = {}
+    for line in lines:
+        line = line.rstrip('\n')
+        if not line.strip() or line.startswith('#'):
+            continue
+        size, path = line.split('\t', 1)
+        if path.startswith('./'):
+            path = path[2:]
+        name = path.strip('/').split('/', 1)[0]
+        if not name:
+            continue
+        entry = subtrees.setdefault(name, {"Bytes": 0, "Files": 0})
+        entry["Bytes"] += int(size)
+        entry["Files"] += 1
+    return subtrees
+
+def scan(root: string) -> Mapping[str, Mapping]:
+    ## the same sizes, read from a mounted home directory
+    subtrees = {}
+    for top in os.scandir(root):
+        entry = subtrees.setdefault(top.name, {"Bytes": 0, "Files": 0})
+        if top.is_file(follow_symlinks=False):
+            entry["Bytes"] += top.stat(follow_symlinks=False).st_size
+            entry["Files"] += 1
+            continue
+        for path, _, files in os.walk(top.path):
+            for f in files:
+                entry["Bytes"] += os.lstat(os.path.join(path, f)).st_size
+                entry["Files"] += 1
+    return subtrees
+
+def seconds(entry: Mapping, bytes_per_second: int = BYTES_PER_SECOND, seconds_per_file: float = SECONDS_PER_FILE) -> float:
+    return entry["Bytes"] / bytes_per_second + entry["Files"] * seconds_per_file
+
+def plan(subtrees: Mapping[str, Mapping], shards: int, **cost) -> List[Mapping]:
+    '''
+    Split the top-level subtrees into at most `shards` groups of about equal expected duration:
+    longest subtree first onto the least loaded shard, which is within 4/3 of the best split.
+    Returns [{"Paths": [...], "Bytes": ..., "Files": ..., "Seconds": ...}], longest shard first.
+    '''
+    shards = max(1, min(int(shards), len(subtrees) or 1))
+    groups = [{"Paths": [], "Bytes": 0, "Files": 0, "Seconds": 0.0} for _ in range(shards)]
+    heap = [(0.0, i) for i in range(shards)]
+    for name in sorted(subtrees, key=lambda n: (-seconds(subtrees[n], **cost), n)):
+        load, i = heapq.heappop(heap)
+        group = groups[i]
+        group["Paths"].append(name)
+        group["Bytes"] += subtrees[name]["Bytes"]
+        group["Files"] += subtrees[name]["Files"]
+        group["Seconds"] = load + seconds(subtrees[name], **cost)
+        heapq.heappush(heap, (group["Seconds"], i))
+    return sorted([g for g in groups if g["Paths"]], key=lambda g: -g["Seconds"])
+
+def makespan(shards: List[Mapping]) -> float:
+    ## shards run concurrently, so the plan takes as long as its longest shard
+    return max([s["Seconds"] for s in shards] or [0.0])
+
+def lower_bound(subtrees: Mapping[str, Mapping], shards: int, **cost) -> float:
+    ## no split of top-level subtrees beats the largest subtree or an even share of the total
+    durations = [seconds(e, **cost) for e in subtrees.values()]
+    return max(max(durations or [0.0]), sum(durations) / max(1, shards))
+
+def include_filter(paths: List[str]) -> string:
+    '''
+    The SIMPLE_PATTERN value selecting the given top-level entries, relative to the task's
+    source location. Entries that are in no shard's filter are copied by the engine's unfiltered
+    catch-all pass.
+    '''
+    for path in paths:
+        if '|' in path or '*' in path:
+            raise ValueError(f"{path} can not be expressed in a DataSync filter")
+    value = '|'.join(f"/{path}" for path in sorted(paths))
+    if len(value) > FILTER_MAX_LENGTH:
+        raise ValueError(f"filter for {len(paths)} entries exceeds {FILTER_MAX_LENGTH} characters. plan fewer entries per shard")
+    return value
+
+def report(subtrees: Mapping[str, Mapping], max_shards: int, **cost) -> List[Mapping]:
+    ## expected makespan of every shard count up to max_shards
+    single = makespan(plan(subtrees, 1, **cost))
+    rows = []
+    for count in range(1, max_shards + 1):
+        shards = plan(subtrees, count, **cost)
+        span = makespan(shards)
+        rows.append({
+            "Shards": len(shards),
+            "Makespan": span,
+            "LowerBound": lower_bound(subtrees, count, **cost),
+            "Speedup": single / span if span else 1.0
+        })
+    return rows
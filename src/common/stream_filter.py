@@ -0,0 +1,119 @@
+import json
+import string
+from typing import Iterable, List, Mapping, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel('ERROR')
+
+## rules a studioUser stream record must pass before ddb-stream-processor starts a replication. each rule is one of
+##   equals:    the value at path equals the given value
+##   non_empty: the string at path exists and is not empty
+##   any:       at least one of the nested rules passes
+##   changed:   at least one of the attributes differs between OldImage and NewImage
+## equals/non_empty/any compile to Lambda event filter patterns. changed compares two fields,
+## which filter patterns cannot express, so it is only evaluated in the handler.
+RULES = [
+    {"name": "modify-event", "equals": "MODIFY", "path": ["eventName"]},
+    {"name": "replication-enabled", "equals": True, "path": ["dynamodb", "OldImage", "replication", "BOOL"]},
+    {"name": "profile-or-space", "any": [
+        {"non_empty": True, "path": ["dynamodb", "NewImage", "user_profile_name", "S"]},
+        {"non_empty": True, "path": ["dynamodb", "NewImage", "space_name", "S"]}
+    ]},
+    {"name": "efs-home-changed", "changed": ["efs_sys_id", "efs_uid"]}
+]
+
+def lookup(record: Mapping, path: List[str]):
+    value = record
+    for key in path:
+        if not isinstance(value, Mapping) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+def passes(rule: Mapping, record: Mapping) -> bool:
+    if "any" in rule:
+        return any(passes(r, record) for r in rule["any"])
+    if "changed" in rule:
+        old = lookup(record, ["dynamodb", "OldImage"]) or {}
+        new = lookup(record, ["dynamodb", "NewImage"]) or {}
+        return any(old.get(name) != new.get(name) for name in rule["changed"])
+    value = lookup(record, rule["path"])
+    if "equals" in rule:
+        return value == rule["equals"]
+    return isinstance(value, str) and value != ""
+
+def should_process(record: Mapping, rules: List[Mapping] = RULES) -> Tuple[bool, string]:
+    ## (True, None) or (False, name of the first rule the record fails)
+    for rule in rules:
+        if not passes(rule, record):
+            return False, rule["name"]
+    return True, None
+
+def is_compilable(rule: Mapping) -> bool:
+    if "any" in rule:
+        return all(is_compilable(r) for r in rule["any"])
+    return "path" in rule
+
+def nest(path: List[str], leaf) -> Mapping:
+    pattern = leaf
+    for key in reversed(path):
+        pattern = {key: pattern}
+    return pattern
+
+def merge(left: Mapping, right: Mapping) -> Mapping:
+    merged = dict(left)
+    for key, value in right.items():
+        if key in merged and isinstance(merged[key], Mapping) and isinstance(value, Mapping):
+            merged[key] = merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+def alternatives(rule: Mapping) -> List[Mapping]:
+    ## one pattern fragment per way the rule can pass
+    if "any" in rule:
+        return [fragment for r in rule["any"] for fragment in alternatives(r)]
+    if "equals" in rule:
+        return [nest(rule["path"], [rule["equals"]])]
+    return [nest(rule["path"], [{"anything-but": [""]}])]
+
+def compile_patterns(rules: List[Mapping] = RULES) -> List[Mapping]:
+    '''
+    Filter patterns equivalent to the compilable rules. Fields within a pattern are ANDed and
+    the filters of an event source mapping are ORed, so every `any` multiplies the patterns.
+    '''
+    patterns = [{}]
+    for rule in rules:
+        if not is_compilable(rule):
+            continue
+        patterns = [merge(pattern, fragment) for pattern in patterns for fragment in alternatives(rule)]
+    return patterns
+
+def filter_criteria(rules: List[Mapping] = RULES) -> Mapping:
+    ## the FilterCriteria property of AWS::Lambda::EventSourceMapping
+    return {"Filters": [{"Pattern": json.dumps(pattern)} for pattern in compile_patterns(rules)]}
+
+def pattern_matches(pattern: Mapping, record: Mapping) -> bool:
+    ## the subset of Lambda event filtering used by compile_patterns: value lists and anything-but
+    for key, expected in pattern.items():
+        if not isinstance(record, Mapping) or key not in record:
+            return False
+        value = record[key]
+        if isinstance(expected, Mapping):
+            if not pattern_matches(expected, value):
+                return False
+            continue
+        matched = False
+        for option in expected:
+            if isinstance(option, Mapping) and "anything-but" in option:
+                matched = matched or value not in option["anything-but"]
+            else:
+                matched = matched or value == option
+        if not matched:
+            return False
+    return True
+
+def filter_matches(record: Mapping, patterns: Iterable[Mapping] = None) -> bool:
+    ## local stand-in for the event source mapping: would this record start an invocation?
+    return any(pattern_matches(pattern, record) for pattern in (patterns or compile_patterns()))
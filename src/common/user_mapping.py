@@ -0,0 +1,158 @@
+import string
+import uuid
+from threading import Lock
+from typing import List, Mapping, Tuple
+from boto3.dynamodb.types import TypeSerializer
+from botocore.exceptions import ClientError, ParamValidationError
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel('ERROR')
+
+serializer = TypeSerializer()
+
+## TransactWriteItems limit; every entry takes two actions, its Update and its history Put
+TRANSACT_MAX_ITEMS = 100
+TRANSACT_MAX_ENTRIES = TRANSACT_MAX_ITEMS // 2
+
+def idempotency_token(*parts) -> string:
+    ## deterministic 36 character ClientRequestToken for the same logical write
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, '/'.join(str(p) for p in parts)))
+
+class UserMapping:
+    '''
+    Writes the current studioUser row and appends the matching history row
+    in a single TransactWriteItems call, so the two tables cannot disagree.
+    Writes that would not change the current row are rejected by a condition
+    expression and counted in `skipped`; no history row is appended for them.
+    write_many packs several profiles into one transaction.
+    '''
+    def __init__(self, users, users_hist):
+        self.users = users
+        self.users_hist = users_hist
+        self.client = users.table.meta.client
+        self.written = 0
+        self.skipped = 0
+        self._lock = Lock()
+
+    def update_expression(self, attributes: Mapping):
+        names = {f"#a{i}": name for i, name in enumerate(attributes)}
+        values = {f":v{i}": serializer.serialize(value) for i, value in enumerate(attributes.values())}
+        expression = "set " + ", ".join(f"#a{i} = :v{i}" for i in range(len(attributes)))
+        return expression, names, values
+
+    def changed_condition(self, attributes: Mapping) -> string:
+        ## true when the row is missing or at least one attribute differs; uses update_expression's placeholders
+        return " OR ".join(f"attribute_not_exists(#a{i}) OR #a{i} <> :v{i}" for i in range(len(attributes)))
+
+    def is_unchanged(self, e: ClientError) -> bool:
+        return self.unchanged_entries(e) == [0]
+
+    def unchanged_entries(self, e: ClientError) -> List[int]:
+        '''
+        Positions of the entries whose Update condition failed in a cancelled transaction, or []
+        when anything else took part in the cancellation.
+        '''
+        if e.response['Error']['Code'] != 'TransactionCanceledException':
+            return []
+        reasons = e.response.get('CancellationReasons') or []
+        if any(r.get('Code') not in ('None', 'ConditionalCheckFailed') for r in reasons):
+            return []
+        return [n // 2 for n, r in enumerate(reasons) if n % 2 == 0 and r.get('Code') == 'ConditionalCheckFailed']
+
+    def count(self, written: bool):
+        with self._lock:
+            if written:
+                self.written += 1
+            else:
+                self.skipped += 1
+
+    def transact_items(self, key: Mapping, attributes: Mapping, history_item: Mapping, skip_unchanged: bool) -> List[Mapping]:
+        expression, names, values = self.update_expression(attributes)
+        update = {
+            "TableName": self.users.table.name,
+            "Key": {k: serializer.serialize(v) for k, v in key.items()},
+            "UpdateExpression": expression,
+            "ExpressionAttributeNames": names,
+            "ExpressionAttributeValues": values
+        }
+        if skip_unchanged:
+            update["ConditionExpression"] = self.changed_condition(attributes)
+        return [
+            {"Update": update},
+            {
+                "Put": {
+                    "TableName": self.users_hist.table.name,
+                    "Item": {k: serializer.serialize(v) for k, v in history_item.items()}
+                }
+            }
+        ]
+
+    def write(self, key: Mapping, attributes: Mapping, history_item: Mapping, token: string = None,
+              skip_unchanged: bool = True) -> Mapping:
+        '''
+        Set attributes on the row at key and put history_item, atomically.
+        Returns None without writing anything when skip_unchanged and the row already holds attributes.
+        A retry with the same token and the same arguments within 10 minutes is a no-op,
+        so history_item must be rebuilt identically (including its range key) when retrying.
+        '''
+        request = {"TransactItems": self.transact_items(key, attributes, history_item, skip_unchanged)}
+        if token:
+            request["ClientRequestToken"] = token
+        try:
+            response = self.client.transact_write_items(**request)
+        except ParamValidationError as e:
+            logger.error(
+                f"Could not write user mapping because wrong parameters provided: key={key}, attributes={attributes}, history_item={history_item}")
+            raise
+        except ClientError as e:
+            if skip_unchanged and self.is_unchanged(e):
+                self.count(written=False)
+                return None
+            logger.error(
+                f"Could not write user mapping {key}: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
+            raise
+        self.count(written=True)
+        return response
+
+    def write_many(self, entries: List[Tuple[Mapping, Mapping, Mapping]], token: string = None,
+                   skip_unchanged: bool = True) -> List[bool]:
+        '''
+        write for up to TRANSACT_MAX_ENTRIES (key, attributes, history_item) entries in one transaction.
+        An unchanged row cancels the whole transaction, so those entries are dropped and the rest is
+        sent again. Returns whether each entry was written; any other failure raises for all of them.
+        '''
+        if len(entries) > TRANSACT_MAX_ENTRIES:
+            raise ValueError(f"at most {TRANSACT_MAX_ENTRIES} entries per transaction, got {len(entries)}")
+        written = [False] * len(entries)
+        pending = list(range(len(entries)))
+        while pending:
+            request = {"TransactItems": [item for i in pending for item in self.transact_items(*entries[i], skip_unchanged)]}
+            if token:
+                ## a resend carries fewer entries, which needs a token of its own
+                request["ClientRequestToken"] = idempotency_token(token, *pending)
+            try:
+                self.client.transact_write_items(**request)
+            except ParamValidationError as e:
+                logger.error(
+                    f"Could not write user mappings because wrong parameters provided: {[entries[i] for i in pending]}")
+                raise
+            except ClientError as e:
+                unchanged = self.unchanged_entries(e) if skip_unchanged else []
+                if not unchanged:
+                    logger.error(
+                        f"Could not write {len(pending)} user mappings: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
+                    raise
+                for _ in unchanged:
+                    self.count(written=False)
+                pending = [i for n, i in enumerate(pending) if n not in unchanged]
+                continue
+            for i in pending:
+                written[i] = True
+                self.count(written=True)
+            pending = []
+        return written
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"written": self.written, "skipped": self.skipped}
@@ -1,27 +1,38 @@
-import json
+import os
 import string
-import boto3
-from typing import Mapping
+import time
+from typing import Iterable, Iterator, List, Mapping, Tuple
+from boto3.dynamodb.conditions import Attr
 from botocore.exceptions import ClientError, ParamValidationError
 import logging
-import argparse
 
 logger = logging.getLogger(__name__)
 logger.setLevel('ERROR')
 
+HASHKEY = os.getenv('HASHKEY', 'profile_name')
+RANGEKEY = os.getenv('RANGEKEY', 'domain_name')
+BATCH_GET_SIZE = 100
+
 class Users:
-    def __init__(self, ddb_resource, table_name):
+    def __init__(self, ddb_resource, table_name, validate=True):
         self.ddb_resource = ddb_resource
         self.table = None
         try:
             table = self.ddb_resource.Table(table_name)
-            table.load()
+            ## validate=False skips the DescribeTable round trip; a missing table surfaces on the first call instead
+            if validate:
+                table.load()
             self.table = table
         except ClientError as e:
             logger.error(
                 f"Table {table_name} not found: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
             raise
 
+    def check_table(self, e: ClientError):
+        if e.response['Error']['Code'] == 'ResourceNotFoundException':
+            logger.error(
+                f"Table {self.table.name} not found: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
+
     def update_user(self, key: Mapping, expression: string, attributes: Mapping,ret_val: string) -> Mapping:
         try:
             response = self.table.update_item(
@@ -35,6 +46,7 @@ class Users:
                 f"Could not update table because wrong parameters provided: key={key}, expression={expression}, attributes={attributes}")
             raise
         except ClientError as e:
+            self.check_table(e)
             logger.error(
                 f"Could not update table: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
             raise
@@ -46,6 +58,7 @@ class Users:
                 Key=key
             )
         except ClientError as e:
+            self.check_table(e)
             logger.error(
                 f"Could not get user: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
             raise
@@ -53,6 +66,91 @@ class Users:
             return response['Item']
         return {}
 
+    def set_replication(self, key: Mapping, replication: bool) -> Tuple[Mapping, bool]:
+        '''
+        Set only the replication flag of an existing row with one conditional update.
+        Returns the row after the call and whether it changed; ({}, False) when no row exists for key
+        (the row is never created). A row that already holds the flag is not written, only read back.
+        '''
+        try:
+            response = self.table.update_item(
+                Key=key,
+                UpdateExpression="set replication = :rp",
+                ConditionExpression=Attr(HASHKEY).exists() & (Attr('replication').not_exists() | Attr('replication').ne(replication)),
+                ExpressionAttributeValues={":rp": replication},
+                ReturnValues='ALL_NEW'
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                ## the row is missing or already holds the flag; the boto3 of the Lambda layer (deploy.sh)
+                ## has no ReturnValuesOnConditionCheckFailure, so tell the two apart with a read
+                return self.get_user(key), False
+            self.check_table(e)
+            logger.error(
+                f"Could not update table: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
+            raise
+        return response['Attributes'], True
+
+    def scan_users(self, domain_name: string = None, keys_only: bool = False) -> Iterator[Mapping]:
+        ## the table is keyed by profile first, so selecting a whole domain is a filtered, paginated scan
+        kwargs = {}
+        if keys_only:
+            kwargs["ProjectionExpression"] = "#h, #r"
+            kwargs["ExpressionAttributeNames"] = {"#h": HASHKEY, "#r": RANGEKEY}
+        if domain_name:
+            kwargs["FilterExpression"] = Attr(RANGEKEY).eq(domain_name)
+        while True:
+            try:
+                response = self.table.scan(**kwargs)
+            except ClientError as e:
+                self.check_table(e)
+                logger.error(
+                    f"Could not scan table: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
+                raise
+            yield from response.get('Items', [])
+            if 'LastEvaluatedKey' not in response:
+                return
+            kwargs["ExclusiveStartKey"] = response['LastEvaluatedKey']
+
+    def batch_get_users(self, keys: List[Mapping]) -> List[Mapping]:
+        '''
+        Read many rows with BatchGetItem, 100 keys per call, resending unprocessed keys
+        with exponential backoff. Keys without a row are simply absent from the result.
+        '''
+        items = []
+        for i in range(0, len(keys), BATCH_GET_SIZE):
+            request = {self.table.name: {"Keys": keys[i:i + BATCH_GET_SIZE]}}
+            attempt = 0
+            while request:
+                try:
+                    response = self.ddb_resource.batch_get_item(RequestItems=request)
+                except ClientError as e:
+                    self.check_table(e)
+                    logger.error(
+                        f"Could not get users: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
+                    raise
+                items.extend(response.get('Responses', {}).get(self.table.name, []))
+                request = response.get('UnprocessedKeys') or None
+                if request:
+                    time.sleep(min(2 ** attempt * 0.05, 5))
+                    attempt += 1
+        return items
+
+    def put_users(self, items: Iterable[Mapping]) -> int:
+        ## BatchWriteItem in chunks of 25; unprocessed items are resent by the batch writer
+        count = 0
+        try:
+            with self.table.batch_writer() as batch:
+                for item in items:
+                    batch.put_item(Item=item)
+                    count += 1
+        except ClientError as e:
+            self.check_table(e)
+            logger.error(
+                f"Could not put users: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
+            raise
+        return count
+
 def run_question(ddb_resource, table_name, key):
     print('-' * 50)
     users = Users(ddb_resource, table_name)
@@ -63,6 +161,9 @@ def run_question(ddb_resource, table_name, key):
     print('-' * 50)
 
 if __name__ == '__main__':
+    import argparse
+    import boto3
+    import json
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "-region",
@@ -1,43 +1,70 @@
 import string
-import boto3
-from typing import Mapping
+import os
+from typing import Iterable, Iterator, List, Mapping
+from boto3.dynamodb.conditions import Key
 from botocore.exceptions import ClientError
 import logging
-import argparse
 
 logger = logging.getLogger(__name__)
 logger.setLevel('ERROR')
 
+HASHKEY = os.getenv('HASHKEY_HIST', 'profile_name')
+RANGEKEY = os.getenv('RANGEKEY_HIST', 'epoctime')
+
 class UsersHistory:
-    def __init__(self, ddb_resource, table_name):
+    def __init__(self, ddb_resource, table_name, validate=True):
         self.ddb_resource = ddb_resource
         self.table = None
         try:
             table = self.ddb_resource.Table(table_name)
-            table.load()
+            ## validate=False skips the DescribeTable round trip; a missing table surfaces on the first call instead
+            if validate:
+                table.load()
             self.table = table
         except ClientError as e:
             logger.error(
                 f"Table {table_name} not found: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
             raise
 
+    def check_table(self, e: ClientError):
+        if e.response['Error']['Code'] == 'ResourceNotFoundException':
+            logger.error(
+                f"Table {self.table.name} not found: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
+
     def put_user(self, item: Mapping) -> Mapping:
         try:
             response = self.table.put_item(
                 Item=item
             )
         except ClientError as e:
+            self.check_table(e)
             logger.error(
                 f"Could not appen an item to table: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
             raise
         return response
 
+    def put_users(self, items: Iterable[Mapping]) -> int:
+        ## BatchWriteItem in chunks of 25; unprocessed items are resent by the batch writer
+        count = 0
+        try:
+            with self.table.batch_writer() as batch:
+                for item in items:
+                    batch.put_item(Item=item)
+                    count += 1
+        except ClientError as e:
+            self.check_table(e)
+            logger.error(
+                f"Could not append items to table: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
+            raise
+        return count
+
     def get_user(self, key: Mapping) -> Mapping:
         try:
             response = self.table.get_item(
                 Key=key
             )
         except ClientError as e:
+            self.check_table(e)
             logger.error(
                 f"Could not get user: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
             raise
@@ -45,27 +72,70 @@ class UsersHistory:
             return response['Item']
         return {}
 
-    def query(self, attribute: string) -> Mapping:
-        try:
-            response = self.table.query(
-                KeyConditionExpression=boto3.dynamodb.conditions.Key('user').eq(attribute)
-            )
-        except ClientError as e:
-            logger.error(
-                f"Could not get user: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
-            raise
-        return response['Items']
+    def iter_query(self, attribute: string, projection: Iterable[string] = None, limit: int = None,
+                   newest_first: bool = False, start: int = None, end: int = None,
+                   page_size: int = None) -> Iterator[Mapping]:
+        '''
+        Stream the history rows of one profile, page by page, following LastEvaluatedKey.
+        start/end bound the epoctime range (inclusive); limit caps the rows returned and
+        is also pushed down as the page size, so a small limit costs a single small read.
+        '''
+        condition = Key(HASHKEY).eq(attribute)
+        if start is not None and end is not None:
+            condition = condition & Key(RANGEKEY).between(start, end)
+        elif start is not None:
+            condition = condition & Key(RANGEKEY).gte(start)
+        elif end is not None:
+            condition = condition & Key(RANGEKEY).lte(end)
+        kwargs = {
+            "KeyConditionExpression": condition,
+            "ScanIndexForward": not newest_first
+        }
+        if projection:
+            names = {f"#p{i}": name for i, name in enumerate(projection)}
+            kwargs["ProjectionExpression"] = ", ".join(names)
+            kwargs["ExpressionAttributeNames"] = names
+        returned = 0
+        while True:
+            page_limit = page_size
+            if limit is not None:
+                page_limit = min(page_limit or limit - returned, limit - returned)
+            if page_limit:
+                kwargs["Limit"] = page_limit
+            try:
+                response = self.table.query(**kwargs)
+            except ClientError as e:
+                self.check_table(e)
+                logger.error(
+                    f"Could not query user history: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
+                raise
+            for item in response.get('Items', []):
+                yield item
+                returned += 1
+                if limit is not None and returned >= limit:
+                    return
+            if 'LastEvaluatedKey' not in response:
+                return
+            kwargs["ExclusiveStartKey"] = response['LastEvaluatedKey']
+
+    def query(self, attribute: string, **kwargs) -> List[Mapping]:
+        return list(self.iter_query(attribute, **kwargs))
 
-def run_question(ddb_resource, table_name, attribute):
+    def latest(self, attribute: string, count: int = 1, projection: Iterable[string] = None) -> List[Mapping]:
+        return self.query(attribute, projection=projection, limit=count, newest_first=True)
+
+def run_question(ddb_resource, table_name, attribute, limit=None, newest_first=False):
     print('-' * 50)
     users = UsersHistory(ddb_resource, table_name)
     print("table exists")
     print('-' * 50)
-    item = users.query(attribute=attribute)
+    item = users.query(attribute=attribute, limit=limit, newest_first=newest_first)
     print(f"get records with attribute {attribute} returned {len(item)} items: {item}")
     print('-' * 50)
 
 if __name__ == '__main__':
+    import argparse
+    import boto3
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "-region",
@@ -89,9 +159,23 @@ if __name__ == '__main__':
         type=str,
         default='user1'
     )
+    parser.add_argument(
+        "-limit",
+        "--limit",
+        dest="limit",
+        type=int
+    )
+    parser.add_argument(
+        "-newest-first",
+        "--newest-first",
+        dest="newest_first",
+        action='store_true'
+    )
     args = parser.parse_args()
     run_question(
         ddb_resource=boto3.resource('dynamodb', args.region),
         table_name=args.table_name,
-        attribute=args.attribute
+        attribute=args.attribute,
+        limit=args.limit,
+        newest_first=args.newest_first
     )
@@ -0,0 +1,39 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, List
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel('ERROR')
+
+DEFAULT_MAX_WORKERS = 10
+
+def bounded_map(func: Callable, items: Iterable, max_workers: int = DEFAULT_MAX_WORKERS) -> Iterator:
+    '''
+    Run func over items on a bounded thread pool and yield the results in input order.
+    Only a small window of items is submitted ahead of the consumer, so items can be a lazy iterator of any length.
+    '''
+    max_workers = max(1, int(max_workers or 1))
+    if max_workers == 1:
+        for item in items:
+            yield func(item)
+        return
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= 2 * max_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def chunked(items: Iterable, size: int) -> Iterator[List]:
+    ## consecutive lists of up to size items from a possibly lazy iterable
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
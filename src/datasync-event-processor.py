@@ -0,0 +1,69 @@
+import json
+import os
+import string
+from typing import Mapping
+from botocore.exceptions import ClientError
+import logging
+from common import callbacks
+from common import clients
+from common import metrics
+from common.replication_state import ReplicationState
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+FINAL_STATES = ['SUCCESS', 'ERROR']
+## how long a completion that arrived before the state machine started waiting is remembered
+MARKER_TTL_SECONDS = int(os.getenv('COMPLETION_MARKER_TTL_SECONDS', 3600))
+
+def describe_task_execution(arn: string, client) -> Mapping:
+    try:
+        response = client.describe_task_execution(
+            TaskExecutionArn=arn
+        )
+    except ClientError as e:
+        logger.error(
+            f"Could not describe task execution {arn}: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
+        raise
+    response.pop('ResponseMetadata', None)
+    return response
+
+def resume(execution_arn: string, result: Mapping, state: ReplicationState, sfn_client) -> string:
+    '''
+    Hand the final DescribeTaskExecution result to the execution waiting on execution_arn.
+    The state machine stores its task token under execution#<arn> with a put that fails if the
+    record exists, so when the completion wins the race a marker is left instead and the state
+    machine falls back to describing the execution itself.
+    Returns 'resumed', 'marked' or 'ignored'.
+    '''
+    key = f"execution#{execution_arn}"
+    claimed, existing = state.claim(key, {"status": result.get('Status')}, MARKER_TTL_SECONDS)
+    if claimed:
+        logger.info(f"no execution is waiting for {execution_arn} yet. left a completion marker")
+        return 'marked'
+    if 'token' not in existing:
+        logger.info(f"duplicate completion event for {execution_arn}")
+        return 'ignored'
+    resumed = callbacks.send_task_success(existing['token'], json.dumps(result, default=str), sfn_client)
+    state.release(key)
+    if resumed:
+        logger.info(f"resumed {existing.get('execution')} with status {result.get('Status')}")
+        return 'resumed'
+    return 'ignored'
+
+@metrics.report_api_calls('datasync-event-processor')
+def lambda_handler(event, context):
+    '''
+    Target of the "DataSync Task Execution State Change" rule; resources[0] is the task execution ARN.
+    '''
+    logger.info(f"received event: {event}")
+    if 'detail' not in event or not event.get('resources'):
+        logger.error(f"Expected keys detail and resources in input payload but didn't exist")
+        raise ValueError(f"Invalid event format: {event}")
+    if event['detail'].get('State') not in FINAL_STATES:
+        logger.info(f"nothing to do. task execution state is {event['detail'].get('State')}")
+        return 'ignored'
+    execution_arn = event['resources'][0]
+    result = describe_task_execution(execution_arn, clients.client('datasync'))
+    state = ReplicationState(clients.resource('dynamodb'), os.getenv('REPLICATION_STATE_TABLE', 'studioReplicationState'))
+    return resume(execution_arn, result, state, clients.client('stepfunctions'))
@@ -1,16 +1,28 @@
+import hashlib
 import json
 import string
-import boto3
+import time
 from typing import Mapping, List
-import argparse
 from botocore.exceptions import ClientError
 import os
 import logging
 from common import profile as p
+from common import clients
+from common import metrics
+from common import stream_filter
+from common import datasync_cache
+from common import datasync_policy
+from common.replication_state import ReplicationState
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+## MODIFYs of the same source and target within this many seconds start a single execution
+REPLICATION_DEDUPE_SECONDS = int(os.getenv('REPLICATION_DEDUPE_SECONDS', 900))
+## TTL of the task token items the execution parks on: the app readiness deadline of stepfunction.yaml
+## (AppReadyDeadlineSeconds) plus a day for the transfer. only tokens nobody consumed live that long
+TOKEN_TTL_SECONDS = int(os.getenv('TOKEN_TTL_SECONDS', 7200 + 86400))
+
 def get_params(names: List[str], client) -> Mapping:
     try:
         response = client.get_parameters(
@@ -23,33 +35,78 @@ def get_params(names: List[str], client) -> Mapping:
     return response
 
 
-def start_execution(arn: string, input: string, client) -> Mapping:
+def start_execution(arn: string, input: string, client, name: string = None) -> Mapping:
+    kwargs = {"stateMachineArn": arn, "input": input}
+    if name:
+        kwargs["name"] = name
     try:
-        response = client.start_execution(
-            stateMachineArn=arn,
-            input=input
-        )
+        response = client.start_execution(**kwargs)
     except ClientError as e:
+        if e.response['Error']['Code'] == 'ExecutionAlreadyExists':
+            logger.info(f"execution {name} already exists for state machine {arn}")
+            raise
         logger.error(
             f"Could not start state machine {arn}: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
         raise
     return response
 
 
-def lambda_handler(event, context):
-    logger.info(f"change in table detected: {event}")
-    if 'Records' not in event:
-        logger.error(f"Expected key Records in input payload but didn't exist")
-        raise ValueError(f"Invalid input: {event}")
+def replication_key(source_efs: string, source_mount: string, target_efs: string, target_mount: string) -> string:
+    ## the same copy always gets the same key, whatever triggered it
+    return hashlib.sha256(f"{source_efs}/{source_mount}/{target_efs}/{target_mount}".encode()).hexdigest()[:40]
+
+def execution_name(key: string, now: float = None) -> string:
+    '''
+    Deterministic within a dedupe window, so concurrent duplicates collide on the name even without
+    the dedupe record. Standard workflows reject a reused name for 90 days, hence the window suffix.
+    '''
+    window = int((now or time.time()) // REPLICATION_DEDUPE_SECONDS)
+    return f"replicate-{key}-{window}"
+
+def start_replication(arn: string, input: Mapping, key: string, client, state: ReplicationState = None) -> Mapping:
+    '''
+    Start at most one execution per replication key and dedupe window.
+    Returns the StartExecution response, or None when the start was coalesced into an earlier one.
+    '''
+    name = execution_name(key)
+    if state:
+        claimed, existing = state.claim(
+            key=f"start#{key}",
+            attributes={"execution_name": name, "state_machine": arn},
+            ttl_seconds=REPLICATION_DEDUPE_SECONDS
+        )
+        if not claimed:
+            logger.info(f"replication {key} already started as {existing.get('execution_name')}. skip duplicate trigger")
+            return None
+    try:
+        return start_execution(arn=arn, input=json.dumps(input), client=client, name=name)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ExecutionAlreadyExists':
+            return None
+        ## let the retried stream record claim the key again
+        if state:
+            state.release(f"start#{key}")
+        raise
+
+def get_env_params(names: List[str]) -> Mapping:
+    params = {}
+    for a in names:
+        if not(os.getenv(a)):
+            raise ValueError(f"invalid os env parameter. key {a} does not exist or value is empty")
+        params[a] = os.getenv(a)
+    return params
+
 
-    event = json.loads(json.dumps(event['Records'][0]))
-    if (event['eventName'] != 'MODIFY'):
-        logger.info(f"nothing to do. its not MODIFY event: {event['eventName']}")
+def process_record(event: Mapping, account: string, params: Mapping, sm_client, sfn_client, state: ReplicationState = None):
+    event = json.loads(json.dumps(event))
+    ## the same rules are compiled into the event source mapping's FilterCriteria; records that
+    ## reach this point fail at most the rules a filter pattern cannot express
+    process, rule = stream_filter.should_process(event)
+    if not process:
+        logger.info(f"nothing to do. record {event.get('dynamodb', {}).get('SequenceNumber')} does not pass rule {rule}")
         return
 
-    account = boto3.client('sts').get_caller_identity().get('Account')
     region = event['awsRegion']
-    replication_flag = event['dynamodb']['OldImage']['replication'].get('BOOL')
     domain_id = event['dynamodb']['NewImage']['domain_id'].get('S')
     domain_name = event['dynamodb']['NewImage']['domain_name'].get('S')
     profile_name = event['dynamodb']['NewImage']['profile_name'].get('S')
@@ -61,14 +118,11 @@ def lambda_handler(event, context):
     source_efs = event['dynamodb']['OldImage']['efs_sys_id'].get('S')
     source_mount = event['dynamodb']['OldImage']['efs_uid'].get('S')
 
-    if not(replication_flag):
-        logger.info(f"replication flag set to {replication_flag} for profile {profile_name}. skip replication")
-        return
     if user_profile_name:
         logger.info(f"build user profile metadata: {user_profile_name}")
         profile = p.Profile(
             domain_id=domain_id,
-            sm_client=boto3.client('sagemaker'),
+            sm_client=sm_client,
             profile_name=user_profile_name,
             role_name=role_name
         )
@@ -76,7 +130,7 @@ def lambda_handler(event, context):
         logger.info(f"build space metadata: {space_name}")
         profile = p.Profile(
             domain_id=domain_id,
-            sm_client=boto3.client('sagemaker'),
+            sm_client=sm_client,
             space_name=space_name
         )
     if profile.error:
@@ -94,21 +148,9 @@ def lambda_handler(event, context):
     home_efs_id {profile.efs_sys_id}\
     efs_uid {profile.efs_uid}""")
 
-    names = []
-    names.append(('SOURCE_SECURITY_GROUP', os.getenv('SOURCE_SECURITY_GROUP')))
-    names.append(('TARGET_SECURITY_GROUP', os.getenv('TARGET_SECURITY_GROUP')))
-    names.append(('SUBNET1', os.getenv('SUBNET1')))
-    names.append(('STEPFUNCTION', os.getenv('STEPFUNCTION')))
-
-    names = ['SOURCE_SECURITY_GROUP', 'TARGET_SECURITY_GROUP', 'SUBNET1', 'STEPFUNCTION']
-    params = {}
-    for a in names:
-        if not(os.getenv(a)):
-            raise ValueError(f"invalid os env parameter. key {a} does not exist or value is empty")
-        params[a] = os.getenv(a)
-
-    options = {"Gid": 'NONE', "LogLevel": "TRANSFER", "OverwriteMode": "ALWAYS", "PosixPermissions": "NONE", "TransferMode": "CHANGED", "Uid": "NONE"}
-    logger.debug(f"datasync task option setting: {options}")
+    facts, overrides = datasync_policy.facts_from_record(event)
+    options, applied = datasync_policy.decide(facts, overrides)
+    logger.info(f"datasync task option setting: {options} from rules {applied} for {facts}")
     source_domain_id = event['dynamodb']['OldImage']['domain_id'].get('S')
     source_domain_name = event['dynamodb']['OldImage']['domain_name'].get('S')
     source_profile_name = event['dynamodb']['OldImage']['profile_name'].get('S')
@@ -116,10 +158,6 @@ def lambda_handler(event, context):
     source_space_name = event['dynamodb']['OldImage']['space_name'].get('S')
     source_mount = event['dynamodb']['OldImage']['efs_uid'].get('S')
 
-    ## logic to skip the same EFS Volume and Directory replication in case of table update for other purpose (ex. replication switch)
-    if (source_efs == target_efs) and (source_mount == target_mount):
-        logging.warning(f"Source EFS Volume and Directory UID cannot be the same. skip profile {profile_name}")
-        return
     input = {
         "Options": options,
         "Log": {
@@ -151,17 +189,50 @@ def lambda_handler(event, context):
     elif user_profile_name:
         input["Source"]["UserProfileName"] = source_user_profile_name
         input["Target"]["UserProfileName"] = user_profile_name
+    input["Cache"] = datasync_cache.lookup(input, state)
+    ## the state machine has no clock arithmetic, so the expiry of its token items comes with the input
+    input["ExpiresAt"] = int(time.time()) + TOKEN_TTL_SECONDS
     step_function_name = params['STEPFUNCTION'].rsplit(':')[-1]
     logger.info(f"invoke stepfunction {params['STEPFUNCTION'].rsplit(':')[-1]} with input {input}")
-    response = start_execution(
+    response = start_replication(
         arn=f"arn:aws:states:{region}:{account}:stateMachine:{step_function_name}",
-        input=json.dumps(input),
-        client=boto3.client('stepfunctions')
+        input=input,
+        key=replication_key(source_efs, source_mount, target_efs, target_mount),
+        client=sfn_client,
+        state=state
     )
-    logger.info("Done")
+    if response:
+        logger.info(f"started execution {response['executionArn']}")
     return
 
+@metrics.report_api_calls('ddb-stream-processor')
+def lambda_handler(event, context):
+    logger.info(f"change in table detected: {event}")
+    if 'Records' not in event:
+        logger.error(f"Expected key Records in input payload but didn't exist")
+        raise ValueError(f"Invalid input: {event}")
+
+    params = get_env_params(['SOURCE_SECURITY_GROUP', 'TARGET_SECURITY_GROUP', 'SUBNET1', 'STEPFUNCTION'])
+    account = clients.account_id()
+    sm_client = clients.client('sagemaker')
+    sfn_client = clients.client('stepfunctions')
+    state = None
+    if os.getenv('REPLICATION_STATE_TABLE'):
+        state = ReplicationState(clients.resource('dynamodb'), os.getenv('REPLICATION_STATE_TABLE'))
+    ## report the first failed record back to the event source mapping (ReportBatchItemFailures).
+    ## stream records are retried from that sequence number on, so stop there to keep per-profile ordering
+    for record in event['Records']:
+        try:
+            process_record(record, account, params, sm_client, sfn_client, state)
+        except Exception as e:
+            sequence_number = record.get('dynamodb', {}).get('SequenceNumber')
+            logger.error(f"could not process record {sequence_number}: {e}")
+            return {"batchItemFailures": [{"itemIdentifier": sequence_number}]}
+    logger.info(f"Done. processed {len(event['Records'])} records")
+    return {"batchItemFailures": []}
+
 if __name__ == "__main__":
+    import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "-domain-id",
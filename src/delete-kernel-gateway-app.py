@@ -1,103 +1,130 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
+import os
 import time
-import boto3
 import logging
+from botocore.exceptions import ClientError
 from common import cfnresponse
-
-sm_client = boto3.client('sagemaker')
-
-def delete_apps_domain(domain_id):
+from common import clients
+from common import metrics
+from common import workers
+
+## the custom resource has 300 s; keep enough of it to send the response
+DELETE_DEADLINE_SECONDS = int(os.getenv('APP_DELETE_DEADLINE_SECONDS', 240))
+DELETE_CONCURRENCY = int(os.getenv('APP_DELETE_CONCURRENCY', 10))
+WAIT_INITIAL_SECONDS = 2
+WAIT_MAX_SECONDS = 30
+DONE_STATES = ['Deleted', 'Failed']
+
+def app_id(app):
+    ## apps of a domain belong to a user profile or to a space
+    return (app.get('UserProfileName') or app.get('SpaceName'), app['AppName'])
+
+def list_kernel_gateways(sm_client, **filters):
+    apps = []
+    for p in sm_client.get_paginator('list_apps').paginate(**filters):
+        apps.extend([a for a in p['Apps'] if a['AppType'] == 'KernelGateway'])
+    return apps
+
+def delete_app(sm_client, app):
+    owner = {'SpaceName': app['SpaceName']} if app.get('SpaceName') else {'UserProfileName': app['UserProfileName']}
+    try:
+        sm_client.delete_app(DomainId=app['DomainId'], AppType=app['AppType'], AppName=app['AppName'], **owner)
+    except ClientError as e:
+        ## gone or already on its way out
+        if e.response['Error']['Code'] == 'ResourceNotFound':
+            return None
+        if e.response['Error']['Code'] == 'ValidationException' and 'Deleting' in e.response['Error']['Message']:
+            return app_id(app)
+        logging.error(f"Could not delete app {app_id(app)}: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
+        raise
+    return app_id(app)
+
+def delete_apps(sm_client, deadline, **filters):
+    '''
+    Delete every KernelGateway app matching filters concurrently, then wait for exactly those apps
+    with exponential backoff until deadline (a time.monotonic() value).
+    Returns the apps still not deleted at the deadline and those whose delete was rejected.
+    '''
+    apps = [a for a in list_kernel_gateways(sm_client, **filters) if a['Status'] not in DONE_STATES]
+    pending = {app_id(a) for a in apps if a['Status'] == 'Deleting'}
+    failed = set()
+    def issue(app):
+        try:
+            return delete_app(sm_client, app)
+        except ClientError:
+            failed.add(app_id(app))
+            return None
+    issued = workers.bounded_map(issue, [a for a in apps if a['Status'] != 'Deleting'], max_workers=DELETE_CONCURRENCY)
+    pending.update([i for i in issued if i])
+    logging.info(f'Deleting {len(pending)} KernelGateway apps')
+    wait = WAIT_INITIAL_SECONDS
+    while pending:
+        if time.monotonic() + wait > deadline:
+            logging.error(f'KernelGateway apps still pending at the deadline: {sorted(pending)}')
+            return sorted(pending | failed)
+        time.sleep(wait)
+        wait = min(wait * 2, WAIT_MAX_SECONDS)
+        ## apps drop out of the listing some time after they are deleted
+        remaining = {app_id(a) for a in list_kernel_gateways(sm_client, **filters) if a['Status'] not in DONE_STATES}
+        pending &= remaining
+        logging.info(f'Number of pending KernelGateway apps: {len(pending)}')
+    return sorted(failed)
+
+def delete_apps_domain(domain_id, deadline):
+    sm_client = clients.client('sagemaker')
     logging.info(f'Start deleting apps for domain id: {domain_id}')
 
     try:
         sm_client.describe_domain(DomainId=domain_id)
     except:
         logging.info(f'Cannot retrieve {domain_id}')
-        return
-
-    for p in sm_client.get_paginator('list_apps').paginate(DomainIdEquals=domain_id):
-        for a in p['Apps']:
-            if a['AppType'] == 'KernelGateway' and a['Status'] != 'Deleted':
-
-                sm_client.delete_app(DomainId=a['DomainId'],
-                                     UserProfileName=a['UserProfileName'],
-                                     AppType=a['AppType'],
-                                     AppName=a['AppName'])
-
-    apps = 1
-    while apps:
-        apps = 0
-        for p in sm_client.get_paginator('list_apps').paginate(DomainIdEquals=domain_id):
-            apps += len(
-                [a['AppName'] for a in p['Apps'] if a['AppType'] == 'KernelGateway' and a['Status'] != 'Deleted'])
-        logging.info(f'Number of active KernelGateway apps: {str(apps)}')
-        time.sleep(5)
-
-    logging.info(f'KernelGateway apps for domain {domain_id} deleted')
-    return
-
-def delete_apps_user(domain_id, user_profile_name):
+        return []
+
+    pending = delete_apps(sm_client, deadline, DomainIdEquals=domain_id)
+    if not pending:
+        logging.info(f'KernelGateway apps for domain {domain_id} deleted')
+    return pending
+
+def delete_apps_user(domain_id, user_profile_name, deadline):
+    sm_client = clients.client('sagemaker')
     logging.info(f'Start deleting apps for user: {user_profile_name}')
 
     try:
         sm_client.describe_user_profile(DomainId=domain_id, UserProfileName=user_profile_name)
     except:
         logging.info(f'Cannot retrieve {user_profile_name}')
-        return
-
-    for p in sm_client.get_paginator('list_apps').paginate(DomainIdEquals=domain_id, UserProfileNameEquals=user_profile_name):
-        for a in p['Apps']:
-            if a['AppType'] == 'KernelGateway' and a['Status'] != 'Deleted':
-
-                sm_client.delete_app(DomainId=a['DomainId'],
-                                     UserProfileName=a['UserProfileName'],
-                                     AppType=a['AppType'],
-                                     AppName=a['AppName'])
-
-    apps = 1
-    while apps:
-        apps = 0
-        for p in sm_client.get_paginator('list_apps').paginate(DomainIdEquals=domain_id, UserProfileNameEquals=user_profile_name):
-            apps += len(
-                [a['AppName'] for a in p['Apps'] if a['AppType'] == 'KernelGateway' and a['Status'] != 'Deleted'])
-        logging.info(f'Number of active KernelGateway apps: {str(apps)}')
-        time.sleep(5)
-
-    logging.info(f'KernelGateway apps for user {user_profile_name} deleted')
-    return
-
-def delete_apps_space(domain_id, space_name):
+        return []
+
+    pending = delete_apps(sm_client, deadline, DomainIdEquals=domain_id, UserProfileNameEquals=user_profile_name)
+    if not pending:
+        logging.info(f'KernelGateway apps for user {user_profile_name} deleted')
+    return pending
+
+def delete_apps_space(domain_id, space_name, deadline):
+    sm_client = clients.client('sagemaker')
     logging.info(f'Start deleting apps for space: {space_name}')
 
     try:
         sm_client.describe_space(DomainId=domain_id, SpaceName=space_name)
     except:
         logging.info(f'Cannot retrieve {space_name}')
-        return
-
-    for p in sm_client.get_paginator('list_apps').paginate(DomainIdEquals=domain_id, SpaceNameEquals=space_name):
-        for a in p['Apps']:
-            if a['AppType'] == 'KernelGateway' and a['Status'] != 'Deleted':
-
-                sm_client.delete_app(DomainId=a['DomainId'],
-                                     SpaceName=a['SpaceName'],
-                                     AppType=a['AppType'],
-                                     AppName=a['AppName'])
+        return []
 
-    apps = 1
-    while apps:
-        apps = 0
-        for p in sm_client.get_paginator('list_apps').paginate(DomainIdEquals=domain_id, SpaceNameEquals=space_name):
-            apps += len(
-                [a['AppName'] for a in p['Apps'] if a['AppType'] == 'KernelGateway' and a['Status'] != 'Deleted'])
-        logging.info(f'Number of active KernelGateway apps: {str(apps)}')
-        time.sleep(5)
+    pending = delete_apps(sm_client, deadline, DomainIdEquals=domain_id, SpaceNameEquals=space_name)
+    if not pending:
+        logging.info(f'KernelGateway apps for space {space_name} deleted')
+    return pending
 
-    logging.info(f'KernelGateway apps for space {space_name} deleted')
-    return
+def deadline_for(context):
+    ## the configured deadline, or less when the invocation has less time left
+    seconds = DELETE_DEADLINE_SECONDS
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        seconds = min(seconds, context.get_remaining_time_in_millis() / 1000 - 15)
+    return time.monotonic() + max(0, seconds)
 
+@metrics.report_api_calls('delete-kernel-gateway-app')
 def lambda_handler(event, context):
     logging.info(f'REQUEST RECEIVED: {event}')
     response_data = {}
@@ -111,12 +138,17 @@ def lambda_handler(event, context):
             domain_id = event.get('ResourceProperties').get('DomainId')
             user_profile_name = event.get('ResourceProperties').get('UserProfileName')
             space_name = event.get('ResourceProperties').get('SpaceName')
+            started = time.monotonic()
+            deadline = deadline_for(context)
             if user_profile_name:
-                delete_apps_user(domain_id, user_profile_name)
+                pending = delete_apps_user(domain_id, user_profile_name, deadline)
             elif space_name:
-                delete_apps_space(domain_id, space_name)
+                pending = delete_apps_space(domain_id, space_name, deadline)
             else:
-                delete_apps_domain(domain_id)
+                pending = delete_apps_domain(domain_id, deadline)
+            if pending:
+                names = ', '.join(f"{owner}/{name}" for owner, name in pending[:20])
+                raise TimeoutError(f"{len(pending)} KernelGateway apps not deleted after {deadline - started:.0f}s: {names}")
         cfnresponse.send(event, context, cfnresponse.SUCCESS, response_data, physicalResourceId=physicalResourceId)
 
     except Exception as exception:
@@ -1,31 +1,38 @@
 import json
-import boto3
-import argparse
 import os
+from common import clients
 from common import profile as p
 from common import users as u
 from common import users_history as hist
+from common import metrics
+from common import workers
 import logging
 import time
+import zlib
+from typing import List, Mapping, Tuple
+from datetime import datetime, timezone
+from common.user_mapping import UserMapping, TRANSACT_MAX_ENTRIES, idempotency_token
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-def lambda_handler(event, context):
-    if 'detail' not in event:
-        logger.error(f"Expected key detail in input payload but didn't exist")
-        raise ValueError(f"Invalid event format: {event}")
-    event = json.loads(json.dumps(event['detail']))
-    logger.info(f"event detail: {event}")
-    domain_id = event.get('requestParameters')['domainId']
-    profile_name = event.get('requestParameters').get('userProfileName')
-    space_name = event.get('requestParameters').get('spaceName')
+BATCH_CONCURRENCY = int(os.getenv('DESCRIBE_CONCURRENCY', workers.DEFAULT_MAX_WORKERS))
+
+def parse_detail(detail: Mapping) -> Tuple[str, str, str, str]:
+    domain_id = detail.get('requestParameters')['domainId']
+    profile_name = detail.get('requestParameters').get('userProfileName') or ''
+    space_name = detail.get('requestParameters').get('spaceName') or ''
+    role_name = ""
+    if profile_name:
+        role_name = detail.get('requestParameters').get('userSettings')['executionRole'].rsplit("/")[-1]
+    return domain_id, profile_name, space_name, role_name
+
+def build_profile(domain_id: str, profile_name: str, space_name: str, role_name: str) -> p.Profile:
     if profile_name:
-        role_name = event.get('requestParameters').get('userSettings')['executionRole'].rsplit("/")[-1]
         logger.info(f"Create UserProfile event detected with domain {domain_id} userprofile {profile_name} role {role_name}")
         profile = p.Profile(
             domain_id=domain_id,
-            sm_client=boto3.client('sagemaker'),
+            sm_client=clients.client('sagemaker'),
             profile_name=profile_name,
             role_name=role_name
         )
@@ -35,11 +42,10 @@ def lambda_handler(event, context):
         home_efs_id {profile.efs_sys_id}\
         efs_uid {profile.efs_uid}""")
     elif space_name:
-        role_name = ""
         logger.info(f"Create Space event detected with domain {domain_id} space {space_name}")
         profile = p.Profile(
             domain_id=domain_id,
-            sm_client=boto3.client('sagemaker'),
+            sm_client=clients.client('sagemaker'),
             space_name=space_name
         )
         logger.info(f"""Built profile: space {profile.space}\
@@ -47,51 +53,203 @@ def lambda_handler(event, context):
         domain_id {profile.domain_id}\
         home_efs_id {profile.efs_sys_id}\
         efs_uid {profile.efs_uid}""")
+    else:
+        raise ValueError(f"neither userProfileName nor spaceName in event for domain {domain_id}")
+    return profile
+
+def get_mapping() -> UserMapping:
     users = u.Users(
-        ddb_resource=boto3.resource('dynamodb'),
-        table_name=os.getenv('USERTABLE', 'studioUser')
+        ddb_resource=clients.resource('dynamodb'),
+        table_name=os.getenv('USERTABLE', 'studioUser'),
+        validate=False
     )
     users_hist = hist.UsersHistory(
-        ddb_resource=boto3.resource('dynamodb'),
-        table_name=os.getenv('HISTORYTABLE', 'studioUserHistory')
+        ddb_resource=clients.resource('dynamodb'),
+        table_name=os.getenv('HISTORYTABLE', 'studioUserHistory'),
+        validate=False
     )
-    logger.info(f"update table {users.table.name}")
-    response = users.update_user(
-        key={
-            os.getenv('HASHKEY', "profile_name"): profile.name + profile.space, #either one is empty string,
-            os.getenv('RANGEKEY', "domain_name"): profile.domain_name
-        },
-        expression="set replication = :rp, domain_id = :d, user_profile_name = :upn, space_name = :s, efs_sys_id =:es, efs_uid = :eu, role_name =:rn",
-        attributes={
-            ":rp": True,
-            ":rn": profile.role,
-            ":d": domain_id,
-            ":upn": profile.name,
-            ":s": profile.space,
-            ":es": profile.efs_sys_id,
-            ":eu": profile.efs_uid
-        },
-        ret_val='ALL_NEW'
+    return UserMapping(users, users_hist)
+
+def current_key(profile: p.Profile) -> Mapping:
+    return {
+        os.getenv('HASHKEY', "profile_name"): profile.name + profile.space, #either one is empty string,
+        os.getenv('RANGEKEY', "domain_name"): profile.domain_name
+    }
+
+def current_attributes(profile: p.Profile) -> Mapping:
+    return {
+        "replication": True,
+        "domain_id": profile.domain_id,
+        "user_profile_name": profile.name,
+        "space_name": profile.space,
+        "efs_sys_id": profile.efs_sys_id,
+        "efs_uid": profile.efs_uid,
+        "role_name": profile.role
+    }
+
+def event_epoctime(detail: Mapping, domain_id: str = '') -> int:
+    ## CloudTrail eventTime keeps the history row identical when the same event is retried.
+    ## it has whole seconds only and the history hash key is the bare name, so a stable
+    ## millisecond offset from the domain keeps same-named profiles of two domains apart
+    try:
+        seconds = datetime.strptime(detail['eventTime'], '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return int(time.time() * 1000)
+    return int(seconds) * 1000 + zlib.crc32(domain_id.encode()) % 1000
+
+def unique_epoctimes(messages: Mapping):
+    ## entries of one transaction must not share a history key, or it fails as a whole
+    taken = set()
+    for (domain_id, profile_name, space_name), message in messages.items():
+        while (profile_name + space_name, message['epoctime']) in taken:
+            message['epoctime'] += 1
+        taken.add((profile_name + space_name, message['epoctime']))
+
+def write_profile(mapping: UserMapping, profile: p.Profile, epoctime: int, event_id: str = None) -> Mapping:
+    token = idempotency_token(event_id, profile.domain_id, profile.name + profile.space) if event_id else None
+    return mapping.write(
+        key=current_key(profile),
+        attributes=current_attributes(profile),
+        history_item=history_item(profile, epoctime),
+        token=token
     )
-    logger.debug(f"update table {users.table.name} respose: {response}")
-    logger.info(f"append to table {users_hist.table.name}")
-    users_hist.put_user(
-        item={
-            os.getenv('HASHKEY_HIST', 'profile_name'): profile.name + profile.space, #either one is empty string
-            os.getenv('RANGEKEY_HIST', 'epoctime'): int(time.time() * 1000),
-            "replication": True,
-            "role_name": profile.role,
-            "domain_id": domain_id,
-            "domain_name": profile.domain_name,
-            "user_profile_name": profile.name,
-            "space_name": profile.space,
-            "efs_sys_id": profile.efs_sys_id,
-            "efs_uid": profile.efs_uid}
+
+def write_profiles(mapping: UserMapping, profiles: List[Tuple[p.Profile, int]], event_ids: List[str] = None) -> List[bool]:
+    ## (profile, epoctime) pairs in one transaction; the event ids make the token
+    token = idempotency_token(*event_ids) if event_ids else None
+    return mapping.write_many(
+        [(current_key(profile), current_attributes(profile), history_item(profile, epoctime)) for profile, epoctime in profiles],
+        token=token
     )
+
+def history_item(profile: p.Profile, epoctime: int = None) -> Mapping:
+    return {
+        os.getenv('HASHKEY_HIST', 'profile_name'): profile.name + profile.space, #either one is empty string
+        os.getenv('RANGEKEY_HIST', 'epoctime'): epoctime or int(time.time() * 1000),
+        "replication": True,
+        "role_name": profile.role,
+        "domain_id": profile.domain_id,
+        "domain_name": profile.domain_name,
+        "user_profile_name": profile.name,
+        "space_name": profile.space,
+        "efs_sys_id": profile.efs_sys_id,
+        "efs_uid": profile.efs_uid
+    }
+
+@metrics.report_api_calls('event-processor')
+def lambda_handler(event, context):
+    if 'detail' not in event:
+        logger.error(f"Expected key detail in input payload but didn't exist")
+        raise ValueError(f"Invalid event format: {event}")
+    event_id = event.get('id')
+    event = json.loads(json.dumps(event['detail']))
+    logger.info(f"event detail: {event}")
+    profile = build_profile(*parse_detail(event))
+    logger.debug(f"domain metadata cache: {p.domain_cache.stats()}")
+    mapping = get_mapping()
+    logger.info(f"update table {mapping.users.table.name} and append to table {mapping.users_hist.table.name}")
+    response = write_profile(mapping, profile, event_epoctime(event, profile.domain_id), event_id)
+    logger.debug(f"write user mapping response: {response}")
+    if response is None:
+        logger.info(f"profile {profile.name + profile.space} unchanged, write skipped")
     logger.info("Done")
     return True
 
+def build_profile_safe(key: Tuple[str, str, str, str]):
+    try:
+        profile = build_profile(*key)
+    except Exception as e:
+        logger.error(f"could not build profile {key}: {e}")
+        return None
+    if profile.error:
+        logger.error(f"could not get metadata for profile {key}")
+        return None
+    return profile
+
+@metrics.report_api_calls('event-processor-batch')
+def batch_handler(event, context):
+    '''
+    SQS entry point: each message body is a CreateUserProfile/CreateSpace EventBridge event.
+    Messages for the same profile are processed once, profiles are described concurrently and
+    written up to TRANSACT_MAX_ENTRIES per transaction, and failed messages are returned as
+    batchItemFailures so only they are redelivered.
+    '''
+    if 'Records' not in event:
+        logger.error(f"Expected key Records in input payload but didn't exist")
+        raise ValueError(f"Invalid event format: {event}")
+    failures = []
+    messages = {}
+    for record in event['Records']:
+        try:
+            detail = json.loads(record['body'])['detail']
+            domain_id, profile_name, space_name, role_name = parse_detail(detail)
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error(f"could not parse message {record.get('messageId')}: {e}")
+            failures.append(record['messageId'])
+            continue
+        ## the last event for a profile wins; every message for it shares the outcome
+        key = (domain_id, profile_name, space_name)
+        if key in messages:
+            messages[key]['message_ids'].append(record['messageId'])
+            messages[key]['role_name'] = role_name
+            messages[key]['epoctime'] = event_epoctime(detail, domain_id)
+        else:
+            messages[key] = {'message_ids': [record['messageId']], 'role_name': role_name, 'epoctime': event_epoctime(detail, domain_id)}
+    unique_epoctimes(messages)
+    logger.info(f"received {len(event['Records'])} messages for {len(messages)} profiles")
+
+    keys = list(messages)
+    profiles = workers.bounded_map(
+        lambda key: build_profile_safe(key + (messages[key]['role_name'],)),
+        keys,
+        BATCH_CONCURRENCY
+    )
+    built = []
+    for key, profile in zip(keys, profiles):
+        if profile is None:
+            failures.extend(messages[key]['message_ids'])
+        else:
+            built.append((key, profile))
+
+    mapping = get_mapping()
+
+    def write(entry):
+        key, profile = entry
+        ## the message id is stable across redeliveries, so a retried write is a no-op
+        message_id = messages[key]['message_ids'][-1]
+        try:
+            write_profile(mapping, profile, messages[key]['epoctime'], message_id)
+        except Exception as e:
+            logger.error(f"could not write user mapping for profile {key}: {e}")
+            return False
+        return True
+
+    def write_group(group):
+        ## one transaction for the group; if it fails, one per profile so only the bad ones fail
+        try:
+            write_profiles(
+                mapping,
+                [(profile, messages[key]['epoctime']) for key, profile in group],
+                [messages[key]['message_ids'][-1] for key, _ in group]
+            )
+        except Exception as e:
+            logger.warning(f"could not write {len(group)} profiles in one transaction, write them one by one: {e}")
+            return [write(entry) for entry in group]
+        return [True] * len(group)
+
+    written = []
+    groups = list(workers.chunked(built, TRANSACT_MAX_ENTRIES))
+    for group, oks in zip(groups, workers.bounded_map(write_group, groups, BATCH_CONCURRENCY)):
+        for (key, profile), ok in zip(group, oks):
+            if ok:
+                written.append((key, profile))
+            else:
+                failures.extend(messages[key]['message_ids'])
+    logger.info(f"Done. {len(written)} profiles processed ({mapping.stats()}), {len(failures)} messages failed")
+    return {"batchItemFailures": [{"itemIdentifier": m} for m in failures]}
+
 if __name__ == "__main__":
+    import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "-domain-id",
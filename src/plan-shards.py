@@ -0,0 +1,115 @@
+import json
+import sys
+from typing import List, Mapping
+import logging
+from common import shard_planner
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+def human(seconds: float) -> str:
+    seconds = int(round(seconds))
+    return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m{seconds % 60:02d}s"
+
+def print_report(rows: List[Mapping]):
+    print(f"{'shards':>6}  {'makespan':>11}  {'lower bound':>11}  speedup")
+    for row in rows:
+        print(f"{row['Shards']:>6}  {human(row['Makespan']):>11}  {human(row['LowerBound']):>11}  {row['Speedup']:.2f}x")
+
+def print_plan(shards: List[Mapping]):
+    print(f"{'shard':>5}  {'expected':>11}  {'GiB':>9}  {'files':>10}  entries")
+    for index, shard in enumerate(shards):
+        paths = ', '.join(shard['Paths'][:5]) + (f" (+{len(shard['Paths']) - 5})" if len(shard['Paths']) > 5 else '')
+        print(f"{index:>5}  {human(shard['Seconds']):>11}  {shard['Bytes'] / 2 ** 30:>9.2f}  {shard['Files']:>10}  {paths}")
+
+def shard_inputs(inputs: List[Mapping], shards: List[Mapping]) -> List[Mapping]:
+    ## the inputs with one include filter per shard, for replicate-profiles.py
+    filters = [{"Includes": shard_planner.include_filter(shard['Paths'])} for shard in shards]
+    return [dict(input, Shards=filters) for input in inputs]
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="split a home directory into DataSync shards by top-level subtree")
+    parser.add_argument(
+        "-manifest",
+        "--manifest",
+        dest="manifest",
+        type=str,
+        help="one '<bytes>\\t<path>' line per file, paths relative to the home, - for stdin"
+    )
+    parser.add_argument(
+        "-path",
+        "--path",
+        dest="path",
+        type=str,
+        help="read the sizes from a mounted home directory instead"
+    )
+    parser.add_argument(
+        "-shards",
+        "--shards",
+        dest="shards",
+        type=int,
+        default=4
+    )
+    parser.add_argument(
+        "-max-shards",
+        "--max-shards",
+        dest="max_shards",
+        type=int,
+        help="report the expected makespan for every shard count up to this one"
+    )
+    parser.add_argument(
+        "-bytes-per-second",
+        "--bytes-per-second",
+        dest="bytes_per_second",
+        type=int,
+        default=shard_planner.BYTES_PER_SECOND,
+        help="expected throughput of one DataSync task"
+    )
+    parser.add_argument(
+        "-seconds-per-file",
+        "--seconds-per-file",
+        dest="seconds_per_file",
+        type=float,
+        default=shard_planner.SECONDS_PER_FILE,
+        help="expected per-file overhead of one DataSync task"
+    )
+    parser.add_argument(
+        "-inputs-file",
+        "--inputs-file",
+        dest="inputs_file",
+        type=str,
+        help="state machine inputs (one per line) of this home to write out with the shard filters"
+    )
+    parser.add_argument(
+        "-output",
+        "--output",
+        dest="output",
+        type=str,
+        help="where to write the sharded inputs for replicate-profiles.py --inputs-file"
+    )
+    args = parser.parse_args()
+    if bool(args.manifest) == bool(args.path):
+        parser.error("one of --manifest or --path is required")
+    if args.path:
+        subtrees = shard_planner.scan(args.path)
+    elif args.manifest == '-':
+        subtrees = shard_planner.read_manifest(sys.stdin)
+    else:
+        with open(args.manifest) as f:
+            subtrees = shard_planner.read_manifest(f)
+    cost = {"bytes_per_second": args.bytes_per_second, "seconds_per_file": args.seconds_per_file}
+    print(f"{len(subtrees)} top-level entries, {sum(e['Bytes'] for e in subtrees.values()) / 2 ** 30:.2f} GiB, "
+          f"{sum(e['Files'] for e in subtrees.values())} files")
+    print_report(shard_planner.report(subtrees, args.max_shards or args.shards, **cost))
+    shards = shard_planner.plan(subtrees, args.shards, **cost)
+    print_plan(shards)
+    if args.inputs_file:
+        with open(args.inputs_file) as f:
+            inputs = [json.loads(line) for line in f if line.strip()]
+        lines = [json.dumps(input) for input in shard_inputs(inputs, shards)]
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+        else:
+            print('\n'.join(lines))
@@ -0,0 +1,125 @@
+import json
+import sys
+from typing import Iterable, List, Mapping
+import logging
+from common import clients
+from common import replication_engine
+from common.replication_state import ReplicationState
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+def read_inputs(text: str) -> List[Mapping]:
+    '''
+    State machine inputs as a JSON array or one JSON document per line, e.g. the bodies of the
+    replication failure queue messages. Earlier results (Task, Result, Error ...) are dropped so
+    every input starts over.
+    '''
+    text = text.strip()
+    if not text:
+        return []
+    documents = json.loads(text) if text.startswith('[') else [json.loads(line) for line in text.splitlines() if line.strip()]
+    keep = ['Options', 'Log', 'Source', 'Target', 'Cache', 'Shards']
+    inputs = []
+    for document in documents:
+        input = {k: document[k] for k in keep if k in document}
+        for endpoint in ['Source', 'Target']:
+            input[endpoint].pop('CreateLocationResult', None)
+        inputs.append(input)
+    return inputs
+
+def print_results(results: Iterable[Mapping]):
+    rows = []
+    for result in results:
+        target = result['Input']['Target']
+        if result['Status'] == 'FAILED':
+            detail = result['Error']['State']
+        elif 'Shards' in result:
+            detail = f"{len(result['Shards'])} shards"
+        else:
+            detail = result['Result'].get('TaskExecutionArn', '')
+        rows.append((target.get('DomainName') or '', target.get('UserProfileName') or target.get('SpaceName') or '', result['Status'], detail))
+    width = max([len(r[0]) for r in rows] + [len('domain_name')])
+    pwidth = max([len(r[1]) for r in rows] + [len('profile_name')])
+    print(f"{'domain_name':<{width}}  {'profile_name':<{pwidth}}  {'status':<9}  detail")
+    for domain, profile, status, detail in rows:
+        print(f"{domain:<{width}}  {profile:<{pwidth}}  {status:<9}  {detail}")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="run the replication state machine in-process for many profiles")
+    parser.add_argument(
+        "-inputs-file",
+        "--inputs-file",
+        dest="inputs_file",
+        type=str,
+        required=True,
+        help="state machine inputs, a JSON array or one document per line, - for stdin"
+    )
+    parser.add_argument(
+        "-region",
+        "--region",
+        dest="region",
+        type=str
+    )
+    parser.add_argument(
+        "-table-name",
+        "--table-name",
+        dest="table_name",
+        type=str,
+        default='studioUser'
+    )
+    parser.add_argument(
+        "-state-table-name",
+        "--state-table-name",
+        dest="state_table_name",
+        type=str,
+        default='studioReplicationState',
+        help="DataSync location and task cache shared with the state machine"
+    )
+    parser.add_argument(
+        "-failure-queue-url",
+        "--failure-queue-url",
+        dest="failure_queue_url",
+        type=str,
+        help="send failed replications here, like the state machine does"
+    )
+    parser.add_argument(
+        "-concurrency",
+        "--concurrency",
+        dest="concurrency",
+        type=int,
+        default=replication_engine.DEFAULT_MAX_CONCURRENCY,
+        help="DataSync transfers in flight at any time; shards of one home count separately"
+    )
+    parser.add_argument(
+        "-max-replications",
+        "--max-replications",
+        dest="max_replications",
+        type=int,
+        default=replication_engine.DEFAULT_MAX_REPLICATIONS,
+        help="replications in flight at any time, waiting for the target app included; at least --concurrency"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.inputs_file == '-':
+        inputs = read_inputs(sys.stdin.read())
+    else:
+        with open(args.inputs_file) as f:
+            inputs = read_inputs(f.read())
+    ddb_resource = clients.resource('dynamodb', args.region)
+    results = replication_engine.run(
+        inputs,
+        sm_client=clients.client('sagemaker', args.region),
+        datasync_client=clients.client('datasync', args.region),
+        users_table=ddb_resource.Table(args.table_name),
+        state=ReplicationState(ddb_resource, args.state_table_name),
+        sqs_client=clients.client('sqs', args.region) if args.failure_queue_url else None,
+        failure_queue_url=args.failure_queue_url,
+        max_concurrency=args.concurrency,
+        max_replications=args.max_replications
+    )
+    print_results(results)
+    failed = len([r for r in results if r['Status'] == 'FAILED'])
+    print(f"Done. {len(results) - failed} replicated, {failed} failed")
+    sys.exit(1 if failed else 0)
@@ -1,15 +1,29 @@
-import boto3
+import json
 import os
 import logging
 import time
 from botocore.exceptions import ClientError
 import string
-from typing import Mapping, List
+from typing import Iterable, Iterator, Mapping, List, Tuple
 from common import cfnresponse
+from common import workers
+from common import clients
+from common import ratelimit
+from common import metrics
+from common import users as u
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+DESCRIBE_CONCURRENCY = int(os.getenv('DESCRIBE_CONCURRENCY', workers.DEFAULT_MAX_WORKERS))
+## hand the remaining work to a new invocation once less than this is left on the clock
+SEED_TIME_BUDGET_MS = int(os.getenv('SEED_TIME_BUDGET_MS', 60000))
+SEED_PHASES = ['users', 'spaces']
+## a page still throttled after this many invocations in a row fails the custom resource
+SEED_MAX_THROTTLED_ATTEMPTS = int(os.getenv('SEED_MAX_THROTTLED_ATTEMPTS', 8))
+SEED_THROTTLE_BACKOFF_SECONDS = float(os.getenv('SEED_THROTTLE_BACKOFF_SECONDS', 2))
+SEED_THROTTLE_MAX_BACKOFF_SECONDS = float(os.getenv('SEED_THROTTLE_MAX_BACKOFF_SECONDS', 60))
+
 def get_domain_ids(client)->List:
     domain_ids = []
     try:
@@ -35,33 +49,39 @@ def get_domain_metadata(domain_id: string, client)->Mapping[str, str]:
         return
     return response
 
-def list_profiles(domain_id: string, client)-> List[str]:
-    users = []
+def list_profiles(domain_id: string, client, next_token: string = None) -> Iterator[Tuple[List[str], str]]:
+    ## yield one page of names at a time together with the token of the page after it
     try:
-        paginator = client.get_paginator('list_user_profiles')
-        page_iterator = paginator.paginate(DomainIdEquals=domain_id,PaginationConfig={'MaxItems': 500})
-        for page in page_iterator:
-            for u in page['UserProfiles']:
-                users. append(u['UserProfileName'])
+        while True:
+            kwargs = {'DomainIdEquals': domain_id}
+            if next_token:
+                kwargs['NextToken'] = next_token
+            page = client.list_user_profiles(**kwargs)
+            next_token = page.get('NextToken')
+            yield [u['UserProfileName'] for u in page['UserProfiles']], next_token
+            if not next_token:
+                return
     except ClientError as e:
         logger.error(
             f"Could not list profiles with domain id {domain_id}: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
-        return
-    return users
+        raise
 
-def list_spaces(domain_id: string, client)-> List[str]:
-    users = []
+def list_spaces(domain_id: string, client, next_token: string = None) -> Iterator[Tuple[List[str], str]]:
+    ## yield one page of names at a time together with the token of the page after it
     try:
-        paginator = client.get_paginator('list_spaces')
-        page_iterator = paginator.paginate(DomainIdEquals=domain_id,PaginationConfig={'MaxItems': 500})
-        for page in page_iterator:
-            for s in page['Spaces']:
-                users. append(s['SpaceName'])
+        while True:
+            kwargs = {'DomainIdEquals': domain_id}
+            if next_token:
+                kwargs['NextToken'] = next_token
+            page = client.list_spaces(**kwargs)
+            next_token = page.get('NextToken')
+            yield [s['SpaceName'] for s in page['Spaces']], next_token
+            if not next_token:
+                return
     except ClientError as e:
         logger.error(
             f"Could not list spaces with domain id {domain_id}: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
-        return
-    return users
+        raise
 
 def get_user_metadata(domain_id: string, profile_name: string, client):
     try:
@@ -72,6 +92,9 @@ def get_user_metadata(domain_id: string, profile_name: string, client):
     except ClientError as e:
         logger.error(
             f"Could not describe user {profile_name}: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
+        ## still throttled after retries: fail the page so it is picked up again from the checkpoint
+        if e.response['Error']['Code'] in ratelimit.THROTTLE_CODES:
+            raise
         return
     return response
 
@@ -84,46 +107,177 @@ def get_space_metadata(domain_id: string, space_name: string, client):
     except ClientError as e:
         logger.error(
             f"Could not describe space {space_name}: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
+        ## still throttled after retries: fail the page so it is picked up again from the checkpoint
+        if e.response['Error']['Code'] in ratelimit.THROTTLE_CODES:
+            raise
         return
     return response
 
-def get_all_users_metadata(domain_id: string, efs_id: string, profile_names: List[str], client):
-    data = []
-    for name in profile_names:
-        response = get_user_metadata(domain_id, name, client)
-        user_meta = {
+def get_all_users_metadata(domain_id: string, efs_id: string, profile_names: Iterable[str], client, max_workers: int = DESCRIBE_CONCURRENCY) -> Iterator[Mapping]:
+    responses = workers.bounded_map(
+        lambda name: (name, get_user_metadata(domain_id, name, client)),
+        profile_names,
+        max_workers
+    )
+    for name, response in responses:
+        if not response:
+            continue
+        yield {
             "DomainId": domain_id,
             "UserProfileName": name,
             "HomeEfsFileSystemId": efs_id,
-            "HomeEfsFileSystemUid": "",
-            "ExecutionRole": ""
+            "HomeEfsFileSystemUid": response['HomeEfsFileSystemUid'],
+            "ExecutionRole": response['UserSettings']["ExecutionRole"].rsplit("role/")[-1]
         }
-        if response:
-            user_meta["HomeEfsFileSystemUid"] = response['HomeEfsFileSystemUid']
-            user_meta["ExecutionRole"] = response['UserSettings']["ExecutionRole"].rsplit("role/")[-1]
-            data.append(user_meta)
-        else:
-            continue
-    return data
 
-def get_all_spaces_metadata(domain_id: string, efs_id: string, space_names: List[str], client):
-    data = []
-    for name in space_names:
-        response = get_space_metadata(domain_id, name, client)
-        space_meta = {
+def get_all_spaces_metadata(domain_id: string, efs_id: string, space_names: Iterable[str], client, max_workers: int = DESCRIBE_CONCURRENCY) -> Iterator[Mapping]:
+    responses = workers.bounded_map(
+        lambda name: (name, get_space_metadata(domain_id, name, client)),
+        space_names,
+        max_workers
+    )
+    for name, response in responses:
+        if not response:
+            continue
+        yield {
             "DomainId": domain_id,
             "SpaceName": name,
             "HomeEfsFileSystemId": efs_id,
-            "HomeEfsFileSystemUid": "",
+            "HomeEfsFileSystemUid": response['HomeEfsFileSystemUid'],
             "ExecutionRole": ""
         }
-        if response:
-            space_meta["HomeEfsFileSystemUid"] = response['HomeEfsFileSystemUid']
-            data.append(space_meta)
+
+def build_item(record: Mapping, domain_name: string) -> Mapping:
+    return {
+        os.getenv('HASHKEY_HIST', 'profile_name'): record.get("UserProfileName", "")+record.get("SpaceName", ""), #either UserProfileName or SpaceName is empty string
+        "replication": True,
+        "role_name": record.get("ExecutionRole"),
+        "user_profile_name": record.get("UserProfileName"),
+        "space_name": record.get("SpaceName"),
+        "domain_id": record.get("DomainId"),
+        "domain_name": domain_name,
+        "efs_sys_id": record.get("HomeEfsFileSystemId"),
+        "efs_uid": record.get("HomeEfsFileSystemUid")
+    }
+
+def build_history_item(record: Mapping, domain_name: string) -> Mapping:
+    item = build_item(record, domain_name)
+    item[os.getenv('RANGEKEY_HIST', 'epoctime')] = int(time.time() * 1000)
+    return item
+
+def update_record(table, item: Mapping):
+    ## SET only the seeded attributes, so whatever else the row carries (tier, totals, options) survives
+    names = [name for name in item if name not in (u.HASHKEY, u.RANGEKEY)]
+    table.update_item(
+        Key={u.HASHKEY: item[u.HASHKEY], u.RANGEKEY: item[u.RANGEKEY]},
+        UpdateExpression="set " + ", ".join(f"#a{i} = :v{i}" for i in range(len(names))),
+        ExpressionAttributeNames={f"#a{i}": name for i, name in enumerate(names)},
+        ExpressionAttributeValues={f":v{i}": item[name] for i, name in enumerate(names)}
+    )
+
+def write_records(records: Iterable[Mapping], domain_name: string, table, hist_table) -> Tuple[int, int]:
+    '''
+    Write the current and history rows of records, skipping profiles whose current row already
+    holds the seeded values, so a re-seed rewrites nothing and appends no history.
+    Existing rows are read with one BatchGetItem per 100 records. New rows are put, changed rows
+    are updated in place. Returns (written, skipped).
+    '''
+    written = skipped = 0
+    users = u.Users(clients.resource('dynamodb'), table.name, validate=False)
+    with table.batch_writer() as batch, hist_table.batch_writer() as hist_batch:
+        for chunk in workers.chunked(records, u.BATCH_GET_SIZE):
+            items = [build_item(record, domain_name) for record in chunk]
+            keys = [{u.HASHKEY: item[u.HASHKEY], u.RANGEKEY: item[u.RANGEKEY]} for item in items]
+            current = {(row[u.HASHKEY], row[u.RANGEKEY]): row for row in users.batch_get_users(keys)}
+            for record, item in zip(chunk, items):
+                row = current.get((item[u.HASHKEY], item[u.RANGEKEY]))
+                ## the row may hold more than the seed writes, only the seeded attributes count
+                if row is not None and all(row.get(k) == v for k, v in item.items()):
+                    skipped += 1
+                    continue
+                if row is None:
+                    batch.put_item(Item=item)
+                else:
+                    update_record(table, item)
+                hist_batch.put_item(Item=build_history_item(record, domain_name))
+                written += 1
+    return written, skipped
+
+def new_checkpoint(domain_ids: List[str]) -> Mapping:
+    return {
+        "DomainIds": list(domain_ids or []),
+        "Phase": SEED_PHASES[0],
+        "NextToken": None,
+        "RecordsWritten": 0,
+        "RecordsSkipped": 0,
+        "ThrottledAttempts": 0
+    }
+
+def out_of_time(context) -> bool:
+    if not hasattr(context, 'get_remaining_time_in_millis'):
+        return False
+    return context.get_remaining_time_in_millis() < SEED_TIME_BUDGET_MS
+
+def throttle_backoff(attempts: int, context) -> float:
+    ## doubling pause before a throttled page is handed on, never past the invocation's own timeout
+    delay = min(SEED_THROTTLE_BACKOFF_SECONDS * 2 ** (attempts - 1), SEED_THROTTLE_MAX_BACKOFF_SECONDS)
+    if hasattr(context, 'get_remaining_time_in_millis'):
+        delay = min(delay, max(0, context.get_remaining_time_in_millis() - 10000) / 1000)
+    return delay
+
+def continue_seed(event: Mapping, checkpoint: Mapping, context, client):
+    logger.info(f"running out of time. continue seed asynchronously from checkpoint {checkpoint}")
+    payload = dict(event)
+    payload['Checkpoint'] = checkpoint
+    try:
+        client.invoke(
+            FunctionName=context.invoked_function_arn,
+            InvocationType='Event',
+            Payload=json.dumps(payload)
+        )
+    except ClientError as e:
+        logger.error(
+            f"Could not continue seed from checkpoint {checkpoint}: {e.response['Error']['Code']}:{e.response['Error']['Message']}")
+        raise
+
+def seed_domain(domain_id: string, checkpoint: Mapping, table, hist_table, client, context) -> bool:
+    '''
+    Seed a single domain starting from checkpoint, updating it after every page written.
+    Returns False if the invocation ran out of time or was throttled before the domain was finished;
+    checkpoint['ThrottledAttempts'] counts the throttled invocations since the last page written.
+    '''
+    domain_metadata = get_domain_metadata(domain_id, client)
+    efs_id = domain_metadata['HomeEfsFileSystemId'] #event.get('ResourceProperties')['EFS_ID']
+    domain_name = domain_metadata['DomainName']
+    logger.info(f"seed domain {domain_name} {domain_id} from checkpoint {checkpoint}")
+    for phase in SEED_PHASES[SEED_PHASES.index(checkpoint['Phase']):]:
+        checkpoint['Phase'] = phase
+        if phase == 'users':
+            pages = list_profiles(domain_id, client, checkpoint['NextToken'])
+            describe = get_all_users_metadata
         else:
-            continue
-    return data
+            pages = list_spaces(domain_id, client, checkpoint['NextToken'])
+            describe = get_all_spaces_metadata
+        for names, next_token in pages:
+            try:
+                count, skipped = write_records(describe(domain_id, efs_id, names, client), domain_name, table, hist_table)
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ratelimit.THROTTLE_CODES:
+                    raise
+                checkpoint['ThrottledAttempts'] = checkpoint.get('ThrottledAttempts', 0) + 1
+                logger.warning(f"domain {domain_name} {domain_id}: throttled, retry the page from checkpoint {checkpoint}")
+                return False
+            checkpoint['ThrottledAttempts'] = 0
+            checkpoint['RecordsWritten'] += count
+            checkpoint['RecordsSkipped'] = checkpoint.get('RecordsSkipped', 0) + skipped
+            checkpoint['NextToken'] = next_token
+            logger.info(f"domain {domain_name} {domain_id}: wrote {count} {phase}, skipped {skipped} unchanged, {checkpoint['RecordsWritten']} records in total")
+            if next_token and out_of_time(context):
+                return False
+        checkpoint['NextToken'] = None
+    return True
 
+@metrics.report_api_calls('seed-table')
 def lambda_handler(event, context):
     logger.info(f"received event: {event}")
     physicalResourceId = event.get('PhysicalResourceId')
@@ -136,61 +290,36 @@ def lambda_handler(event, context):
             physicalResourceId=physicalResourceId
         )
     try:
-        sagemaker = boto3.client('sagemaker')
-        domain_ids = get_domain_ids(sagemaker) #event.get('ResourceProperties')['DOMAIN_ID']
-        dynamodb = boto3.resource('dynamodb')
+        sagemaker = clients.client('sagemaker')
+        checkpoint = event.get('Checkpoint')
+        if not checkpoint:
+            checkpoint = new_checkpoint(get_domain_ids(sagemaker)) #event.get('ResourceProperties')['DOMAIN_ID']
+        dynamodb = clients.resource('dynamodb')
         user_table = os.getenv('USERTABLE', 'studioUser')
         user_hist_table = os.getenv('HISTORYTABLE', 'studioUserHIstory')
         hist_table = dynamodb.Table(user_hist_table)
         table = dynamodb.Table(user_table)
-        for domain_id in domain_ids:
-            domain_metadata = get_domain_metadata(domain_id, sagemaker)
-            efs_id = domain_metadata['HomeEfsFileSystemId'] #event.get('ResourceProperties')['EFS_ID']
-            domain_name = domain_metadata['DomainName']
-            users = list_profiles(domain_id, sagemaker)
-            logger.info(f"domain {domain_name} {domain_id} has users {users}")
-            spaces = list_spaces(domain_id, sagemaker)
-            logger.info(f"domain {domain_name} {domain_id} has spaces {spaces}")
-            data = get_all_users_metadata(domain_id, efs_id, users, sagemaker)
-            data += get_all_spaces_metadata(domain_id, efs_id, spaces, sagemaker)
-            logger.info(f"update table {user_table} with data: {data}")
-            with table.batch_writer() as batch:
-                # put in a batch
-                for record in data:
-                    item = {
-                        os.getenv('HASHKEY_HIST'): record.get("UserProfileName", "")+record.get("SpaceName", ""), #either UserProfileName or SpaceName is empty string
-                        "replication": True,
-                        "role_name": record.get("ExecutionRole"),
-                        "user_profile_name": record.get("UserProfileName"),
-                        "space_name": record.get("SpaceName"),
-                        "domain_id": record.get("DomainId"),
-                        "domain_name": domain_name,
-                        "efs_sys_id": record.get("HomeEfsFileSystemId"),
-                        "efs_uid": record.get("HomeEfsFileSystemUid")
-                    }
-                    batch.put_item(Item=item)
-            logger.info(f"update history table {user_hist_table}")
-            with hist_table.batch_writer() as batch:
-                # put in a batch
-                for record in data:
-                    item = {
-                        os.getenv('HASHKEY_HIST'): record.get("UserProfileName", "")+record.get("SpaceName", ""), #either UserProfileName or SpaceName is empty string
-                        os.getenv('RANGEKEY_HIST'): int(time.time() * 1000),
-                        "replication": True,
-                        "role_name": record.get("ExecutionRole"),
-                        "user_profile_name": record.get("UserProfileName"),
-                        "space_name": record.get("SpaceName"),
-                        "domain_id": record.get("DomainId"),
-                        "domain_name": domain_name,
-                        "efs_sys_id": record.get("HomeEfsFileSystemId"),
-                        "efs_uid": record.get("HomeEfsFileSystemUid")
-                    }
-                    batch.put_item(Item=item)
+        logger.info(f"update tables {user_table} and {user_hist_table} from checkpoint {checkpoint}")
+        while checkpoint['DomainIds']:
+            if not seed_domain(checkpoint['DomainIds'][0], checkpoint, table, hist_table, sagemaker, context):
+                attempts = checkpoint.get('ThrottledAttempts', 0)
+                if attempts >= SEED_MAX_THROTTLED_ATTEMPTS:
+                    raise RuntimeError(f"seed still throttled after {attempts} attempts at checkpoint {checkpoint}")
+                if attempts:
+                    time.sleep(throttle_backoff(attempts, context))
+                continue_seed(event, checkpoint, context, clients.client('lambda'))
+                return
+            checkpoint['DomainIds'].pop(0)
+            checkpoint['Phase'] = SEED_PHASES[0]
+            if checkpoint['DomainIds'] and out_of_time(context):
+                continue_seed(event, checkpoint, context, clients.client('lambda'))
+                return
+        logger.info(f"seed completed with {checkpoint['RecordsWritten']} records, {checkpoint.get('RecordsSkipped', 0)} unchanged")
         cfnresponse.send(
             event,
             context,
             cfnresponse.SUCCESS,
-            {},
+            {"RecordsWritten": checkpoint['RecordsWritten'], "RecordsSkipped": checkpoint.get('RecordsSkipped', 0)},
             physicalResourceId=physicalResourceId
         )
     except Exception as e:
@@ -204,4 +333,3 @@ def lambda_handler(event, context):
         )
         return
     return
-
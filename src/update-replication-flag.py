@@ -1,12 +1,83 @@
-import json
-import boto3
-import argparse
 import os
+import sys
+import time
+from typing import Iterable, List, Mapping, Tuple
+from botocore.exceptions import ClientError
+from common import clients
 from common import users as u
 from common import users_history as hist
-import time
+from common import workers
+from common.user_mapping import UserMapping
+
+def read_keys(lines: Iterable[str], domain_name: str = None) -> List[Mapping]:
+    '''
+    One "domain_name,profile_name" pair per line, or just a profile name when domain_name is given.
+    Blank lines and lines starting with # are skipped; duplicates are dropped.
+    '''
+    keys = []
+    seen = set()
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if ',' in line:
+            domain, profile = [part.strip() for part in line.split(',', 1)]
+        elif domain_name:
+            domain, profile = domain_name, line
+        else:
+            raise ValueError(f"line '{line}' has no domain name and --domain-name is not set")
+        if (domain, profile) in seen:
+            continue
+        seen.add((domain, profile))
+        keys.append({u.RANGEKEY: domain, u.HASHKEY: profile})
+    return keys
+
+def toggle(users: u.Users, key: Mapping, replication: bool) -> Tuple[Mapping, str, Mapping]:
+    try:
+        item, changed = users.set_replication(key=key, replication=replication)
+    except ClientError as e:
+        return key, f"error: {e.response['Error']['Code']}", {}
+    if changed:
+        return key, "updated", item
+    return key, "unchanged" if item else "not found", item
+
+def history_record(item: Mapping, epoctime: int) -> Mapping:
+    return {
+        os.getenv('HASHKEY_HIST', 'profile_name'): item[u.HASHKEY],
+        os.getenv('RANGEKEY_HIST', 'epoctime'): epoctime,
+        "replication": item['replication'],
+        "role_name": item.get('role_name', ''),
+        "domain_id": item.get('domain_id', ''),
+        "domain_name": item[u.RANGEKEY],
+        "user_profile_name": item.get('user_profile_name', ''),
+        "space_name": item.get('space_name', ''),
+        "efs_sys_id": item.get('efs_sys_id', ''),
+        "efs_uid": item.get('efs_uid', '')
+    }
+
+def run_bulk(users: u.Users, users_hist: hist.UsersHistory, keys: List[Mapping], replication: bool,
+             concurrency: int = workers.DEFAULT_MAX_WORKERS) -> List[Tuple[Mapping, str, Mapping]]:
+    '''
+    Flip the flag on every key concurrently over one pooled client, then append all history rows
+    with BatchWriteItem. Each profile costs one UpdateItem plus 1/25 of a BatchWriteItem.
+    '''
+    results = list(workers.bounded_map(lambda key: toggle(users, key, replication), keys, concurrency))
+    epoctime = int(time.time() * 1000)
+    ## distinct range keys so the same profile name in two domains does not collide in history
+    changed = [item for _, status, item in results if status == "updated"]
+    records = [history_record(item, epoctime + i) for i, item in enumerate(changed)]
+    users_hist.put_users(records)
+    return results
+
+def print_results(results: List[Tuple[Mapping, str, Mapping]]):
+    width = max([len(key[u.RANGEKEY]) for key, _, _ in results] + [len('domain_name')])
+    pwidth = max([len(key[u.HASHKEY]) for key, _, _ in results] + [len('profile_name')])
+    print(f"{'domain_name':<{width}}  {'profile_name':<{pwidth}}  result")
+    for key, status, _ in results:
+        print(f"{key[u.RANGEKEY]:<{width}}  {key[u.HASHKEY]:<{pwidth}}  {status}")
 
 if __name__ == "__main__":
+    import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "-domain-name",
@@ -52,6 +123,27 @@ if __name__ == "__main__":
         dest="replication",
         action='store_false'
     )
+    parser.add_argument(
+        "-keys-file",
+        "--keys-file",
+        dest="keys_file",
+        type=str,
+        help="bulk mode: file with one domain_name,profile_name per line, - for stdin"
+    )
+    parser.add_argument(
+        "-all-profiles",
+        "--all-profiles",
+        dest="all_profiles",
+        action='store_true',
+        help="bulk mode: every profile in the table, limited to --domain-name when given"
+    )
+    parser.add_argument(
+        "-concurrency",
+        "--concurrency",
+        dest="concurrency",
+        type=int,
+        default=workers.DEFAULT_MAX_WORKERS
+    )
     parser.set_defaults(replication=True)
     args = parser.parse_args()
     table = args.table_name
@@ -60,10 +152,31 @@ if __name__ == "__main__":
     domain_name = args.domain_name
     region = args.region
     replication = args.replication
-    table_key = {"domain_name": domain_name, "profile_name": profile_name}
+    ddb_resource = clients.resource('dynamodb', region)
+
+    if args.keys_file or args.all_profiles:
+        users = u.Users(ddb_resource, table)
+        users_hist = hist.UsersHistory(ddb_resource=ddb_resource, table_name=history_table)
+        if args.all_profiles:
+            keys = list(users.scan_users(domain_name=domain_name, keys_only=True))
+        elif args.keys_file == '-':
+            keys = read_keys(sys.stdin, domain_name)
+        else:
+            with open(args.keys_file) as f:
+                keys = read_keys(f, domain_name)
+        print(f"set replication={replication} on {len(keys)} profiles in table {table}")
+        start = time.perf_counter()
+        results = run_bulk(users, users_hist, keys, replication, args.concurrency)
+        print('-' * 50)
+        print_results(results)
+        print('-' * 50)
+        updated = sum(1 for _, status, _ in results if status == "updated")
+        unchanged = sum(1 for _, status, _ in results if status == "unchanged")
+        print(f"{updated}/{len(results)} profiles updated, {unchanged} already set, in {time.perf_counter() - start:.2f}s")
+        sys.exit(0 if updated + unchanged == len(results) else 1)
 
+    table_key = {"domain_name": domain_name, "profile_name": profile_name}
     print(f"Read table {table} with key {table_key}")
-    ddb_resource = boto3.resource('dynamodb', region)
     users = u.Users(ddb_resource, args.table_name)
     print("table exists")
     print('-' * 50)
@@ -72,29 +185,23 @@ if __name__ == "__main__":
     print('-' * 50)
     print(f"update table {table} and set replication flag")
     item['replication'] = replication
-    response = users.update_user(
-        key=table_key,
-        expression="set replication = :rp, domain_id = :d, user_profile_name = :upn, space_name = :s, efs_sys_id =:es, efs_uid = :eu, role_name =:rn",
-        attributes={
-            ":rp": item['replication'],
-            ":rn": item['role_name'],
-            ":d": item['domain_id'],
-            ":upn": item['user_profile_name'],
-            ":s": item['space_name'],
-            ":es": item['efs_sys_id'],
-            ":eu": item['efs_uid']
-        },
-        ret_val='ALL_NEW'
-    )
-    print(f"update table {table} respose: {response}")
-    print('-' * 50)
     users_hist = hist.UsersHistory(
         ddb_resource=ddb_resource,
         table_name=history_table
     )
-    print(f"append the item into table {history_table}")
-    users_hist.put_user(
-        item={
+    print(f"update table {table} and append the item into table {history_table} in one transaction")
+    response = UserMapping(users, users_hist).write(
+        key=table_key,
+        attributes={
+            "replication": item['replication'],
+            "role_name": item['role_name'],
+            "domain_id": item['domain_id'],
+            "user_profile_name": item['user_profile_name'],
+            "space_name": item['space_name'],
+            "efs_sys_id": item['efs_sys_id'],
+            "efs_uid": item['efs_uid']
+        },
+        history_item={
             "profile_name": profile_name,
             "epoctime": int(time.time() * 1000),
             "replication": item['replication'],
@@ -107,6 +214,10 @@ if __name__ == "__main__":
             "efs_uid": item['efs_uid']
         }
     )
+    if response is None:
+        print(f"replication is already {replication} for {table_key}. Nothing written")
+    else:
+        print(f"write user mapping response: {response}")
     print("Done")
 
 
@@ -0,0 +1,402 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import time
+import tracemalloc
+import zlib
+from collections import Counter
+from threading import Lock
+from types import SimpleNamespace
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_DIR)
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+from botocore.exceptions import ClientError
+from common import clients
+from common import cfnresponse
+
+ACCOUNT = '123456789012'
+REGION = os.environ['AWS_DEFAULT_REGION']
+PAGE_SIZE = 100
+## simulated round trip per fake API call, set with --latency-ms
+LATENCY_S = 0.0
+
+class ApiCalls:
+    '''Thread-safe counter of service.operation calls made against the fakes.'''
+    def __init__(self):
+        self.counts = Counter()
+        self._lock = Lock()
+
+    def record(self, service: str, operation: str):
+        with self._lock:
+            self.counts[f"{service}.{operation}"] += 1
+        if LATENCY_S:
+            time.sleep(LATENCY_S)
+
+    def total(self) -> int:
+        return sum(self.counts.values())
+
+def not_found(operation: str):
+    return ClientError({'Error': {'Code': 'ResourceNotFound', 'Message': 'not found'}}, operation)
+
+class FakeSageMaker:
+    def __init__(self, calls: ApiCalls, domains: int, profiles: int, spaces: int):
+        self.calls = calls
+        self.domains = {f"d-{d:04d}": {
+            "DomainName": f"domain-{d}",
+            "HomeEfsFileSystemId": f"fs-{d:08d}",
+            "profiles": [f"user-{i}" for i in range(profiles)],
+            "spaces": [f"space-{i}" for i in range(spaces)]
+        } for d in range(domains)}
+
+    def _page(self, names, key, name_key, next_token):
+        start = int(next_token or 0)
+        page = {key: [{name_key: n} for n in names[start:start + PAGE_SIZE]]}
+        if start + PAGE_SIZE < len(names):
+            page['NextToken'] = str(start + PAGE_SIZE)
+        return page
+
+    def list_domains(self, **kwargs):
+        self.calls.record('sagemaker', 'ListDomains')
+        return {'Domains': [{'DomainId': d} for d in self.domains]}
+
+    def describe_domain(self, DomainId):
+        self.calls.record('sagemaker', 'DescribeDomain')
+        if DomainId not in self.domains:
+            raise not_found('DescribeDomain')
+        domain = self.domains[DomainId]
+        return {'DomainId': DomainId, 'DomainName': domain['DomainName'], 'HomeEfsFileSystemId': domain['HomeEfsFileSystemId']}
+
+    def list_user_profiles(self, DomainIdEquals, NextToken=None, **kwargs):
+        self.calls.record('sagemaker', 'ListUserProfiles')
+        return self._page(self.domains[DomainIdEquals]['profiles'], 'UserProfiles', 'UserProfileName', NextToken)
+
+    def list_spaces(self, DomainIdEquals, NextToken=None, **kwargs):
+        self.calls.record('sagemaker', 'ListSpaces')
+        return self._page(self.domains[DomainIdEquals]['spaces'], 'Spaces', 'SpaceName', NextToken)
+
+    def describe_user_profile(self, DomainId, UserProfileName):
+        self.calls.record('sagemaker', 'DescribeUserProfile')
+        return {
+            'DomainId': DomainId,
+            'UserProfileName': UserProfileName,
+            'HomeEfsFileSystemUid': str(200000 + zlib.crc32(UserProfileName.encode()) % 100000),
+            'UserSettings': {'ExecutionRole': f"arn:aws:iam::{ACCOUNT}:role/{UserProfileName}-role"}
+        }
+
+    def describe_space(self, DomainId, SpaceName):
+        self.calls.record('sagemaker', 'DescribeSpace')
+        return {'DomainId': DomainId, 'SpaceName': SpaceName, 'HomeEfsFileSystemUid': str(300000 + zlib.crc32(SpaceName.encode()) % 100000)}
+
+class FakeBatchWriter:
+    def __init__(self, table):
+        self.table = table
+        self.buffer = []
+
+    def put_item(self, Item):
+        self.buffer.append(Item)
+        if len(self.buffer) >= 25:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.table.calls.record('dynamodb', 'BatchWriteItem')
+            for item in self.buffer:
+                self.table.store(item)
+            self.buffer = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+class FakeDynamoDBClient:
+    def __init__(self, calls: ApiCalls, tables: dict):
+        self.calls = calls
+        self.tables = tables
+
+    def transact_write_items(self, TransactItems, **kwargs):
+        self.calls.record('dynamodb', 'TransactWriteItems')
+        for action in TransactItems:
+            for request in action.values():
+                self.tables[request['TableName']].store(request.get('Item') or request.get('Key'))
+        return {}
+
+class FakeTable:
+    '''In-memory table stand-in; items are only counted so the fake itself does not dominate peak memory.'''
+    def __init__(self, calls: ApiCalls, name: str, client: FakeDynamoDBClient):
+        self.calls = calls
+        self.name = name
+        self.items = 0
+        self.meta = SimpleNamespace(client=client)
+
+    def store(self, item):
+        self.items += 1
+
+    def load(self):
+        self.calls.record('dynamodb', 'DescribeTable')
+
+    def batch_writer(self, **kwargs):
+        return FakeBatchWriter(self)
+
+    def put_item(self, Item, **kwargs):
+        self.calls.record('dynamodb', 'PutItem')
+        self.store(Item)
+        return {}
+
+    def update_item(self, Key, **kwargs):
+        self.calls.record('dynamodb', 'UpdateItem')
+        self.store(Key)
+        return {'Attributes': dict(Key)}
+
+    def get_item(self, Key, **kwargs):
+        self.calls.record('dynamodb', 'GetItem')
+        return {}
+
+    def query(self, **kwargs):
+        self.calls.record('dynamodb', 'Query')
+        return {'Items': []}
+
+class FakeDynamoDB:
+    def __init__(self, calls: ApiCalls):
+        self.calls = calls
+        self.tables = {}
+        self.meta = SimpleNamespace(client=FakeDynamoDBClient(calls, self.tables))
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        ## every profile is new to the benchmark tables, so nothing is returned
+        self.calls.record('dynamodb', 'BatchGetItem')
+        return {'Responses': {name: [] for name in RequestItems}}
+
+    def Table(self, name):
+        if name not in self.tables:
+            self.tables[name] = FakeTable(self.calls, name, self.meta.client)
+        return self.tables[name]
+
+class FakeStepFunctions:
+    def __init__(self, calls: ApiCalls):
+        self.calls = calls
+
+    def start_execution(self, stateMachineArn, input, **kwargs):
+        self.calls.record('stepfunctions', 'StartExecution')
+        return {'executionArn': f"{stateMachineArn}:{kwargs.get('name', 'execution')}", 'startDate': time.time()}
+
+class FakeSTS:
+    def __init__(self, calls: ApiCalls):
+        self.calls = calls
+
+    def get_caller_identity(self):
+        self.calls.record('sts', 'GetCallerIdentity')
+        return {'Account': ACCOUNT}
+
+class FakeLambda:
+    def __init__(self, calls: ApiCalls):
+        self.calls = calls
+        self.queue = []
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        self.calls.record('lambda', 'Invoke')
+        self.queue.append(json.loads(Payload))
+        return {'StatusCode': 202}
+
+class FakeContext:
+    '''Lambda context with a fixed 300 s budget per invocation.'''
+    invoked_function_arn = f"arn:aws:lambda:{REGION}:{ACCOUNT}:function:benchmark-seed"
+    log_stream_name = 'benchmark'
+
+    def __init__(self, timeout_ms: int = 300000):
+        self.deadline = time.monotonic() + timeout_ms / 1000
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.monotonic()) * 1000)
+
+def install_fakes(profiles: int, spaces: int, domains: int = 1) -> dict:
+    clients.reset()
+    calls = ApiCalls()
+    fakes = {
+        'calls': calls,
+        'sagemaker': FakeSageMaker(calls, domains, profiles, spaces),
+        'dynamodb': FakeDynamoDB(calls),
+        'stepfunctions': FakeStepFunctions(calls),
+        'sts': FakeSTS(calls),
+        'lambda': FakeLambda(calls)
+    }
+    for service in ['sagemaker', 'stepfunctions', 'sts', 'lambda']:
+        clients.register_client(service, fakes[service])
+    clients.register_resource('dynamodb', fakes['dynamodb'])
+    ## the handlers answer CloudFormation over HTTP; keep the benchmark offline
+    cfnresponse.send = lambda *args, **kwargs: None
+    return fakes
+
+def load_handler(file_name: str):
+    spec = importlib.util.spec_from_file_location(file_name.replace('-', '_')[:-3], os.path.join(SRC_DIR, file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def stream_record(sequence: int, domain_id: str, profile_name: str) -> dict:
+    image = {
+        'profile_name': {'S': profile_name},
+        'domain_name': {'S': 'domain-0'},
+        'domain_id': {'S': domain_id},
+        'user_profile_name': {'S': profile_name},
+        'space_name': {'S': ''},
+        'role_name': {'S': f"{profile_name}-role"},
+        'replication': {'BOOL': True}
+    }
+    old_image = dict(image, efs_sys_id={'S': 'fs-old'}, efs_uid={'S': '100001'})
+    new_image = dict(image, efs_sys_id={'S': 'fs-00000000'}, efs_uid={'S': '200001'})
+    return {
+        'eventID': str(sequence),
+        'eventName': 'MODIFY',
+        'eventSource': 'aws:dynamodb',
+        'awsRegion': REGION,
+        'dynamodb': {
+            'Keys': {'profile_name': {'S': profile_name}, 'domain_name': {'S': 'domain-0'}},
+            'NewImage': new_image,
+            'OldImage': old_image,
+            'SequenceNumber': str(sequence).zfill(21),
+            'StreamViewType': 'NEW_AND_OLD_IMAGES'
+        }
+    }
+
+def create_event(domain_id: str, profile_name: str) -> dict:
+    return {
+        'detail-type': 'AWS API Call via CloudTrail',
+        'source': 'aws.sagemaker',
+        'id': f"{domain_id}-{profile_name}",
+        'detail': {
+            'eventSource': 'sagemaker.amazonaws.com',
+            'eventName': 'CreateUserProfile',
+            'eventTime': '2024-01-01T00:00:00Z',
+            'awsRegion': REGION,
+            'requestParameters': {
+                'domainId': domain_id,
+                'userProfileName': profile_name,
+                'userSettings': {'executionRole': f"arn:aws:iam::{ACCOUNT}:role/{profile_name}-role"}
+            }
+        }
+    }
+
+def run_seed_table(size: int):
+    ## size is split evenly between user profiles and spaces
+    fakes = install_fakes(profiles=size - size // 2, spaces=size // 2)
+    handler = load_handler('seed-table.py')
+    queue = fakes['lambda'].queue
+    queue.append({'RequestType': 'Create', 'ResponseURL': '', 'StackId': '', 'RequestId': '', 'LogicalResourceId': ''})
+    while queue:
+        handler.lambda_handler(queue.pop(0), FakeContext())
+    return fakes['calls'], size
+
+def run_event_processor(size: int):
+    fakes = install_fakes(profiles=size, spaces=0)
+    handler = load_handler('event-processor.py')
+    for i in range(size):
+        handler.lambda_handler(create_event('d-0000', f"user-{i}"), FakeContext())
+    return fakes['calls'], size
+
+def run_event_batch_processor(size: int, batch_size: int = 100):
+    fakes = install_fakes(profiles=size, spaces=0)
+    handler = load_handler('event-processor.py')
+    for start in range(0, size, batch_size):
+        records = [{'messageId': str(i), 'body': json.dumps(create_event('d-0000', f"user-{i}"))} for i in range(start, min(size, start + batch_size))]
+        handler.batch_handler({'Records': records}, FakeContext())
+    return fakes['calls'], size
+
+def run_stream_processor(size: int, batch_size: int = 100):
+    fakes = install_fakes(profiles=size, spaces=0)
+    handler = load_handler('ddb-stream-processor.py')
+    for name in ['SOURCE_SECURITY_GROUP', 'TARGET_SECURITY_GROUP', 'SUBNET1', 'STEPFUNCTION', 'REPLICATION_STATE_TABLE']:
+        os.environ.setdefault(name, f"benchmark-{name.lower()}")
+    for start in range(0, size, batch_size):
+        records = [stream_record(i, 'd-0000', f"user-{i}") for i in range(start, min(size, start + batch_size))]
+        handler.lambda_handler({'Records': records}, FakeContext())
+    return fakes['calls'], size
+
+SCENARIOS = {
+    'seed-table': run_seed_table,
+    'event-processor': run_event_processor,
+    'event-processor-batch': run_event_batch_processor,
+    'ddb-stream-processor': run_stream_processor
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="offline throughput benchmark for the Lambda handlers in src/")
+    parser.add_argument(
+        "-sizes",
+        "--sizes",
+        dest="sizes",
+        type=lambda v: [int(s) for s in v.split(',')],
+        default=[100, 1000, 10000, 50000],
+        help="comma separated number of profiles and spaces per run"
+    )
+    parser.add_argument(
+        "-handlers",
+        "--handlers",
+        dest="handlers",
+        type=lambda v: v.split(','),
+        default=list(SCENARIOS),
+        help=f"comma separated handlers to run: {','.join(SCENARIOS)}"
+    )
+    parser.add_argument(
+        "-latency-ms",
+        "--latency-ms",
+        dest="latency_ms",
+        type=float,
+        default=0,
+        help="simulated latency of every fake API call, to exercise concurrency"
+    )
+    parser.add_argument(
+        "-skip-memory",
+        "--skip-memory",
+        dest="skip_memory",
+        action='store_true',
+        help="skip the second, tracemalloc-instrumented run that measures peak memory"
+    )
+    parser.add_argument(
+        "-json",
+        "--json",
+        dest="json",
+        action='store_true',
+        help="print one json document per run instead of a table"
+    )
+    args = parser.parse_args()
+    global LATENCY_S
+    LATENCY_S = args.latency_ms / 1000
+    if not args.json:
+        print(f"{'handler':<22}{'records':>8}{'wall s':>9}{'rec/s':>10}{'calls/rec':>11}{'peak MiB':>10}  top calls")
+    for name in args.handlers:
+        for size in args.sizes:
+            ## time an untraced run; tracemalloc slows allocation-heavy code several times over
+            start = time.perf_counter()
+            calls, records = SCENARIOS[name](size)
+            wall = time.perf_counter() - start
+            peak = None
+            if not args.skip_memory:
+                tracemalloc.start()
+                SCENARIOS[name](size)
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+            result = {
+                "handler": name,
+                "records": records,
+                "wall_s": round(wall, 3),
+                "records_per_s": round(records / wall, 1) if wall else None,
+                "calls_per_record": round(calls.total() / records, 3),
+                "peak_mib": round(peak / 2 ** 20, 2) if peak is not None else None,
+                "calls": dict(calls.counts)
+            }
+            if args.json:
+                print(json.dumps(result))
+                continue
+            top = ', '.join(f"{op} {n}" for op, n in calls.counts.most_common(3))
+            print(f"{name:<22}{records:>8}{result['wall_s']:>9.2f}{result['records_per_s']:>10.0f}{result['calls_per_record']:>11.2f}{result['peak_mib'] if peak is not None else '-':>10}  {top}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,446 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import argparse
+import importlib.util
+import json
+import os
+import re
+import sys
+import time
+import uuid
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Infrastructure', 'Templates', 'stepfunction.yaml')
+sys.path.insert(0, SRC_DIR)
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+from botocore.exceptions import ClientError
+from common import clients
+
+ACCOUNT = '123456789012'
+REGION = os.environ['AWS_DEFAULT_REGION']
+TABLE = 'studioReplicationState'
+## the states of the completion path, taken from the template as they are
+CALLBACK_STATES = ['WaitForTaskEnd', 'Is_running', 'Is_still_running', 'Result']
+
+def load_definition(template: str = TEMPLATE) -> dict:
+    with open(template) as f:
+        text = f.read()
+    start = text.index('DefinitionString: !Sub |\n') + len('DefinitionString: !Sub |\n')
+    end = text.index('RoleArn: !GetAtt Role.Arn')
+    body = text[start:end]
+    for name, value in [('${ReplicationStateTableName}', TABLE), ('${AWS::Region}', REGION), ('${AWS::AccountId}', ACCOUNT)]:
+        body = body.replace(name, value)
+    ## numeric template parameters are substituted unquoted; use their defaults
+    defaults = dict(re.findall(r'^  (\w+):\n    Type: Number\n(?:    .*\n)*?    Default: (\d+)', text, re.M))
+    body = re.sub(r'\$\{(\w+)\}', lambda m: defaults.get(m.group(1), m.group(0)), body)
+    return json.loads(body)
+
+def completion_machine(definition: dict, describe_result: dict) -> dict:
+    '''
+    The template's completion path with everything around it stubbed: polling returns
+    describe_result after a 1 second wait, success and failure end the execution.
+    '''
+    states = {name: definition['States'][name] for name in CALLBACK_STATES}
+    states['Wait-TaskEnd'] = {"Type": "Wait", "Seconds": 1, "Next": "DescribeTaskExecution"}
+    states['DescribeTaskExecution'] = {"Type": "Pass", "Result": describe_result, "ResultPath": "$.Result", "Next": "Is_running"}
+    states['RecheckTaskEnd'] = {"Type": "Pass", "Result": describe_result, "ResultPath": "$.Result", "Next": "Is_still_running"}
+    states['DynamoDB UpdateItem'] = {"Type": "Succeed"}
+    states['SQS SendMessage'] = {"Type": "Fail", "Error": "ReplicationFailed"}
+    return {"StartAt": "WaitForTaskEnd", "States": states}
+
+def load_handler(name: str = 'datasync-event-processor'):
+    path = os.path.join(SRC_DIR, f"{name}.py")
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def datasync_event(execution_arn: str, state: str) -> dict:
+    ## what EventBridge delivers for a DataSync task execution state change
+    return {
+        'version': '0',
+        'id': str(uuid.uuid4()),
+        'detail-type': 'DataSync Task Execution State Change',
+        'source': 'aws.datasync',
+        'account': ACCOUNT,
+        'region': REGION,
+        'resources': [execution_arn],
+        'detail': {'State': state}
+    }
+
+def create_app_event(domain_id: str, owner: str) -> dict:
+    ## the CloudTrail CreateApp call of a user profile's JupyterServer app
+    return {
+        'version': '0',
+        'id': str(uuid.uuid4()),
+        'detail-type': 'AWS API Call via CloudTrail',
+        'source': 'aws.sagemaker',
+        'account': ACCOUNT,
+        'region': REGION,
+        'detail': {
+            'eventSource': 'sagemaker.amazonaws.com',
+            'eventName': 'CreateApp',
+            'requestParameters': {'domainId': domain_id, 'userProfileName': owner, 'appType': 'JupyterServer', 'appName': 'default'}
+        }
+    }
+
+class FakeDataSync:
+    def __init__(self, status: str):
+        self.status = status
+
+    def describe_task_execution(self, TaskExecutionArn):
+        return {
+            'TaskExecutionArn': TaskExecutionArn,
+            'Status': self.status,
+            'BytesWritten': 1024,
+            'FilesTransferred': 3,
+            'Result': {'TotalDuration': 1500, 'TransferStatus': self.status}
+        }
+
+class FakeStateTable:
+    '''Conditional put/delete semantics of the replication state table for the two writers.'''
+    def __init__(self, name: str = TABLE):
+        self.name = name
+        self.items = {}
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeNames=None, **kwargs):
+        existing = self.items.get(Item['pk'])
+        ## claim() accepts an expired record, the state machine's put (a condition string) does not
+        expired = existing is not None and 'expires_at' in existing and existing['expires_at'] < time.time() \
+            and not isinstance(ConditionExpression, str)
+        if existing is not None and not expired and not self.holds(existing, ConditionExpression, ExpressionAttributeNames):
+            raise ClientError({
+                'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'The conditional request failed'},
+                'Item': {k: {'S': str(v)} for k, v in existing.items()}
+            }, 'PutItem')
+        self.items[Item['pk']] = dict(Item)
+        return {}
+
+    def holds(self, existing: dict, condition, names: dict = None) -> bool:
+        ## "attribute_exists(x) OR ..." terms of a condition string against an existing item
+        if not isinstance(condition, str):
+            return False
+        for term in condition.split(' OR '):
+            function, name = term.strip().rstrip(')').split('(')
+            name = (names or {}).get(name, name)
+            if (function == 'attribute_exists') == (name in existing):
+                return True
+        return False
+
+    def get_item(self, Key, **kwargs):
+        item = self.items.get(Key['pk'])
+        return {'Item': dict(item)} if item else {}
+
+    def delete_item(self, Key):
+        self.items.pop(Key['pk'], None)
+        return {}
+
+class FakeDynamoDB:
+    def __init__(self):
+        self.table = FakeStateTable()
+
+    def Table(self, name):
+        return self.table
+
+class FakeStepFunctions:
+    def __init__(self, timed_out: bool = False):
+        self.sent = []
+        self.timed_out = timed_out
+
+    def send_task_success(self, taskToken, output):
+        if self.timed_out:
+            raise ClientError({'Error': {'Code': 'TaskTimedOut', 'Message': 'Task Timed Out'}}, 'SendTaskSuccess')
+        self.sent.append((taskToken, json.loads(output)))
+        return {}
+
+def machine_waits(definition: dict, table: FakeStateTable, execution_arn: str, token: str) -> bool:
+    ## what WaitForTaskEnd does: store the token with the template's key and condition
+    parameters = definition['States']['WaitForTaskEnd']['Parameters']
+    prefix = parameters['Item']['pk']['S.$'].split("'")[1].replace('{}', '')
+    item = {'pk': prefix + execution_arn, 'token': token, 'execution': 'local'}
+    if 'expires_at' in parameters['Item']:
+        item['expires_at'] = int(time.time()) + 3600
+    try:
+        table.put_item(
+            Item=item,
+            ConditionExpression=parameters['ConditionExpression'],
+            ExpressionAttributeNames=parameters.get('ExpressionAttributeNames')
+        )
+    except ClientError:
+        return False
+    return True
+
+def app_wait_key(definition: dict, domain_id: str, owner: str) -> str:
+    ## what InitUserAppWait computes
+    fmt = definition['States']['InitUserAppWait']['Parameters']['Key.$'].split("'")[1]
+    return fmt.format(domain_id, owner)
+
+def app_wait_schedule(definition: dict, checks: int) -> list:
+    ## the waits between app checks, following the template's Pass states
+    states = definition['States']
+    seconds = states['InitUserAppWait']['Parameters']['Seconds']
+    ceiling = states['MaxAppWait']['Parameters']['Seconds']
+    deadline = states['AppNotReady']['Choices'][2]['NumericGreaterThanEquals']
+    waits, elapsed = [], 0
+    while len(waits) < checks and elapsed < deadline:
+        waits.append(seconds)
+        elapsed, seconds = elapsed + seconds, min(seconds * 2, ceiling)
+    return waits
+
+def walk_app_wait(definition: dict, error: str, steps: int = 10000) -> tuple:
+    '''
+    Follows the template's app wait states for a user profile whose app never starts, with every
+    WaitForApp ending in error. Returns (seconds of real waiting, ListApps calls) at AppReadyDeadline.
+    '''
+    states = definition['States']
+    data = {'Target': {'UserProfileName': 'user-a'}}
+
+    def value(expr):
+        if expr.startswith('States.MathAdd('):
+            return sum(value(arg.strip()) for arg in expr[len('States.MathAdd('):-1].split(','))
+        if expr.startswith('$.'):
+            node = data
+            for part in expr[2:].split('.'):
+                node = node[part]
+            return node
+        return expr
+
+    def present(path):
+        try:
+            value(path)
+        except KeyError:
+            return False
+        return True
+
+    def holds(choice):
+        if 'And' in choice:
+            return all(holds(c) for c in choice['And'])
+        if 'IsPresent' in choice:
+            return present(choice['Variable']) == choice['IsPresent']
+        if 'NumericGreaterThanEquals' in choice:
+            return value(choice['Variable']) >= choice['NumericGreaterThanEquals']
+        if 'NumericGreaterThan' in choice:
+            return value(choice['Variable']) > choice['NumericGreaterThan']
+        raise ValueError(f"unsupported choice {choice}")
+
+    slept, checks, name = 0, 0, 'InitUserAppWait'
+    for _ in range(steps):
+        if name == 'AppReadyDeadline':
+            return slept, checks
+        state = states[name]
+        if name == 'ListApps':
+            checks, name = checks + 1, 'AppNotReady'
+        elif state['Type'] == 'Pass':
+            data['AppWait'] = {k[:-2] if k.endswith('.$') else k: value(v) if k.endswith('.$') else v
+                               for k, v in state['Parameters'].items()}
+            name = state['Next']
+        elif state['Type'] == 'Choice':
+            name = next((c['Next'] for c in state['Choices'] if holds(c)), state.get('Default'))
+        elif state['Type'] == 'Wait':
+            slept += value(state['SecondsPath'])
+            name = state['Next']
+        elif name == 'WaitForApp':
+            if error == 'States.Timeout':
+                slept += data['AppWait']['Seconds']
+            name = next(c['Next'] for c in state['Catch'] if error in c['ErrorEquals'] or 'States.ALL' in c['ErrorEquals'])
+        else:
+            raise ValueError(f"unexpected state {name}")
+    raise RuntimeError(f"no deadline after {steps} states")
+
+def run_app_fake(definition: dict) -> list:
+    '''
+    The CreateApp wake-up against in-memory fakes, and the fallback polling schedule.
+    '''
+    handler = load_handler('app-event-processor')
+    results = []
+    key = app_wait_key(definition, 'd-0', 'user-a')
+
+    def setup(timed_out: bool = False):
+        ddb, sfn = FakeDynamoDB(), FakeStepFunctions(timed_out)
+        clients.reset()
+        clients.register_resource('dynamodb', ddb)
+        clients.register_client('stepfunctions', sfn)
+        return ddb.table, sfn
+
+    table, sfn = setup()
+    table.put_item(Item={'pk': key, 'token': 'app-token-1', 'execution': 'local'})
+    outcome = handler.lambda_handler(create_app_event('d-0', 'user-a'), None)
+    ok = outcome == 'woken' and sfn.sent and sfn.sent[0][1]['AppEvent'] == 'CreateApp' and not table.items
+    results.append(('CreateApp wakes the waiting execution', ok, outcome))
+
+    table, sfn = setup()
+    outcome = handler.lambda_handler(create_app_event('d-0', 'user-a'), None)
+    ok = outcome == 'ignored' and not sfn.sent
+    results.append(('CreateApp without a waiting execution is ignored', ok, outcome))
+
+    table, sfn = setup(timed_out=True)
+    table.put_item(Item={'pk': key, 'token': 'app-token-2', 'execution': 'local'})
+    outcome = handler.lambda_handler(create_app_event('d-0', 'user-a'), None)
+    ok = outcome == 'ignored' and not table.items
+    results.append(('stale token of a timed out wait is dropped', ok, outcome))
+
+    waits = app_wait_schedule(definition, 1000)
+    ok = waits == sorted(waits) and max(waits) <= definition['States']['MaxAppWait']['Parameters']['Seconds'] and len(waits) < 1000
+    results.append(('fallback polling backs off and stops at the deadline', ok, f"{len(waits)} checks, waits {waits[:8]}..."))
+
+    deadline = definition['States']['AppNotReady']['Choices'][2]['NumericGreaterThanEquals']
+    for error in ['States.Timeout', 'States.TaskFailed']:
+        slept, checks = walk_app_wait(definition, error)
+        ok = deadline <= slept and checks == len(waits)
+        results.append((f"waits ending in {error} reach the deadline in real time", ok, f"{checks} checks over {slept}s"))
+    clients.reset()
+    return results
+
+def run_fake(definition: dict) -> list:
+    '''
+    Every ordering of "state machine starts waiting" and "completion event arrives" against in-memory
+    fakes. Returns (scenario, ok, detail) tuples.
+    '''
+    handler = load_handler()
+    results = []
+    arn = f"arn:aws:datasync:{REGION}:{ACCOUNT}:task/task-0/execution/exec-"
+
+    def setup(status: str):
+        ddb, sfn = FakeDynamoDB(), FakeStepFunctions()
+        clients.reset()
+        clients.register_resource('dynamodb', ddb)
+        clients.register_client('stepfunctions', sfn)
+        clients.register_client('datasync', FakeDataSync(status))
+        return ddb.table, sfn
+
+    table, sfn = setup('SUCCESS')
+    waiting = machine_waits(definition, table, arn + '1', 'token-1')
+    outcome = handler.lambda_handler(datasync_event(arn + '1', 'SUCCESS'), None)
+    ok = waiting and outcome == 'resumed' and sfn.sent and sfn.sent[0][1]['Status'] == 'SUCCESS' and not table.items
+    results.append(('token stored before completion', ok, outcome))
+
+    table, sfn = setup('ERROR')
+    machine_waits(definition, table, arn + '2', 'token-2')
+    outcome = handler.lambda_handler(datasync_event(arn + '2', 'ERROR'), None)
+    ok = outcome == 'resumed' and sfn.sent and sfn.sent[0][1]['Status'] == 'ERROR'
+    results.append(('failed transfer resumes with ERROR', ok, outcome))
+
+    table, sfn = setup('SUCCESS')
+    outcome = handler.lambda_handler(datasync_event(arn + '3', 'SUCCESS'), None)
+    waiting = machine_waits(definition, table, arn + '3', 'token-3')
+    ok = outcome == 'marked' and not waiting and not sfn.sent
+    results.append(('completion before token falls back to polling', ok, outcome))
+
+    table, sfn = setup('SUCCESS')
+    machine_waits(definition, table, arn + '4', 'token-4')
+    handler.lambda_handler(datasync_event(arn + '4', 'SUCCESS'), None)
+    outcome = handler.lambda_handler(datasync_event(arn + '4', 'SUCCESS'), None)
+    ok = len(sfn.sent) == 1
+    results.append(('duplicate completion event resumes once', ok, outcome))
+
+    table, sfn = setup('SUCCESS')
+    machine_waits(definition, table, arn + '6', 'token-6')
+    parked = machine_waits(definition, table, arn + '6', 'token-7')
+    outcome = handler.lambda_handler(datasync_event(arn + '6', 'SUCCESS'), None)
+    ok = parked and outcome == 'resumed' and [t for t, _ in sfn.sent] == ['token-7']
+    results.append(('timed out wait parks again with a fresh token', ok, outcome))
+
+    items = [definition['States'][name]['Parameters']['Item'] for name in ['WaitForTaskEnd', 'WaitForApp']]
+    ok = all('expires_at' in item and '$.ExpiresAt' in item['expires_at'].get('N.$', '') for item in items)
+    results.append(('token items expire with the input\'s ExpiresAt', ok, [item.get('expires_at') for item in items]))
+
+    table, sfn = setup('SUCCESS')
+    outcome = handler.lambda_handler(datasync_event(arn + '5', 'TRANSFERRING'), None)
+    ok = outcome == 'ignored' and not table.items
+    results.append(('intermediate state is ignored', ok, outcome))
+    clients.reset()
+    return results
+
+def run_local(definition: dict, sfn_endpoint: str, ddb_endpoint: str, timeout: int) -> list:
+    '''
+    The completion path on Step Functions Local, with its DynamoDB calls pointed at DynamoDB Local.
+    The handler runs in-process with a fake DataSync client and real clients for both local endpoints.
+    '''
+    import boto3
+    handler = load_handler()
+    session = dict(region_name=REGION, aws_access_key_id='local', aws_secret_access_key='local')
+    sfn = boto3.client('stepfunctions', endpoint_url=sfn_endpoint, **session)
+    ddb = boto3.resource('dynamodb', endpoint_url=ddb_endpoint, **session)
+    try:
+        ddb.create_table(
+            TableName=TABLE,
+            KeySchema=[{'AttributeName': 'pk', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'pk', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        ).wait_until_exists()
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ResourceInUseException':
+            raise
+    clients.reset()
+    clients.register_resource('dynamodb', ddb)
+    clients.register_client('stepfunctions', sfn)
+    results = []
+    for scenario, status, event_first in [('token stored before completion', 'SUCCESS', False),
+                                          ('failed transfer resumes with ERROR', 'ERROR', False),
+                                          ('completion before token falls back to polling', 'SUCCESS', True)]:
+        clients.register_client('datasync', FakeDataSync(status))
+        execution_arn = f"arn:aws:datasync:{REGION}:{ACCOUNT}:task/task-0/execution/exec-{uuid.uuid4().hex[:17]}"
+        machine = sfn.create_state_machine(
+            name=f"callback-{uuid.uuid4().hex[:8]}",
+            definition=json.dumps(completion_machine(definition, FakeDataSync(status).describe_task_execution(execution_arn))),
+            roleArn=f"arn:aws:iam::{ACCOUNT}:role/DummyRole"
+        )
+        if event_first:
+            handler.lambda_handler(datasync_event(execution_arn, status), None)
+        execution = sfn.start_execution(
+            stateMachineArn=machine['stateMachineArn'],
+            input=json.dumps({'Task': {'TaskExecutionArn': execution_arn}, 'ExpiresAt': int(time.time()) + 3600})
+        )
+        deadline = time.time() + timeout
+        if not event_first:
+            ## the fake event source fires once the execution is parked on its token
+            while time.time() < deadline and 'Item' not in ddb.Table(TABLE).get_item(Key={'pk': f"execution#{execution_arn}"}):
+                time.sleep(0.5)
+            handler.lambda_handler(datasync_event(execution_arn, status), None)
+        while time.time() < deadline:
+            described = sfn.describe_execution(executionArn=execution['executionArn'])
+            if described['status'] != 'RUNNING':
+                break
+            time.sleep(0.5)
+        expected = 'SUCCEEDED' if status == 'SUCCESS' else 'FAILED'
+        results.append((scenario, described['status'] == expected, described['status']))
+    clients.reset()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="check the DataSync completion callback and the CreateApp wake-up against a fake event source")
+    parser.add_argument(
+        "-sfn-endpoint",
+        "--sfn-endpoint",
+        dest="sfn_endpoint",
+        type=str,
+        help="Step Functions Local endpoint, e.g. http://localhost:8083; in-memory fakes when omitted"
+    )
+    parser.add_argument(
+        "-ddb-endpoint",
+        "--ddb-endpoint",
+        dest="ddb_endpoint",
+        type=str,
+        default='http://localhost:8000',
+        help="DynamoDB Local endpoint that Step Functions Local is configured with"
+    )
+    parser.add_argument(
+        "-timeout",
+        "--timeout",
+        dest="timeout",
+        type=int,
+        default=60
+    )
+    args = parser.parse_args()
+    definition = load_definition()
+    if args.sfn_endpoint:
+        results = run_local(definition, args.sfn_endpoint, args.ddb_endpoint, args.timeout)
+    else:
+        results = run_fake(definition) + run_app_fake(definition)
+    for scenario, ok, detail in results:
+        print(f"{'ok  ' if ok else 'FAIL'} {scenario} ({detail})")
+    sys.exit(0 if all(ok for _, ok, _ in results) else 1)
+
+if __name__ == '__main__':
+    main()
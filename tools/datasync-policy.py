@@ -0,0 +1,117 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import argparse
+import itertools
+import json
+import os
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_DIR)
+
+from common import datasync_policy as policy
+
+LOG_LEVELS = ['OFF', 'BASIC', 'TRANSFER']
+
+def sample_facts():
+    ## around every threshold the rules use, for every tier
+    sizes = [None, 0, policy.LARGE_BYTES - 1, policy.LARGE_BYTES, 10 * policy.LARGE_BYTES]
+    files = [None, 0, policy.MANY_FILES - 1, policy.MANY_FILES, policy.HUGE_FILES - 1, policy.HUGE_FILES, 10 * policy.HUGE_FILES]
+    for b, f, tier in itertools.product(sizes, files, [None, 'standard', 'bulk', 'priority']):
+        yield {"bytes": b, "files": f, "tier": tier}
+
+def stream_record(facts: dict, overrides: dict = None) -> dict:
+    new = {}
+    if facts.get('bytes') is not None:
+        new['bytes_written'] = {'S': str(facts['bytes'])}
+    if facts.get('files') is not None:
+        new['files_transferred'] = {'S': str(facts['files'])}
+    if facts.get('tier'):
+        new['replication_tier'] = {'S': facts['tier']}
+    if overrides:
+        new['datasync_options'] = {'M': {k: {'N': str(v)} if isinstance(v, int) else {'S': v} for k, v in overrides.items()}}
+    return {'eventName': 'MODIFY', 'dynamodb': {'NewImage': new, 'OldImage': {}}}
+
+def check() -> list:
+    '''
+    Every rule sets only values DataSync accepts, every decision is complete and valid, more files
+    never mean more verbose logs within a tier, overrides always win and survive the stream image
+    round trip. Returns the failures.
+    '''
+    failures = []
+    for rule in policy.RULES:
+        for name, value in rule['set'].items():
+            if not policy.valid(name, value):
+                failures.append(f"rule {rule['name']} sets invalid {name}={value}")
+    decisions = {}
+    for facts in sample_facts():
+        options, applied = policy.decide(facts)
+        decisions[(facts['bytes'], facts['files'], facts['tier'])] = options
+        for name, value in options.items():
+            if not policy.valid(name, value):
+                failures.append(f"{facts}: invalid {name}={value} from {applied}")
+        if set(options) < set(policy.BASE_OPTIONS):
+            failures.append(f"{facts}: options incomplete")
+        record_facts, _ = policy.facts_from_record(stream_record(facts))
+        if record_facts != facts:
+            failures.append(f"{facts}: read back from a stream record as {record_facts}")
+    for (b, f, tier), options in decisions.items():
+        for (b2, f2, tier2), options2 in decisions.items():
+            if b == b2 and tier == tier2 and f is not None and f2 is not None and f2 > f \
+                    and LOG_LEVELS.index(options2['LogLevel']) > LOG_LEVELS.index(options['LogLevel']):
+                failures.append(f"more files, more logs: {f}->{options['LogLevel']} {f2}->{options2['LogLevel']} (tier {tier})")
+    override = {"LogLevel": 'OFF', "BytesPerSecond": 1048576, "VerifyMode": 'bogus'}
+    for facts in sample_facts():
+        options, applied = policy.decide(*policy.facts_from_record(stream_record(facts, override)))
+        if options['LogLevel'] != 'OFF' or options['BytesPerSecond'] != 1048576 or options['VerifyMode'] == 'bogus' or applied[-1] != 'override':
+            failures.append(f"{facts}: override not applied: {options}")
+    ## DataSync rejects REMOVE with TransferMode ALL and accepts it with CHANGED
+    for mode, expected in [('ALL', 'PRESERVE'), ('CHANGED', 'REMOVE')]:
+        override = {"PreserveDeletedFiles": 'REMOVE', "TransferMode": mode}
+        for facts in sample_facts():
+            options, _ = policy.decide(*policy.facts_from_record(stream_record(facts, override)))
+            if options.get('PreserveDeletedFiles') != expected or options['TransferMode'] != mode:
+                failures.append(f"{facts}: TransferMode {mode} with REMOVE gave {options.get('PreserveDeletedFiles')}, expected {expected}")
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description="show and check the DataSync option rules of common.datasync_policy")
+    parser.add_argument(
+        "-check",
+        "--check",
+        dest="check",
+        action='store_true',
+        help="verify the rules over every combination of size, file count and tier around their thresholds"
+    )
+    parser.add_argument(
+        "-facts",
+        "--facts",
+        dest="facts",
+        type=str,
+        help='one decision, e.g. \'{"bytes": 1099511627776, "files": 2000000, "tier": "bulk"}\''
+    )
+    parser.add_argument(
+        "-overrides",
+        "--overrides",
+        dest="overrides",
+        type=str,
+        help="the profile's datasync_options as JSON"
+    )
+    args = parser.parse_args()
+    if args.check:
+        failures = check()
+        for failure in failures:
+            print(failure)
+        if not failures:
+            print(f"ok: {len(policy.RULES)} rules, {len(list(sample_facts()))} sample profiles")
+        sys.exit(1 if failures else 0)
+    overrides = json.loads(args.overrides) if args.overrides else None
+    samples = [json.loads(args.facts)] if args.facts else sample_facts()
+    print(f"{'bytes':>15}  {'files':>9}  {'tier':<9}  {'LogLevel':<8}  {'VerifyMode':<24}  {'BytesPerSecond':>14}  rules")
+    for facts in samples:
+        options, applied = policy.decide(facts, overrides)
+        print(f"{str(facts.get('bytes')):>15}  {str(facts.get('files')):>9}  {str(facts.get('tier')):<9}  {options['LogLevel']:<8}  "
+              f"{options['VerifyMode']:<24}  {str(options.get('BytesPerSecond', '-')):>14}  {', '.join(applied)}")
+
+if __name__ == '__main__':
+    main()
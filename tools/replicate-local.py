@@ -0,0 +1,256 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import argparse
+import asyncio
+import json
+import os
+import sys
+import uuid
+from collections import Counter
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_DIR)
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+from botocore.exceptions import ClientError, EndpointConnectionError, ParamValidationError
+from common import datasync_cache
+from common.replication_engine import ReplicationEngine
+
+ACCOUNT = '123456789012'
+REGION = os.environ['AWS_DEFAULT_REGION']
+
+def error(code: str, operation: str) -> ClientError:
+    return ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+def replication_input(index: int, space: bool = False) -> dict:
+    ## what ddb-stream-processor starts the state machine with
+    def endpoint(efs, domain):
+        return {
+            "DomainID": domain,
+            "DomainName": f"{domain}-name",
+            "EfsFilesystemArn": f"arn:aws:elasticfilesystem:{REGION}:{ACCOUNT}:file-system/{efs}",
+            "HomeEfsFileSystemUid": str(200000 + index),
+            "SubnetArn": f"arn:aws:ec2:{REGION}:{ACCOUNT}:subnet/subnet-0",
+            "SecurityGroupArns": [f"arn:aws:ec2:{REGION}:{ACCOUNT}:security-group/sg-0"]
+        }
+    input = {
+        "Options": {"Gid": 'NONE', "LogLevel": "TRANSFER", "OverwriteMode": "ALWAYS", "PosixPermissions": "NONE", "TransferMode": "CHANGED", "Uid": "NONE"},
+        "Log": {"CloudWatchLogGroupArn": f"arn:aws:logs:{REGION}:{ACCOUNT}:log-group:/aws/datasync:*"},
+        "Source": endpoint('fs-old', 'd-old'),
+        "Target": endpoint('fs-new', 'd-new')
+    }
+    name = "SpaceName" if space else "UserProfileName"
+    input["Source"][name] = input["Target"][name] = f"{'space' if space else 'user'}-{index}"
+    return input
+
+class FakeSageMaker:
+    def __init__(self, checks_until_ready: int = 2, never_ready: set = (), errors: dict = None):
+        self.checks = Counter()
+        ## owner -> exception raised by every ListApps for it
+        self.errors = errors or {}
+        self.checks_until_ready = checks_until_ready
+        self.never_ready = set(never_ready)
+
+    def list_apps(self, DomainIdEquals, MaxResults, UserProfileNameEquals=None, SpaceNameEquals=None):
+        owner = UserProfileNameEquals or SpaceNameEquals
+        self.checks[owner] += 1
+        if owner in self.errors:
+            raise self.errors[owner]
+        if owner in self.never_ready or self.checks[owner] < self.checks_until_ready:
+            return {'Apps': [{'Status': 'Pending'}] if self.checks[owner] > 1 else []}
+        return {'Apps': [{'Status': 'InService'}]}
+
+class FakeDataSync:
+    def __init__(self, polls_until_done: int = 3, failing: set = (), flaky_creates: int = 0):
+        self.calls = Counter()
+        self.tasks = {}
+        self.includes = {}
+        self.executions = {}
+        self.polls_until_done = polls_until_done
+        self.failing = set(failing)
+        self.flaky_creates = flaky_creates
+
+    def create_location_efs(self, Ec2Config, EfsFilesystemArn, Subdirectory):
+        self.calls['CreateLocationEfs'] += 1
+        if self.flaky_creates:
+            self.flaky_creates -= 1
+            raise error('DataSyncException', 'CreateLocationEfs')
+        return {'LocationArn': f"arn:aws:datasync:{REGION}:{ACCOUNT}:location/loc-{uuid.uuid4().hex[:17]}"}
+
+    def create_task(self, CloudWatchLogGroupArn, DestinationLocationArn, SourceLocationArn, Options, Includes=None):
+        self.calls['CreateTask'] += 1
+        arn = f"arn:aws:datasync:{REGION}:{ACCOUNT}:task/task-{uuid.uuid4().hex[:17]}"
+        self.tasks[arn] = DestinationLocationArn
+        self.includes[arn] = Includes
+        return {'TaskArn': arn}
+
+    def start_task_execution(self, TaskArn, OverrideOptions):
+        self.calls['StartTaskExecution'] += 1
+        if TaskArn not in self.tasks:
+            raise error('InvalidRequestException', 'StartTaskExecution')
+        arn = f"{TaskArn}/execution/exec-{uuid.uuid4().hex[:17]}"
+        self.executions[arn] = [0, TaskArn]
+        return {'TaskExecutionArn': arn}
+
+    def describe_task_execution(self, TaskExecutionArn):
+        self.calls['DescribeTaskExecution'] += 1
+        execution = self.executions[TaskExecutionArn]
+        execution[0] += 1
+        if execution[0] < self.polls_until_done:
+            return {'TaskExecutionArn': TaskExecutionArn, 'Status': 'TRANSFERRING'}
+        status = 'ERROR' if execution[1] in self.failing else 'SUCCESS'
+        return {
+            'TaskExecutionArn': TaskExecutionArn,
+            'Status': status,
+            'BytesWritten': 1024,
+            'FilesTransferred': 3,
+            'Result': {'TotalDuration': 1500, 'TransferStatus': status}
+        }
+
+class FakeState:
+    '''The ReplicationState methods the engine and datasync_cache use.'''
+    def __init__(self):
+        self.items = {}
+
+    def put(self, key, attributes):
+        self.items[key] = dict(attributes, pk=key)
+
+    def release(self, key):
+        self.items.pop(key, None)
+
+    def get_many(self, keys):
+        return {key: self.items[key] for key in keys if key in self.items}
+
+class FakeUsersTable:
+    def __init__(self):
+        self.updates = []
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues):
+        self.updates.append((Key, ExpressionAttributeValues))
+        return {}
+
+class FakeSQS:
+    def __init__(self):
+        self.messages = []
+
+    def send_message(self, QueueUrl, MessageBody):
+        self.messages.append(json.loads(MessageBody))
+        return {'MessageId': str(uuid.uuid4())}
+
+class VirtualClock:
+    ## the engine's waits add up here instead of passing
+    def __init__(self):
+        self.seconds = 0
+
+    async def sleep(self, seconds):
+        self.seconds += seconds
+        await asyncio.sleep(0)
+
+def engine(sm=None, datasync=None, state=None, concurrency: int = 10, replications: int = None):
+    parts = {
+        'sm': sm or FakeSageMaker(),
+        'datasync': datasync or FakeDataSync(),
+        'state': state if state is not None else FakeState(),
+        'users': FakeUsersTable(),
+        'sqs': FakeSQS(),
+        'clock': VirtualClock()
+    }
+    parts['engine'] = ReplicationEngine(
+        sm_client=parts['sm'],
+        datasync_client=parts['datasync'],
+        users_table=parts['users'],
+        state=parts['state'],
+        sqs_client=parts['sqs'],
+        failure_queue_url='https://sqs.local/failures',
+        max_concurrency=concurrency,
+        max_replications=replications or concurrency * 5,
+        sleep=parts['clock'].sleep
+    )
+    return parts
+
+def run_scenarios(size: int, concurrency: int) -> list:
+    results = []
+
+    parts = engine(concurrency=concurrency)
+    inputs = [replication_input(i, space=i % 2 == 1) for i in range(size)]
+    outcome = asyncio.run(parts['engine'].run(inputs))
+    ok = all(r['Status'] == 'SUCCEEDED' for r in outcome) and len(parts['users'].updates) == size \
+        and parts['engine'].peak_in_flight == min(size, concurrency)
+    results.append((f"{size} replications under a cap of {concurrency}", ok,
+                    f"peak in flight {parts['engine'].peak_in_flight}, calls {dict(parts['datasync'].calls)}"))
+
+    ## apps that take long to start: the replications waiting for them stay under their own cap
+    parts = engine(sm=FakeSageMaker(checks_until_ready=6), concurrency=concurrency, replications=concurrency * 2)
+    outcome = asyncio.run(parts['engine'].run([replication_input(i) for i in range(size)]))
+    ok = all(r['Status'] == 'SUCCEEDED' for r in outcome) and parts['engine'].peak_replicating == min(size, concurrency * 2) \
+        and parts['engine'].peak_in_flight <= concurrency
+    results.append((f"{size} slow apps under a cap of {concurrency * 2} replications", ok,
+                    f"peak replicating {parts['engine'].peak_replicating}, peak in flight {parts['engine'].peak_in_flight}"))
+
+    parts = engine(concurrency=concurrency)
+    asyncio.run(parts['engine'].run([replication_input(i) for i in range(3)]))
+    state = parts['state']
+    parts = engine(state=state, datasync=parts['datasync'], concurrency=concurrency)
+    inputs = [dict(replication_input(i), Cache=datasync_cache.lookup(replication_input(i), state)) for i in range(3)]
+    before = Counter(parts['datasync'].calls)
+    outcome = asyncio.run(parts['engine'].run(inputs))
+    created = parts['datasync'].calls['CreateTask'] - before['CreateTask'] + parts['datasync'].calls['CreateLocationEfs'] - before['CreateLocationEfs']
+    ok = all(r['Status'] == 'SUCCEEDED' for r in outcome) and created == 0
+    results.append(('repeat replications reuse cached locations and tasks', ok, f"{created} resources created"))
+
+    parts = engine(state=state)
+    outcome = asyncio.run(parts['engine'].run([dict(replication_input(0), Cache=datasync_cache.lookup(replication_input(0), state))]))
+    ok = outcome[0]['Status'] == 'SUCCEEDED' and parts['datasync'].calls['CreateTask'] == 1
+    results.append(('a cached task that is gone is created again', ok, dict(parts['datasync'].calls)))
+
+    parts = engine(sm=FakeSageMaker(never_ready={'user-0'}))
+    outcome = asyncio.run(parts['engine'].run([replication_input(0)]))
+    ok = outcome[0]['Status'] == 'FAILED' and outcome[0]['Error']['State'] == 'AppReadyDeadline' and len(parts['sqs'].messages) == 1
+    results.append(('an app that never starts fails at the deadline', ok, f"{parts['sm'].checks['user-0']} checks over {parts['clock'].seconds}s"))
+
+    errors = {'user-1': EndpointConnectionError(endpoint_url='https://api.sagemaker.local'),
+              'user-2': ParamValidationError(report='Invalid type for parameter DomainIdEquals')}
+    parts = engine(sm=FakeSageMaker(errors=errors))
+    outcome = asyncio.run(parts['engine'].run([replication_input(i) for i in range(4)]))
+    ok = [r['Status'] for r in outcome] == ['SUCCEEDED', 'FAILED', 'FAILED', 'SUCCEEDED'] \
+        and len(parts['sqs'].messages) == 2 and len(parts['users'].updates) == 2
+    results.append(('connection and validation errors fail only their replication', ok, [r.get('Error', {}).get('State') for r in outcome]))
+
+    parts = engine(datasync=FakeDataSync(flaky_creates=3))
+    outcome = asyncio.run(parts['engine'].run([replication_input(0)]))
+    ok = outcome[0]['Status'] == 'SUCCEEDED' and parts['datasync'].calls['CreateLocationEfs'] == 5
+    results.append(('DataSyncException on create is retried', ok, dict(parts['datasync'].calls)))
+
+    datasync = FakeDataSync()
+    datasync.failing = type('Every', (), {'__contains__': lambda self, item: True})()
+    parts = engine(datasync=datasync)
+    outcome = asyncio.run(parts['engine'].run([replication_input(0)]))
+    ok = outcome[0]['Status'] == 'FAILED' and outcome[0]['Error']['State'] == 'Result' \
+        and not parts['users'].updates and parts['sqs'].messages[0]['Result']['Status'] == 'ERROR'
+    results.append(('a failed transfer is reported, not recorded', ok, outcome[0]['Error']))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="run the in-process replication engine against in-memory fakes")
+    parser.add_argument(
+        "-size",
+        "--size",
+        dest="size",
+        type=int,
+        default=200
+    )
+    parser.add_argument(
+        "-concurrency",
+        "--concurrency",
+        dest="concurrency",
+        type=int,
+        default=10
+    )
+    args = parser.parse_args()
+    results = run_scenarios(args.size, args.concurrency)
+    for scenario, ok, detail in results:
+        print(f"{'ok  ' if ok else 'FAIL'} {scenario} ({detail})")
+    sys.exit(0 if all(ok for _, ok, _ in results) else 1)
+
+if __name__ == '__main__':
+    main()
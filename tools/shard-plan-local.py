@@ -0,0 +1,147 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import argparse
+import asyncio
+import fnmatch
+import importlib.util
+import os
+import random
+import sys
+import tempfile
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SRC_DIR)
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+from common import shard_planner
+
+def load(path: str, name: str):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def synthetic_home(entries: int, seed: int) -> dict:
+    '''
+    A skewed home directory: a few large data and environment folders, many small project
+    folders with lots of files, and loose dotfiles.
+    '''
+    rng = random.Random(seed)
+    subtrees = {}
+    for i in range(entries):
+        if i < 3:
+            subtrees[f"data-{i}"] = {"Bytes": rng.randint(200, 600) * 2 ** 30, "Files": rng.randint(1000, 20000)}
+        elif i < 6:
+            subtrees[f"env-{i}"] = {"Bytes": rng.randint(2, 8) * 2 ** 30, "Files": rng.randint(200000, 900000)}
+        elif i < entries - 10:
+            subtrees[f"project-{i}"] = {"Bytes": int(rng.paretovariate(1.2) * 2 ** 26), "Files": int(rng.paretovariate(1.1) * 500)}
+        else:
+            subtrees[f".dotfile-{i}"] = {"Bytes": rng.randint(100, 10000), "Files": 1}
+    return subtrees
+
+def write_tree(root: str, rng: random.Random) -> dict:
+    ## a small real tree and the sizes it should produce
+    expected = {}
+    for top in ['a', 'b', 'c', '.hidden']:
+        expected[top] = {"Bytes": 0, "Files": 0}
+        for depth in range(rng.randint(1, 3)):
+            folder = os.path.join(root, top, *[f"sub{d}" for d in range(depth)])
+            os.makedirs(folder, exist_ok=True)
+            for n in range(rng.randint(1, 5)):
+                size = rng.randint(0, 4096)
+                with open(os.path.join(folder, f"f{n}"), 'wb') as f:
+                    f.write(b'x' * size)
+                expected[top]["Bytes"] += size
+                expected[top]["Files"] += 1
+    with open(os.path.join(root, 'loose.txt'), 'wb') as f:
+        f.write(b'y' * 10)
+    expected['loose.txt'] = {"Bytes": 10, "Files": 1}
+    return expected
+
+def check_manifest(seed: int) -> list:
+    results = []
+    with tempfile.TemporaryDirectory() as root:
+        expected = write_tree(root, random.Random(seed))
+        scanned = shard_planner.scan(root)
+        results.append(('scan of a real tree', scanned == expected, f"{len(scanned)} entries"))
+        lines = []
+        for path, _, files in os.walk(root):
+            for f in files:
+                full = os.path.join(path, f)
+                lines.append(f"{os.path.getsize(full)}\t./{os.path.relpath(full, root)}\n")
+        manifest = shard_planner.read_manifest(lines)
+        results.append(('manifest of the same tree', manifest == expected, f"{len(lines)} files"))
+    return results
+
+def check_plans(subtrees: dict, max_shards: int) -> list:
+    results = []
+    rows = shard_planner.report(subtrees, max_shards)
+    for row in rows:
+        shards = shard_planner.plan(subtrees, row['Shards'])
+        assigned = sorted(p for s in shards for p in s['Paths'])
+        ok = assigned == sorted(subtrees) and row['LowerBound'] <= row['Makespan'] * (1 + 1e-9) \
+            and row['Makespan'] <= row['LowerBound'] * 4 / 3 + 1e-6
+        filters = [shard_planner.include_filter(s['Paths']) for s in shards]
+        ok = ok and all(len(f) <= shard_planner.FILTER_MAX_LENGTH for f in filters)
+        results.append((f"{row['Shards']} shards", ok,
+                        f"makespan {row['Makespan']:.0f}s, lower bound {row['LowerBound']:.0f}s, speedup {row['Speedup']:.2f}x"))
+    return results
+
+def check_engine(subtrees: dict, shards: int) -> list:
+    ## the sharded input through the in-process engine: one task per shard, all in flight together,
+    ## then one unfiltered catch-all task for what no shard includes
+    local = load(os.path.join(TOOLS_DIR, 'replicate-local.py'), 'replicate_local')
+    planner = load(os.path.join(SRC_DIR, 'plan-shards.py'), 'plan_shards')
+    plan = shard_planner.plan(subtrees, shards)
+    input = planner.shard_inputs([local.replication_input(0)], plan)[0]
+    parts = local.engine(concurrency=shards)
+    outcome = asyncio.run(parts['engine'].run([input]))[0]
+    calls = parts['datasync'].calls
+    ok = outcome['Status'] == 'SUCCEEDED' and calls['CreateTask'] == len(plan) + 1 and calls['CreateLocationEfs'] == 2 \
+        and parts['engine'].peak_in_flight == len(plan) and len(parts['users'].updates) == 1 \
+        and parts['users'].updates[0][1][':b'] == str(1024 * (len(plan) + 1))
+    results = [('sharded replication on the engine', ok, f"peak in flight {parts['engine'].peak_in_flight}, calls {dict(calls)}")]
+
+    ## an entry created after planning matches no shard filter; only the catch-all task copies it
+    filters = [shard['Includes'] for shard in input['Shards']]
+    missed = not any(fnmatch.fnmatch('/new-entry', pattern) for f in filters for pattern in f.split('|'))
+    catch_all = outcome.get('CatchAll', {}).get('Result', {}).get('TaskExecutionArn', '')
+    task = catch_all.split('/execution/')[0]
+    ok = missed and task in parts['datasync'].includes and parts['datasync'].includes[task] is None \
+        and catch_all in outcome.get('Result', {}).get('TaskExecutionArns', [])
+    results.append(('catch-all pass covers entries outside the manifest', ok, f"catch-all task {task or 'missing'}"))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="check the shard planner against synthetic home directories")
+    parser.add_argument(
+        "-entries",
+        "--entries",
+        dest="entries",
+        type=int,
+        default=200
+    )
+    parser.add_argument(
+        "-max-shards",
+        "--max-shards",
+        dest="max_shards",
+        type=int,
+        default=8
+    )
+    parser.add_argument(
+        "-seed",
+        "--seed",
+        dest="seed",
+        type=int,
+        default=7
+    )
+    args = parser.parse_args()
+    subtrees = synthetic_home(args.entries, args.seed)
+    results = check_manifest(args.seed) + check_plans(subtrees, args.max_shards) + check_engine(subtrees, min(4, args.max_shards))
+    for scenario, ok, detail in results:
+        print(f"{'ok  ' if ok else 'FAIL'} {scenario} ({detail})")
+    sys.exit(0 if all(ok for _, ok, _ in results) else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+MARKER = '### handler import start ###'
+
+## runs in a fresh interpreter per handler so every measurement is a cold start
+PROBE = '''
+import importlib.util, json, sys, time
+sys.path.insert(0, {src!r})
+sys.stderr.write({marker!r} + "\\n")
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location("handler", {path!r})
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+print(json.dumps({{"init_ms": (time.perf_counter() - start) * 1000, "modules": len(sys.modules)}}))
+'''
+
+def parse_importtime(stderr: str):
+    ## keep only top-level imports made by the handler, i.e. after the marker and not nested
+    lines = stderr.split(MARKER, 1)[-1].splitlines()
+    top_level = []
+    for line in lines:
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = [part for part in line[len('import time:'):].split('|')]
+        if name.startswith('  '):
+            continue
+        top_level.append((name.strip(), int(cumulative) / 1000))
+    return top_level
+
+def measure(path: str) -> dict:
+    env = dict(os.environ)
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', PROBE.format(src=SRC_DIR, marker=MARKER, path=path)],
+        capture_output=True, text=True, env=env
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"could not import {path}: {proc.stderr.splitlines()[-1:]}")
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    imports = parse_importtime(proc.stderr)
+    result['import_ms'] = sum(ms for _, ms in imports)
+    result['heaviest'] = sorted(imports, key=lambda i: i[1], reverse=True)[:3]
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="measure cold-start import and init time of the Lambda handlers in src/")
+    parser.add_argument(
+        "-budget-ms",
+        "--budget-ms",
+        dest="budget_ms",
+        type=float,
+        default=float(os.getenv('STARTUP_BUDGET_MS', 400)),
+        help="fail when a handler's init time exceeds this many milliseconds"
+    )
+    parser.add_argument(
+        "-runs",
+        "--runs",
+        dest="runs",
+        type=int,
+        default=3,
+        help="cold starts per handler; the fastest run is reported"
+    )
+    parser.add_argument(
+        "handlers",
+        nargs="*",
+        help="handler files to measure (default: every src/*.py)"
+    )
+    args = parser.parse_args()
+    handlers = args.handlers or sorted(glob.glob(os.path.join(SRC_DIR, '*.py')))
+    handlers = [h for h in handlers if not h.endswith('__init__.py')]
+    over_budget = []
+    print(f"{'handler':<32}{'import ms':>10}{'init ms':>10}{'modules':>9}  heaviest imports")
+    for path in handlers:
+        runs = [measure(path) for _ in range(args.runs)]
+        best = min(runs, key=lambda r: r['init_ms'])
+        heaviest = ', '.join(f"{name} {ms:.0f}ms" for name, ms in best['heaviest'])
+        name = os.path.basename(path)
+        print(f"{name:<32}{best['import_ms']:>10.1f}{best['init_ms']:>10.1f}{best['modules']:>9}  {heaviest}")
+        if best['init_ms'] > args.budget_ms:
+            over_budget.append(name)
+    if over_budget:
+        sys.exit(f"init time over budget of {args.budget_ms}ms: {', '.join(over_budget)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import argparse
+import itertools
+import json
+import os
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Infrastructure', 'Templates', 'event-app.yaml')
+sys.path.insert(0, SRC_DIR)
+
+from common import stream_filter
+
+def render_yaml(criteria: dict, indent: int = 6) -> str:
+    ## the FilterCriteria block as it appears under EventStreamProcessor.Properties
+    pad = ' ' * indent
+    lines = [f"{pad}FilterCriteria:", f"{pad}  Filters:"]
+    for f in criteria['Filters']:
+        lines.append(f"{pad}    - Pattern: '{f['Pattern']}'")
+    return '\n'.join(lines)
+
+def sample_records():
+    ## every combination of the fields the rules look at
+    for event_name, replication, profile, space, efs_changed in itertools.product(
+            ['INSERT', 'MODIFY', 'REMOVE'],
+            [True, False, None],
+            ['user-a', '', None],
+            ['space-a', '', None],
+            [True, False]):
+        old = {'efs_sys_id': {'S': 'fs-old'}, 'efs_uid': {'N': '200001'}}
+        new = {'efs_sys_id': {'S': 'fs-new' if efs_changed else 'fs-old'}, 'efs_uid': {'N': '200001'}}
+        if replication is not None:
+            old['replication'] = {'BOOL': replication}
+        if profile is not None:
+            new['user_profile_name'] = {'S': profile}
+        if space is not None:
+            new['space_name'] = {'S': space}
+        yield {'eventName': event_name, 'dynamodb': {'OldImage': old, 'NewImage': new}}
+
+def check_agreement() -> list:
+    '''
+    The filter must never drop a record the handler would process, and for the rules it can express
+    it must match exactly what the handler evaluates. Returns the records that disagree.
+    '''
+    compilable = [rule for rule in stream_filter.RULES if stream_filter.is_compilable(rule)]
+    patterns = stream_filter.compile_patterns()
+    disagreements = []
+    for record in sample_records():
+        matched = stream_filter.filter_matches(record, patterns)
+        processed, _ = stream_filter.should_process(record)
+        expressible, _ = stream_filter.should_process(record, compilable)
+        if (processed and not matched) or matched != expressible:
+            disagreements.append(record)
+    return disagreements
+
+def check_template(criteria: dict, template: str) -> list:
+    with open(template) as f:
+        text = f.read()
+    return [f['Pattern'] for f in criteria['Filters'] if f"Pattern: '{f['Pattern']}'" not in text]
+
+def main():
+    parser = argparse.ArgumentParser(description="generate the stream processor's FilterCriteria from common.stream_filter.RULES")
+    parser.add_argument(
+        "-check",
+        "--check",
+        dest="check",
+        action='store_true',
+        help="verify the template is up to date and the filter agrees with the handler's evaluator"
+    )
+    parser.add_argument(
+        "-json",
+        "--json",
+        dest="json",
+        action='store_true'
+    )
+    parser.add_argument(
+        "-template",
+        "--template",
+        dest="template",
+        type=str,
+        default=TEMPLATE
+    )
+    args = parser.parse_args()
+    criteria = stream_filter.filter_criteria()
+    if not args.check:
+        print(json.dumps(criteria, indent=2) if args.json else render_yaml(criteria))
+        return
+    failed = False
+    disagreements = check_agreement()
+    for record in disagreements:
+        print(f"filter and handler disagree on {json.dumps(record)}")
+        failed = True
+    missing = check_template(criteria, args.template)
+    for pattern in missing:
+        print(f"pattern missing from {args.template}: {pattern}")
+        failed = True
+    if missing:
+        print("regenerate with:")
+        print(render_yaml(criteria))
+    if not failed:
+        print(f"ok: {len(criteria['Filters'])} filters, {len(list(sample_records()))} sample records agree")
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()